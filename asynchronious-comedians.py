@@ -1,14 +1,19 @@
-import os
 import asyncio
 import time
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from batch import BatchRunner, print_batch
+from hedging import print_hedging
+from instrumentation import print_profile
+from llm_backend import ChatRequest, get_backend
+from prompt_layout import print_prompt_cache
+from streaming import astream_request, stop_at_newline
+from transcript_sink import TranscriptSink, print_transcript
 
 # Load API key from .env file
 # This loads the environment variables from a .env file into the application's environment.
 # It allows the secure handling of sensitive information like the API key, which is not hard-coded in the script.
 load_dotenv()
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+backend = get_backend()
 
 class Agent:
     def __init__(self, name, role):
@@ -22,41 +27,91 @@ class Agent:
         self.name = name
         self.role = role
         self.system_prompt = f"You are {self.name}, a famous comedian known for {self.role}."
+        # Seconds until the first token of each response arrived
+        self.first_token_times = []
 
-    async def act(self, context):
+    def request(self, context):
         """
-        Asynchronously generate a response from the agent based on the provided context.
+        Build the API request for the given context without sending it.
 
         :param context: The context or prompt for the agent to respond to (e.g., "Tell a one-liner joke.")
-        :return: The generated response from the agent
+        :return: A ChatRequest
         """
-        response = await client.chat.completions.create(
+        return ChatRequest(
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": self.system_prompt},
                 {"role": "user", "content": context}
             ],
-            temperature=0.8,  # Adjusts the randomness of the response
-            max_tokens=60,    # Limits the length of the response
-            frequency_penalty=0.7  # Penalizes repetition
+            params={
+                "temperature": 0.8,  # Adjusts the randomness of the response
+                "max_tokens": 60,    # Limits the length of the response
+                "frequency_penalty": 0.7  # Penalizes repetition
+            },
+            meta={"agent": self.name}
         )
-        return response.choices[0].message.content 
 
-async def simulation_loop(agents, rounds):
+    async def act(self, context, on_token=None):
+        """
+        Asynchronously generate a response from the agent based on the provided context.
+        The response is streamed and stops at the end of the first line, since
+        a one-liner needs no more; the rest is never generated or billed.
+
+        :param context: The context or prompt for the agent to respond to (e.g., "Tell a one-liner joke.")
+        :param on_token: Called with each piece of the response as it arrives
+        :return: The generated response from the agent
+        """
+        response = await astream_request(backend, self.request(context),
+                                         on_token=on_token, stop=[stop_at_newline()])
+        self.first_token_times.append(response.time_to_first_token)
+        return response.content
+
+async def simulation_loop(agents, rounds, batch=None, sink=None):
     """
     Asynchronously run the simulation loop, allowing each agent to respond to a given context over multiple rounds.
 
     :param agents: A list of Agent objects representing different comedians.
     :param rounds: The number of rounds the simulation should run.
+    :param batch: An optional BatchRunner; if given, all jokes are generated in one
+                  discounted batch instead of by interactive calls
+    :param sink: The TranscriptSink the jokes are written to; by default one
+                 configured from the environment (see transcript_sink.py)
     """
     context = "Tell a one-liner joke."
-    for _ in range(rounds):
-        # Create a list of asyncio tasks for all agents to act simultaneously
-        tasks = [agent.act(context) for agent in agents]
-        completions = await asyncio.gather(*tasks)  # Run all tasks concurrently and gather the results
-        for agent, completion in zip(agents, completions):
-            # Print the response for each agent after completing their act
-            print(f"{agent.name}: {completion.strip()}")
+    if sink is None:
+        sink = TranscriptSink.from_env()
+
+    async with sink:
+        await tell_jokes(agents, rounds, context, batch, sink)
+
+async def tell_jokes(agents, rounds, context, batch, sink):
+    """
+    Generate the jokes of every round and write them to the sink.
+    """
+    if batch is not None:
+        # The comedians do not remember earlier rounds, so every joke of every round
+        # is independent and they can all go into a single batch
+        requests = {f"round-{round_num}-agent-{i}": agent.request(context)
+                    for round_num in range(1, rounds + 1) for i, agent in enumerate(agents)}
+        responses = await batch.run(requests)
+        for round_num in range(1, rounds + 1):
+            for i, agent in enumerate(agents):
+                joke = responses[f"round-{round_num}-agent-{i}"].content.strip()
+                # A batch cannot stop early, so keep only the first line, as act() does
+                await sink.emit(agent.name, joke.splitlines()[0] if joke else joke,
+                                round=round_num, kind="joke")
+        return
+
+    async def perform(agent, round_num):
+        completion = await agent.act(context)
+        # Write each joke as soon as it is complete, without waiting for the others
+        await sink.emit(agent.name, completion.strip(), round=round_num, kind="joke")
+
+    for round_num in range(1, rounds + 1):
+        # Create a list of asyncio tasks for all agents to act simultaneously.
+        # The backend's scheduler starts them as fast as the rate limit allows.
+        tasks = [perform(agent, round_num) for agent in agents]
+        await asyncio.gather(*tasks)  # Run all tasks concurrently and wait for the round to end
 
 if __name__ == "__main__":
     # Initialize a list of agents, each representing a different comedian
@@ -68,8 +123,20 @@ if __name__ == "__main__":
     # Measure the start time of the simulation
     start_time = time.time()
     # Run the asynchronous simulation loop with the list of agents and the number of rounds
-    asyncio.run(simulation_loop(agents, 2))
+    # With LLM_BATCH=1 the jokes are generated through the Batch API instead
+    # With LLM_TRANSCRIPT=jokes.jsonl every joke is also saved for analysis
+    sink = TranscriptSink.from_env()
+    batch = BatchRunner.from_env(backend)
+    asyncio.run(simulation_loop(agents, 2, batch=batch, sink=sink))
     # Measure the end time of the simulation and calculate the total execution time
     end_time = time.time()
 
     print(f"Execution time: {end_time - start_time:.2f} seconds")
+    print_transcript(sink)
+    print_batch(batch)
+    first_token_times = [t for agent in agents for t in agent.first_token_times if t is not None]
+    if first_token_times:
+        print(f"Mean time to first token: {sum(first_token_times) / len(first_token_times):.2f} seconds")
+    print_hedging(backend)
+    print_prompt_cache(backend)
+    print_profile(backend)
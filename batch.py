@@ -0,0 +1,125 @@
+"""
+Batch execution for large offline simulation sweeps.
+
+Interactive calls are the right choice when someone watches the simulation. For an
+overnight run of thousands of rounds nobody needs the answers right away, and the
+Batch API processes requests at a lower price and with far higher throughput.
+A BatchRunner writes a set of independent requests to a JSONL file in the OpenAI
+Batch format, submits it through the backend, polls until the batch is done and maps
+the results back by custom_id. Requests that failed inside the batch are retried
+interactively, so the caller always gets a complete set of answers.
+
+Batch results come straight from the base backend, past the wrappers of
+get_backend(): they are not cached, recorded, profiled or counted by the prompt
+cache meter. get_backend() therefore refuses LLM_BATCH together with LLM_CACHE or
+LLM_RECORD, and the report says how many requests the other reports leave out.
+"""
+import asyncio
+import json
+import os
+import time
+
+from llm_backend import BackendError, ChatResponse
+
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def write_batch_file(path, requests):
+    """
+    Write requests as a Batch API input file.
+
+    :param path: The JSONL file to write
+    :param requests: A dict mapping a unique custom_id to a ChatRequest
+    """
+    with open(path, "w", encoding="utf-8") as file:
+        for custom_id, request in requests.items():
+            record = {"custom_id": custom_id, "method": "POST",
+                      "url": "/v1/chat/completions", "body": request.payload()}
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class BatchRunner:
+    def __init__(self, backend, directory=".llm_batches", poll_interval=30.0, timeout=24 * 3600):
+        """
+        Run groups of independent requests as batches.
+
+        :param backend: A backend that supports submit_batch() and friends
+        :param directory: Where the batch input files are written
+        :param poll_interval: Seconds between two status checks
+        :param timeout: Seconds after which waiting for a batch is abandoned
+        """
+        self.backend = backend
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.batches = 0
+        self.requests = 0
+        self.retried = 0
+
+    @classmethod
+    def from_env(cls, backend):
+        """
+        Create a runner if LLM_BATCH is set to 1, or return None otherwise.
+        LLM_BATCH_DIR and LLM_BATCH_POLL (seconds) tune it.
+        """
+        if not batch_from_env():
+            return None
+        return cls(backend, directory=os.getenv("LLM_BATCH_DIR", ".llm_batches"),
+                   poll_interval=float(os.getenv("LLM_BATCH_POLL", "30")))
+
+    async def run(self, requests):
+        """
+        Execute independent requests as one batch.
+
+        :param requests: A dict mapping a unique custom_id to a ChatRequest
+        :return: A dict mapping each custom_id to its ChatResponse
+        """
+        if not requests:
+            return {}
+        os.makedirs(self.directory, exist_ok=True)
+        self.batches += 1
+        self.requests += len(requests)
+        path = os.path.join(self.directory, f"batch-{int(time.time())}-{self.batches}.jsonl")
+        write_batch_file(path, requests)
+
+        batch_id = await self.backend.submit_batch(path)
+        deadline = time.monotonic() + self.timeout
+        status = await self.backend.batch_status(batch_id)
+        while status not in TERMINAL_STATUSES:
+            if time.monotonic() > deadline:
+                raise BackendError(f"Batch {batch_id} did not finish in {self.timeout} seconds")
+            await asyncio.sleep(self.poll_interval)
+            status = await self.backend.batch_status(batch_id)
+
+        results = await self.backend.batch_results(batch_id) if status != "failed" else {}
+        # Whatever is missing or failed inside the batch is sent interactively
+        missing = [custom_id for custom_id in requests
+                   if not isinstance(results.get(custom_id), ChatResponse)]
+        self.retried += len(missing)
+        responses = await asyncio.gather(*(self.backend.asend(requests[custom_id])
+                                           for custom_id in missing))
+        results.update(zip(missing, responses))
+        return results
+
+    def report(self):
+        """
+        A one-line summary of the batches, and of what the other reports leave out.
+        """
+        return (f"Batch: {self.requests} requests in {self.batches} batches ({self.retried} "
+                f"retried interactively); {self.requests - self.retried} batched answers are "
+                f"not in the prompt cache, routing or profile reports")
+
+
+def batch_from_env():
+    """
+    Whether LLM_BATCH asks for batches.
+    """
+    return os.getenv("LLM_BATCH", "0").lower() in ("1", "true", "yes")
+
+
+def print_batch(runner):
+    """
+    Print the report of a BatchRunner, if batches were run.
+    """
+    if runner is not None and runner.batches:
+        print(runner.report())
@@ -0,0 +1,245 @@
+"""
+Benchmark every simulation script against the local stub backend.
+
+For each script and each combination of agent count and round count, the benchmark
+runs simulation_loop and reports wall time, per-call latency percentiles, calls
+per second and the share of prompt tokens the stub served from its simulated
+prompt cache (see prompt_layout.py). No API key is needed and nothing is billed:
+
+    python benchmark.py --agents 3,10,30 --rounds 1,2 --latency 0.05
+
+Use --json to save the results and --baseline to compare against a saved run; the
+benchmark exits with status 1 if any wall time regressed by more than --tolerance,
+which makes it usable as a CI check.
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import inspect
+import io
+import json
+import math
+import os
+import sys
+import time
+
+from llm_backend import BackendWrapper, find_wrapper, get_backend
+from population import PersonaTemplate, Population
+from prompt_layout import PromptCacheMeter
+from stub_server import LATENCY_DISTRIBUTIONS, StubBackend, StubConfig
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class TimedBackend(BackendWrapper):
+    """
+    A backend wrapper that records the latency of every call.
+    """
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.latencies = []
+
+    def send(self, request):
+        start = time.perf_counter()
+        try:
+            return self.backend.send(request)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def asend(self, request):
+        start = time.perf_counter()
+        try:
+            return await self.backend.asend(request)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    def stream(self, request):
+        start = time.perf_counter()
+        try:
+            yield from super().stream(request)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def astream(self, request):
+        start = time.perf_counter()
+        try:
+            async for chunk in super().astream(request):
+                yield chunk
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def load_script(filename):
+    """
+    Import a simulation script by file name. The scripts have hyphens in their names,
+    so they cannot be imported with a plain import statement.
+    """
+    name = os.path.splitext(filename)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def comedians(module, count):
+    return [module.Agent(f"Comedian {i}", f"comedic style number {i}") for i in range(count)]
+
+
+def presidents(module, count):
+    return [
+        module.Agent(f"President {i}", "former President",
+                     f"You are President {i}, chatting in a restaurant with other former "
+                     "Presidents. Respond with one or two lines.")
+        for i in range(count)
+    ]
+
+
+def debate(module, count):
+    candidate1 = module.Agent("Candidate A", "candidate", "You are Candidate A.")
+    candidate2 = module.Agent("Candidate B", "candidate", "You are Candidate B.")
+    moderator = module.Agent("Moderator", "moderator", "You are the debate moderator.")
+    audience = Population.generate(
+        [PersonaTemplate(f"Voter group {i}", f"You are a voter of group {i}.") for i in range(count)],
+        1000 * count, seed=0)
+    return candidate1, candidate2, moderator, audience
+
+
+# Each scenario names a script and a function that builds the simulation_loop
+# arguments (apart from the round count) for a given number of agents.
+SCENARIOS = {
+    "sequential-comedians": ("sequential-comedians.py", lambda m, n: (comedians(m, n),)),
+    "asynchronious-comedians": ("asynchronious-comedians.py", lambda m, n: (comedians(m, n),)),
+    "comedians-and-jury": ("comedians-and-jury.py",
+                           lambda m, n: (comedians(m, n), m.Agent("Jury", "judge of humor"))),
+    "conversation": ("conversation.py", lambda m, n: (presidents(m, n),)),
+    "presidential_debates": ("presidential_debates.py", debate),
+}
+
+
+def percentile(values, fraction):
+    """
+    The nearest-rank percentile of a list of numbers (e.g., fraction=0.95 for p95).
+    """
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def run_case(module, build, agents, rounds, config):
+    """
+    Run one simulation_loop against a fresh stub backend and measure it.
+
+    :return: A dict with the wall time, call count, latency percentiles and prompt
+             cache hit ratio
+    """
+    timed = TimedBackend(StubBackend(config))
+    module.backend = get_backend(timed)
+    args = build(module, agents)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = module.simulation_loop(*args, rounds)
+        if inspect.iscoroutine(result):
+            asyncio.run(result)
+    wall = time.perf_counter() - start
+
+    calls = len(timed.latencies)
+    return {
+        "agents": agents,
+        "rounds": rounds,
+        "wall_time": wall,
+        "calls": calls,
+        "calls_per_sec": calls / wall if wall > 0 else float("nan"),
+        "p50": percentile(timed.latencies, 0.50),
+        "p95": percentile(timed.latencies, 0.95),
+        "p99": percentile(timed.latencies, 0.99),
+        "cached": find_wrapper(module.backend, PromptCacheMeter).hit_ratio(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Find the cases whose wall time grew by more than `tolerance` against the baseline.
+
+    :return: A list of human readable regression descriptions
+    """
+    previous = {(r["script"], r["agents"], r["rounds"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get((result["script"], result["agents"], result["rounds"]))
+        if old and result["wall_time"] > old["wall_time"] * (1 + tolerance):
+            regressions.append(
+                f"{result['script']} agents={result['agents']} rounds={result['rounds']}: "
+                f"{old['wall_time']:.3f}s -> {result['wall_time']:.3f}s"
+            )
+    return regressions
+
+
+def parse_list(text):
+    return [int(value) for value in text.split(",") if value]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the simulation scripts offline")
+    parser.add_argument("--scripts", default=",".join(SCENARIOS),
+                        help="comma separated scenario names")
+    parser.add_argument("--agents", type=parse_list, default=[3, 10, 30])
+    parser.add_argument("--rounds", type=parse_list, default=[1, 2])
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="median stub time to first token in seconds")
+    parser.add_argument("--latency-spread", type=float, default=0.5)
+    parser.add_argument("--tokens-per-sec", type=float, default=2000.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--prefix-cache-min", type=int, default=1024,
+                        help="shortest prompt, in tokens, the stub serves from its prompt cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results saved with --json")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative wall time growth before failing")
+    args = parser.parse_args(argv)
+
+    # The scripts build their backend at import time; make sure that never needs a key
+    os.environ["LLM_BACKEND"] = "stub"
+
+    results = []
+    print(f"{'script':<26}{'agents':>7}{'rounds':>7}{'wall s':>9}{'calls':>7}"
+          f"{'calls/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'cached':>8}")
+    for name in args.scripts.split(","):
+        filename, build = SCENARIOS[name]
+        module = load_script(filename)
+        for agents in args.agents:
+            for rounds in args.rounds:
+                config = StubConfig(latency_dist=args.latency_dist, latency=args.latency,
+                                    latency_spread=args.latency_spread,
+                                    tokens_per_second=args.tokens_per_sec,
+                                    error_rate=args.error_rate,
+                                    rate_limit_rate=args.rate_limit_rate,
+                                    prefix_cache_min=args.prefix_cache_min, seed=args.seed)
+                result = {"script": name, **run_case(module, build, agents, rounds, config)}
+                results.append(result)
+                print(f"{name:<26}{agents:>7}{rounds:>7}{result['wall_time']:>9.3f}"
+                      f"{result['calls']:>7}{result['calls_per_sec']:>9.1f}"
+                      f"{result['p50'] * 1000:>9.1f}{result['p95'] * 1000:>9.1f}"
+                      f"{result['p99'] * 1000:>9.1f}{result['cached']:>8.0%}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""
+Checkpoint a running simulation, and resume it after a crash.
+
+When a 500-round debate fails at round 150 (a quota error, a lost connection, a
+laptop going to sleep), every agent's history is gone and the 149 rounds already
+paid for have to be generated again. With LLM_CHECKPOINT=run.ckpt, every completed
+turn is appended to a checkpoint file: the turn's result and the changes it made to
+the simulation state, such as the messages added to an agent's context window, the
+lines added to the shared transcript or the verdicts added to a VerdictTable. Each
+record only holds what is new, so a checkpoint costs O(new turns), not a copy of the
+whole state.
+
+With LLM_RESUME=1 the script rebuilds the state from the file and continues the
+run: completed turns are restored instead of being sent to the model again, and
+only the pending turns (those that are not in the file) run. The file also stores
+the state of the global random generator when the run started, so that random
+choices, such as the speaking order or the sampled voters, come out the same.
+`python checkpoint.py run.ckpt --resume` does the same for the script that wrote
+the file.
+
+Objects that a turn changes implement two methods: checkpoint(), which returns the
+changes since its last call as JSON-serializable data, and restore(changes), which
+applies them.
+"""
+import argparse
+import json
+import os
+import random
+import runpy
+import sys
+
+
+class Checkpoint:
+    def __init__(self, path, resume=False):
+        """
+        Record completed turns in an append-only file, or continue from one.
+
+        :param path: The checkpoint file
+        :param resume: Whether to continue the run recorded in `path`; otherwise the
+                       file is replaced by a new checkpoint. Create the checkpoint
+                       before anything random happens, so that resuming restores
+                       the random generator to the same state.
+        """
+        self.path = path
+        self.turns = {}  # name -> (result, changes) of the turns completed before
+        self.restored = 0
+        if resume:
+            self._load()
+            self.file = open(path, "a", encoding="utf-8")
+        else:
+            self.script = os.path.abspath(sys.argv[0])
+            self.file = open(path, "w", encoding="utf-8")
+            version, state, gauss = random.getstate()
+            header = {"checkpoint": 1, "script": self.script, "random": [version, state, gauss]}
+            self.file.write(json.dumps(header) + "\n")
+            self.file.flush()
+
+    def _load(self):
+        valid = 0
+        with open(self.path, "rb") as file:
+            header = json.loads(file.readline())
+            valid = file.tell()
+            for line in file:
+                # The last record may have been cut short by the crash
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                self.turns[record["turn"]] = (record["result"], record["changes"])
+                valid += len(line)
+        # Drop a partial record, so that new records start on a line of their own
+        os.truncate(self.path, valid)
+        self.script = header["script"]
+        version, state, gauss = header["random"]
+        random.setstate((version, tuple(state), gauss))
+
+    @classmethod
+    def from_env(cls):
+        """
+        A Checkpoint if LLM_CHECKPOINT names a file, or None. With LLM_RESUME=1 and an
+        existing file, the run recorded in it is continued.
+        """
+        path = os.getenv("LLM_CHECKPOINT")
+        if not path:
+            return None
+        resume = os.getenv("LLM_RESUME", "0").lower() in ("1", "true", "yes")
+        return cls(path, resume=resume and os.path.exists(path))
+
+    def __contains__(self, name):
+        return name in self.turns
+
+    def _restore(self, name, state):
+        result, changes = self.turns[name]
+        for target, change in zip(state, changes):
+            target.restore(change)
+        self.restored += 1
+        return result
+
+    def _save(self, name, result, state):
+        record = {"turn": name, "result": result,
+                  "changes": [target.checkpoint() for target in state]}
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def run(self, name, action, state=()):
+        """
+        Run a turn and record it, or restore it if it was completed before.
+
+        :param name: A name that identifies the turn in every run (e.g., "round 3: Nixon")
+        :param action: A function without arguments that runs the turn and returns a
+                       JSON-serializable result
+        :param state: The objects the turn changes (with checkpoint() and restore())
+        :return: The result of the turn
+        """
+        if name in self.turns:
+            return self._restore(name, state)
+        result = action()
+        self._save(name, result, state)
+        return result
+
+    async def arun(self, name, action, state=()):
+        """
+        The asynchronous counterpart of run(); `action` returns an awaitable.
+        """
+        if name in self.turns:
+            return self._restore(name, state)
+        result = await action()
+        # Nothing runs between the end of the action and the write, so the changes
+        # recorded are exactly the ones this turn made
+        self._save(name, result, state)
+        return result
+
+    def report(self):
+        """
+        A one-line summary of what was restored.
+        """
+        return (f"Checkpoint {self.path}: {self.restored} of {len(self.turns)} completed turns "
+                f"restored")
+
+
+def print_checkpoint(checkpoint):
+    """
+    Print what a resumed run restored, if it was resumed.
+    """
+    if checkpoint is not None and checkpoint.turns:
+        print(checkpoint.report())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or resume a checkpointed run")
+    parser.add_argument("checkpoint")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the run with the script that wrote the checkpoint")
+    args = parser.parse_args(argv)
+
+    with open(args.checkpoint, encoding="utf-8") as file:
+        header = json.loads(file.readline())
+        turns = [json.loads(line)["turn"] for line in file if line.endswith("\n")]
+    print(f"{args.checkpoint}: {header['script']}, {len(turns)} completed turns"
+          + (f", the last one {turns[-1]!r}" if turns else ""))
+    if args.resume:
+        os.environ["LLM_CHECKPOINT"] = args.checkpoint
+        os.environ["LLM_RESUME"] = "1"
+        sys.argv = [header["script"]]
+        sys.path.insert(0, os.path.dirname(header["script"]))
+        runpy.run_path(header["script"], run_name="__main__")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
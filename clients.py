@@ -0,0 +1,150 @@
+"""
+Process-wide API clients, created on first use, with tuned connection pools.
+
+Every script used to build its OpenAI clients while it was imported. That is slow
+(the openai package alone takes about half a second to import), happens even when
+the script is only imported by the benchmark, and leaves the HTTP connection pool
+at its defaults: at most 20 idle connections are kept alive, so a run with
+hundreds of concurrent agents keeps opening new TLS connections.
+
+The clients now live in a registry. get_client() and get_async_client() create a
+client the first time it is asked for and return the same one afterwards, so all
+agents of the process share one pool of warm connections. The pool is configured
+from the environment:
+
+    LLM_POOL_MAX_CONNECTIONS   connections open at once (100)
+    LLM_POOL_MAX_KEEPALIVE     idle connections kept for reuse (as many as the above)
+    LLM_POOL_KEEPALIVE_EXPIRY  seconds an idle connection is kept (60)
+    LLM_HTTP2=1                multiplex requests over HTTP/2 (needs the h2 package)
+    LLM_TIMEOUT                seconds a request may take (600)
+    LLM_CONNECT_TIMEOUT        seconds to establish a connection (5)
+
+Asynchronous connections belong to the event loop that opened them, so there is one
+asynchronous client per event loop.
+"""
+import asyncio
+import importlib
+import os
+import threading
+import weakref
+
+
+def _http_library():
+    """
+    The HTTP library the installed openai package is built on: httpx, or httpx2 since
+    openai 3. The pool limits must come from the same library as the client.
+    """
+    from openai import DEFAULT_CONNECTION_LIMITS
+
+    return importlib.import_module(type(DEFAULT_CONNECTION_LIMITS).__module__.split(".")[0])
+
+
+class ClientConfig:
+    def __init__(self, max_connections=100, max_keepalive=None, keepalive_expiry=60.0,
+                 http2=False, timeout=600.0, connect_timeout=5.0):
+        """
+        Describe the HTTP connection pool of a client.
+
+        :param max_connections: The most connections open at once
+        :param max_keepalive: The most idle connections kept for reuse; defaults to
+                              max_connections, so that a burst of calls does not
+                              close the connections the next burst needs
+        :param keepalive_expiry: Seconds an idle connection is kept
+        :param http2: Whether to use HTTP/2, which sends many requests over one connection
+        :param timeout: Seconds a request may take
+        :param connect_timeout: Seconds to establish a connection
+        """
+        self.max_connections = max_connections
+        self.max_keepalive = max_connections if max_keepalive is None else max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+
+    @classmethod
+    def from_env(cls):
+        """
+        A ClientConfig from the LLM_POOL_*, LLM_HTTP2 and LLM_*TIMEOUT variables.
+        """
+        keepalive = os.getenv("LLM_POOL_MAX_KEEPALIVE")
+        return cls(max_connections=int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "100")),
+                   max_keepalive=int(keepalive) if keepalive else None,
+                   keepalive_expiry=float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60")),
+                   http2=os.getenv("LLM_HTTP2", "0").lower() in ("1", "true", "yes"),
+                   timeout=float(os.getenv("LLM_TIMEOUT", "600")),
+                   connect_timeout=float(os.getenv("LLM_CONNECT_TIMEOUT", "5")))
+
+    def key(self):
+        return (self.max_connections, self.max_keepalive, self.keepalive_expiry, self.http2,
+                self.timeout, self.connect_timeout)
+
+    def http_options(self):
+        """
+        The keyword arguments for the HTTP client of an OpenAI client with this pool.
+        """
+        http = _http_library()
+        return {"limits": http.Limits(max_connections=self.max_connections,
+                                       max_keepalive_connections=self.max_keepalive,
+                                       keepalive_expiry=self.keepalive_expiry),
+                "timeout": http.Timeout(self.timeout, connect=self.connect_timeout),
+                "http2": self.http2}
+
+
+_lock = threading.Lock()
+_clients = {}  # (api key, base url, retries, pool) -> OpenAI client
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {same key -> AsyncOpenAI client}
+
+
+def _key(api_key, base_url, max_retries, config):
+    return (api_key or os.getenv("OPENAI_API_KEY"), base_url, max_retries, config.key())
+
+
+def get_client(api_key=None, base_url=None, max_retries=2, config=None):
+    """
+    The shared synchronous OpenAI client for these settings, created on first use.
+
+    :param api_key: The API key; defaults to the OPENAI_API_KEY environment variable
+    :param base_url: An alternative endpoint, e.g. the local stub server
+    :param max_retries: How often the client itself retries a failed request
+    :param config: A ClientConfig; defaults to ClientConfig.from_env()
+    """
+    config = config or ClientConfig.from_env()
+    key = _key(api_key, base_url, max_retries, config)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            from openai import DefaultHttpxClient, OpenAI
+
+            client = OpenAI(api_key=key[0], base_url=base_url, max_retries=max_retries,
+                            http_client=DefaultHttpxClient(**config.http_options()))
+            _clients[key] = client
+    return client
+
+
+def get_async_client(api_key=None, base_url=None, max_retries=2, config=None):
+    """
+    The shared asynchronous OpenAI client of the running event loop, created on
+    first use. Takes the same arguments as get_client().
+    """
+    config = config or ClientConfig.from_env()
+    key = _key(api_key, base_url, max_retries, config)
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(key)
+    if client is None:
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        client = AsyncOpenAI(api_key=key[0], base_url=base_url, max_retries=max_retries,
+                             http_client=DefaultAsyncHttpxClient(**config.http_options()))
+        clients[key] = client
+    return client
+
+
+def close_clients():
+    """
+    Close the synchronous clients and forget every client, e.g. between benchmark runs.
+    """
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        _async_clients.clear()
@@ -1,12 +1,21 @@
-import os
 import asyncio
 import time
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from batch import BatchRunner, print_batch
+from hedging import print_hedging
+from instrumentation import print_profile
+from llm_backend import ChatRequest, get_backend
+from prompt_layout import assemble, print_prompt_cache
+from routing import choice_of, print_routing
+from streaming import astream_request, stop_at_newline
+from tournament import Tournament, print_tournament
+from transcript_sink import TranscriptSink, print_transcript
+from turn_graph import TurnGraph
+from verdicts import INSTRUCTIONS, VerdictTable, format_verdict
 
 # Load API key from the .env file to securely access the OpenAI API
 load_dotenv()
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+backend = get_backend()
 
 class Agent:
     def __init__(self, name, role):
@@ -20,57 +29,230 @@ class Agent:
         self.role = role
         self.system_prompt = f"You are {self.name}, a famous {role}."
 
-    async def act(self, context):
+    def request(self, context, shared=(), meta=None, **params):
         """
-        Generate an asynchronous response from the agent based on the given context.
+        Build the API request for the given context without sending it.
         
         :param context: The context or prompt for the agent (e.g., "Tell a one-liner joke.")
-        :return: The generated response from the agent
+        :param shared: Instructions that are the same in every request, sent before
+                       `context` so that they form a cacheable prefix (see prompt_layout.py)
+        :param meta: Extra metadata for the backend (e.g., the role that picks the model)
+        :param params: Extra API parameters (e.g., response_format)
+        :return: A ChatRequest
         """
-        # Make an asynchronous call to the OpenAI API to generate a response
-        response = await client.chat.completions.create(
+        return ChatRequest(
             model="gpt-4o",
-            messages=[
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": context}
-            ]
+            messages=assemble(self.system_prompt, shared, context),
+            params=params,
+            meta={"agent": self.name, **(meta or {})}
         )
+
+    async def act(self, context, stop=None, **params):
+        """
+        Generate an asynchronous response from the agent based on the given context.
+        
+        :param context: The context or prompt for the agent (e.g., "Tell a one-liner joke.")
+        :param stop: Stop predicates that end the response early (see streaming.py)
+        :param params: Extra API parameters (e.g., response_format)
+        :return: The generated response from the agent
+        """
+        # Stream the response from the OpenAI API, closing the stream as soon as a
+        # stop predicate fires so the rest is never generated
+        response = await astream_request(backend, self.request(context, **params), stop=stop)
         # Return the generated response content
-        return response.choices[0].message.content 
+        return response.content
+
+# The jury's instructions are the same every round, so they come before the jokes,
+# which change every round
+JURY_INSTRUCTIONS = ("You will be shown the jokes told by the comedians in one round. "
+                     "Please decide which joke is the best and explain why it is so.")
+
+def jury_context(comedians, jokes):
+    """
+    Prepare the context for the jury to judge the jokes.
+
+    :param comedians: The comedians, in the order their jokes are listed
+    :param jokes: The jokes, one per comedian
+    """
+    context = f"Here are the jokes told by the comedians:\n"
+    for comedian, joke in zip(comedians, jokes):
+        context += f"{comedian.name}: {joke}\n"
+    return context.rstrip("\n")
+
+def jury_request(jury, comedians, jokes, verdicts=None):
+    """
+    The jury's request for one round (or one heat of a tournament); with a
+    VerdictTable, the jury answers in JSON.
+    """
+    # The jury must pick one of the comedians; with LLM_ROUTES a small model judges
+    # first, and the big one only if it does not (see routing.py)
+    names = [comedian.name for comedian in comedians]
+    meta = {"role": "jury", "choices": names}
+    if verdicts is None:
+        return jury.request(jury_context(comedians, jokes), shared=[JURY_INSTRUCTIONS],
+                            meta=meta)
+    return jury.request(jury_context(comedians, jokes),
+                        shared=[f"{JURY_INSTRUCTIONS}\n{INSTRUCTIONS}"], meta=meta,
+                        response_format=verdicts.response_format(names))
+
+def jury_decision(round_num, text, verdicts=None):
+    """
+    Record a structured verdict and return the text to print for the jury decision.
+    """
+    if verdicts is None:
+        return text
+    verdict = verdicts.add(round_num, text)
+    return format_verdict(verdict) if verdict else text
 
-async def simulation_loop(comedians, jury, rounds):
+def tournament_decision(tournament, standings, top=3):
+    """
+    The text to print for a round judged by a tournament.
+    """
+    leaders = ", ".join(f"{name} (won {wins}, rating {rating:.0f})"
+                        for name, wins, rating in standings[:top])
+    return (f"{standings[0][0]} wins the {tournament.schedule} tournament of "
+            f"{len(standings)} comedians. Leaders: {leaders}.")
+
+async def judge_tournament(tournament, round_num, comedians, jokes, verdicts=None):
+    """
+    Judge a round in small heats, spread over the tournament's jury agents.
+    """
+    jokes_of = {comedian.name: (comedian, joke) for comedian, joke in zip(comedians, jokes)}
+
+    async def judge_heat(jury, names):
+        heat = [jokes_of[name] for name in names]
+        request = jury_request(jury, [comedian for comedian, _ in heat],
+                               [joke for _, joke in heat], verdicts)
+        response = await astream_request(backend, request)
+        if verdicts is not None:
+            verdict = verdicts.add(round_num, response.content, candidates=names)
+            return verdict["winner"] if verdict else None
+        return choice_of(response.content, names)
+
+    standings = await tournament.run(list(jokes_of), judge_heat)
+    return tournament_decision(tournament, standings)
+
+async def report_round(sink, round_num, comedians, jury, jokes, decision):
+    """
+    Write one round to the transcript sink (see transcript_sink.py).
+    """
+    for index, (comedian, joke) in enumerate(zip(comedians, jokes)):
+        await sink.emit(comedian.name, joke, round=round_num, kind="joke", index=index)
+    await sink.emit(jury.name, decision, round=round_num, kind="verdict")
+
+def render_round(record):
+    """
+    Render a record of the transcript on the console.
+    """
+    if record["kind"] == "verdict":
+        return f"\nJury Decision:\n{record['text']}\n"
+    line = f"{record['speaker']}: {record['text']}"
+    return f"\nRound {record['round']}:\n\n{line}" if record["index"] == 0 else line
+
+async def batch_simulation(comedians, jury, rounds, batch, sink, verdicts=None):
+    """
+    Run the whole simulation with two batches: one with the jokes of all rounds,
+    then, once they are back, one with the jury decisions of all rounds.
+    """
+    context = "Tell a one-liner joke."
+    joke_requests = {f"round-{round_num}-comedian-{i}": comedian.request(context)
+                     for round_num in range(1, rounds + 1)
+                     for i, comedian in enumerate(comedians)}
+    joke_responses = await batch.run(joke_requests)
+
+    jokes = {}
+    for round_num in range(1, rounds + 1):
+        round_jokes = []
+        for i in range(len(comedians)):
+            joke = joke_responses[f"round-{round_num}-comedian-{i}"].content.strip()
+            # A batch cannot stop early, so keep only the first line of the one-liner
+            round_jokes.append(joke.splitlines()[0] if joke else joke)
+        jokes[round_num] = round_jokes
+
+    jury_responses = await batch.run({
+        f"round-{round_num}-jury": jury_request(jury, comedians, jokes[round_num], verdicts)
+        for round_num in range(1, rounds + 1)
+    })
+    for round_num in range(1, rounds + 1):
+        decision = jury_decision(round_num, jury_responses[f"round-{round_num}-jury"].content,
+                                 verdicts)
+        await report_round(sink, round_num, comedians, jury, jokes[round_num], decision)
+
+async def simulation_loop(comedians, jury, rounds, batch=None, verdicts=None, sink=None,
+                          tournament=None):
     """
     Simulate a loop where comedians tell jokes and the jury decides the best joke.
+
+    The rounds are declared as a graph of turns: the jury of a round waits for that
+    round's jokes, but nothing else waits for the jury. Since comedians do not remember
+    earlier rounds, the jokes of round N+1 are written while the jury judges round N.
+    With a tournament, the jury of round N+1 also waits for the jury of round N, so
+    that each round's heats are seeded by the ratings of the rounds before it.
     
     :param comedians: A list of Agent objects representing comedians
     :param jury: An Agent object representing the jury
     :param rounds: The number of rounds to run the simulation
+    :param batch: An optional BatchRunner; if given, the simulation runs as two
+                  discounted batches instead of interactive calls
+    :param verdicts: An optional VerdictTable; if given, the jury answers in JSON
+                     and every verdict is recorded in it
+    :param sink: The TranscriptSink the rounds are written to; by default one
+                 configured from the environment (see transcript_sink.py)
+    :param tournament: An optional Tournament; if given, each round is judged in small
+                       heats instead of one call with all jokes (see tournament.py).
+                       Batch mode always uses one call per round.
+    :return: The executed TurnGraph, which can report the critical path
+             (None in batch mode)
     """
+    if sink is None:
+        sink = TranscriptSink.from_env(render_round)
+    if batch is not None:
+        async with sink:
+            await batch_simulation(comedians, jury, rounds, batch, sink, verdicts)
+        return None
+
     context = "Tell a one-liner joke."  # The shared context for comedians
 
-    for round_num in range(1, rounds + 1):
-        print(f"\nRound {round_num}:\n")
-        
-        # Comedians generate their jokes asynchronously
-        tasks = [comedian.act(context) for comedian in comedians]
-        completions = await asyncio.gather(*tasks)
-        
-        # Store jokes with comedian names
-        jokes = {comedian.name: completion.strip() for comedian, completion in zip(comedians, completions)}
-        
-        # Print each comedian's joke
-        for comedian_name, joke in jokes.items():
-            print(f"{comedian_name}: {joke}")
+    def tell_joke(comedian):
+        async def turn(inputs):
+            # A one-liner ends at the first line break
+            return (await comedian.act(context, stop=[stop_at_newline()])).strip()
+        return turn
+
+    def judge(round_num, joke_turns):
+        async def turn(inputs):
+            jokes = [inputs[joke_turn] for joke_turn in joke_turns]
+            if tournament is not None:
+                return await judge_tournament(tournament, round_num, comedians, jokes, verdicts)
+            response = await astream_request(backend, jury_request(jury, comedians, jokes, verdicts))
+            return jury_decision(round_num, response.content, verdicts)
+        return turn
 
-        # Prepare context for the jury to judge the jokes
-        jury_context = f"Here are the jokes told by the comedians:\n"
-        for comedian_name, joke in jokes.items():
-            jury_context += f"{comedian_name}: {joke}\n"
-        jury_context += "Please decide which joke is the best and explain why it is so."
+    def report(round_num, joke_turns, jury_turn):
+        async def turn(inputs):
+            # Write the round only after the previous one, so the output stays in order
+            await report_round(sink, round_num, comedians, jury,
+                               [inputs[t] for t in joke_turns], inputs[jury_turn])
+        return turn
 
-        # Jury gives its decision asynchronously
-        jury_decision = await jury.act(jury_context)
-        print(f"\nJury Decision:\n{jury_decision}\n")
+    graph = TurnGraph()
+    previous_report, previous_jury = [], []
+    for round_num in range(1, rounds + 1):
+        # Comedians generate their jokes concurrently, paced by the backend's scheduler
+        joke_turns = [graph.add(f"round {round_num}: {comedian.name}", tell_joke(comedian))
+                      for comedian in comedians]
+        # The jury needs all jokes of the round. A tournament also waits for the one
+        # of the previous round, whose ratings seed its heats
+        jury_turn = graph.add(f"round {round_num}: jury", judge(round_num, joke_turns),
+                              deps=joke_turns + previous_jury)
+        previous_jury = [jury_turn] if tournament is not None else []
+        previous_report = [graph.add(f"round {round_num}: report",
+                                     report(round_num, joke_turns, jury_turn),
+                                     deps=joke_turns + [jury_turn] + previous_report)]
+
+    async with sink:
+        await graph.run()
+    return graph
 
 if __name__ == "__main__":
     # Initialize comedians as agents with specific humor styles
@@ -82,13 +264,38 @@ if __name__ == "__main__":
     
     # Initialize the jury agent
     jury = Agent("Jury", "critical and fair judge of humor")
+    # With LLM_TOURNAMENT=swiss or bracket, a panel of jurors judges the jokes in
+    # small heats, which scales to many more comedians
+    tournament = Tournament.from_env([
+        jury,
+        Agent("Jury of Critics", "demanding critic who values originality"),
+        Agent("Jury of Fans", "comedy fan who laughs at a good punchline"),
+    ])
+
+    # With LLM_VERDICTS=json, the jury's verdicts are structured and aggregated
+    verdicts = VerdictTable.from_env([comedian.name for comedian in comedians])
 
     # Record the start time of the simulation
     start_time = time.time()
 
-    # Run the asynchronous simulation loop
-    asyncio.run(simulation_loop(comedians, jury, 2))
+    # Run the asynchronous simulation loop; with LLM_BATCH=1 it uses the Batch API
+    # With LLM_TRANSCRIPT=comedians.jsonl every joke and decision is also saved
+    sink = TranscriptSink.from_env(render_round)
+    batch = BatchRunner.from_env(backend)
+    graph = asyncio.run(simulation_loop(comedians, jury, 2, batch=batch, verdicts=verdicts,
+                                        sink=sink, tournament=tournament))
 
     # Record the end time and calculate the execution duration
     end_time = time.time()
     print(f"Execution time: {end_time - start_time:.2f} seconds")
+    if graph is not None:
+        print(graph.report())
+    print_transcript(sink)
+    print_batch(batch)
+    print_hedging(backend)
+    print_prompt_cache(backend)
+    print_routing(backend)
+    print_profile(backend)
+    print_tournament(tournament)
+    if verdicts is not None:
+        print(verdicts.summary())
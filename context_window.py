@@ -0,0 +1,287 @@
+"""
+Token-budgeted conversation memory for long-running agents.
+
+An agent that appends every turn to its message list sends a longer prompt every
+round, so prompt tokens, latency and cost grow with the square of the number of
+rounds until the request no longer fits the model's context. A ContextWindow keeps
+the agent's history but only sends what fits in a fixed token budget:
+
+* "sliding" drops the oldest turns, and
+* "summarize" folds the oldest turns into a rolling memo written by the model.
+
+The system prompt is always kept. Token counts are computed locally, once per
+message, and every request records how many prompt tokens the budget saved.
+
+Dropping exactly as many turns as needed on every request would change the start
+of the prompt every time, so the provider's prompt cache (see prompt_layout.py)
+would never hit. Once the window is over budget, it is brought down to TRIM_TO of
+the budget instead, and then stays put, a byte-identical prefix, for the next few
+requests.
+"""
+import itertools
+import os
+from collections import deque
+
+from llm_backend import estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+STRATEGIES = ("sliding", "summarize")
+
+# Tokens the chat format adds around every message
+MESSAGE_OVERHEAD = 4
+
+# The share of the budget a sliding window is trimmed to when it overflows
+TRIM_TO = 0.75
+
+
+class TokenCounter:
+    def __init__(self, model="gpt-4o"):
+        """
+        Count tokens the way `model` does if tiktoken is installed, or estimate them
+        from the text length otherwise.
+
+        :param model: The model whose tokenizer should be used
+        """
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        return estimate_tokens(text)
+
+    def count_message(self, message):
+        return self.count(message["content"]) + MESSAGE_OVERHEAD
+
+
+class LLMSummarizer:
+    def __init__(self, backend, model="gpt-4o", max_tokens=200):
+        """
+        Fold old conversation turns into a short memo using the model itself.
+
+        :param backend: The backend used for the summarization calls
+        :param model: The model that writes the memo
+        :param max_tokens: The maximum length of the memo
+        """
+        self.backend = backend
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def _request(self, memo, turns):
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in turns)
+        prompt = (
+            f"Previous summary:\n{memo or '(none)'}\n\n"
+            f"New conversation turns:\n{transcript}\n\n"
+            "Update the summary so that it covers everything above. Keep names, positions "
+            "and commitments; drop small talk. Answer with the summary only."
+        )
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": "You maintain concise running summaries of conversations."},
+                {"role": "user", "content": prompt},
+            ],
+            "max_tokens": self.max_tokens,
+            "meta": {"agent": "summarizer"},
+        }
+
+    def summarize(self, memo, turns):
+        return self.backend.complete(**self._request(memo, turns)).content.strip()
+
+    async def asummarize(self, memo, turns):
+        return (await self.backend.acomplete(**self._request(memo, turns))).content.strip()
+
+
+class ContextWindow:
+    def __init__(self, system_prompt, budget=3000, strategy="sliding", summarizer=None,
+                 counter=None):
+        """
+        Keep an agent's conversation within a prompt token budget.
+
+        :param system_prompt: The agent's system prompt, which is always sent first
+        :param budget: The maximum number of prompt tokens sent in one request
+        :param strategy: "sliding" or "summarize"
+        :param summarizer: An LLMSummarizer; required by the "summarize" strategy
+        :param counter: A TokenCounter; defaults to one for gpt-4o
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy: {strategy!r} (expected one of {STRATEGIES})")
+        if strategy == "summarize" and summarizer is None:
+            raise ValueError("The 'summarize' strategy needs a summarizer")
+        self.counter = counter or TokenCounter()
+        self.budget = budget
+        self.strategy = strategy
+        self.summarizer = summarizer
+        self.system = {"role": "system", "content": system_prompt}
+        self.system_tokens = self.counter.count_message(self.system)
+        self.memo = ""
+        self.memo_tokens = 0
+        self.turns = deque()  # (message, tokens)
+        self.turn_tokens = 0  # tokens of the turns still in the window
+        self.full_tokens = self.system_tokens  # tokens of the complete, untrimmed history
+        self.rounds = []  # one {"full", "sent", "saved"} record per request
+        self.appended = 0  # turns appended in total
+        self._mark()
+
+    @classmethod
+    def from_env(cls, system_prompt, backend):
+        """
+        Create a window configured by LLM_CONTEXT_BUDGET (tokens, default 3000) and
+        LLM_CONTEXT_STRATEGY ("sliding" or "summarize", default "sliding").
+
+        :param system_prompt: The agent's system prompt
+        :param backend: The backend used for summaries by the "summarize" strategy
+        """
+        strategy = os.getenv("LLM_CONTEXT_STRATEGY", "sliding")
+        return cls(
+            system_prompt,
+            budget=int(os.getenv("LLM_CONTEXT_BUDGET", "3000")),
+            strategy=strategy,
+            summarizer=LLMSummarizer(backend) if strategy == "summarize" else None,
+        )
+
+    def append(self, role, content):
+        """
+        Add a turn to the history. Its tokens are counted once, here.
+        """
+        message = {"role": role, "content": content}
+        tokens = self.counter.count_message(message)
+        self.turns.append((message, tokens))
+        self.turn_tokens += tokens
+        self.full_tokens += tokens
+        self.appended += 1
+
+    def _sent_tokens(self):
+        return self.system_tokens + self.memo_tokens + self.turn_tokens
+
+    def _oldest_turns_over_budget(self, budget):
+        """
+        Remove and return the oldest turns until the window fits `budget`.
+        The newest turn is always kept, even if it does not fit on its own.
+        """
+        removed = []
+        while self._sent_tokens() > budget and len(self.turns) > 1:
+            message, tokens = self.turns.popleft()
+            self.turn_tokens -= tokens
+            removed.append(message)
+        return removed
+
+    def _set_memo(self, memo):
+        self.memo = memo
+        self.memo_tokens = self.counter.count_message(self._memo_message()) if memo else 0
+
+    def _memo_message(self):
+        return {"role": "system", "content": f"Summary of the earlier conversation: {self.memo}"}
+
+    def _messages(self):
+        messages = [self.system]
+        if self.memo:
+            messages.append(self._memo_message())
+        messages.extend(message for message, _ in self.turns)
+        self.rounds.append({"full": self.full_tokens, "sent": self._sent_tokens(),
+                            "saved": self.full_tokens - self._sent_tokens()})
+        return messages
+
+    def _turns_to_summarize(self):
+        """
+        With the "summarize" strategy, remove the turns that should be folded into the
+        memo. The window is brought down to half the budget, so that a summary is not
+        needed on every turn.
+        """
+        if self.strategy != "summarize" or self._sent_tokens() <= self.budget:
+            return []
+        return self._oldest_turns_over_budget(self.budget // 2)
+
+    def _slide(self):
+        """
+        Drop the oldest turns if the window is over budget, down to TRIM_TO of the
+        budget, so that the start of the window stays the same for a while.
+        """
+        if self._sent_tokens() > self.budget:
+            self._oldest_turns_over_budget(int(self.budget * TRIM_TO))
+
+    def messages(self):
+        """
+        The messages to send for the next request, trimmed to the budget.
+        """
+        folded = self._turns_to_summarize()
+        if folded:
+            self._set_memo(self.summarizer.summarize(self.memo, folded))
+        self._slide()
+        return self._messages()
+
+    async def amessages(self):
+        """
+        The asynchronous counterpart of messages(), for agents running in an event loop.
+        """
+        folded = self._turns_to_summarize()
+        if folded:
+            self._set_memo(await self.summarizer.asummarize(self.memo, folded))
+        self._slide()
+        return self._messages()
+
+    def savings(self):
+        """
+        Total prompt tokens sent, and saved compared with sending the full history.
+        """
+        sent = sum(r["sent"] for r in self.rounds)
+        saved = sum(r["saved"] for r in self.rounds)
+        return {"requests": len(self.rounds), "sent": sent, "saved": saved}
+
+    def _mark(self):
+        self._saved = (self.appended, len(self.turns), len(self.rounds), self.memo)
+
+    def checkpoint(self):
+        """
+        The changes since the last checkpoint (see checkpoint.py). The window is always
+        the newest part of the history, so the changes are how many of the oldest turns
+        were dropped and which of the new turns are still in the window.
+        """
+        appended, length, requests, memo = self._saved
+        new = min(self.appended - appended, len(self.turns))
+        changes = {
+            "drop": length - (len(self.turns) - new),
+            "append": [message for message, _ in itertools.islice(reversed(self.turns), new)][::-1],
+            "full_tokens": self.full_tokens,
+            "rounds": self.rounds[requests:],
+        }
+        if self.memo != memo:
+            changes["memo"] = self.memo
+        self._mark()
+        return changes
+
+    def restore(self, changes):
+        """
+        Apply changes returned by checkpoint().
+        """
+        for _ in range(changes["drop"]):
+            _, tokens = self.turns.popleft()
+            self.turn_tokens -= tokens
+        for message in changes["append"]:
+            self.append(message["role"], message["content"])
+        self.full_tokens = changes["full_tokens"]
+        self.rounds.extend(changes["rounds"])
+        if "memo" in changes:
+            self._set_memo(changes["memo"])
+        self._mark()
+
+
+def print_savings(agents):
+    """
+    Print how many prompt tokens each agent's context window saved.
+
+    :param agents: Agents with a `context` attribute holding a ContextWindow
+    """
+    print("Prompt tokens sent / saved by the context window:")
+    for agent in agents:
+        savings = agent.context.savings()
+        print(f"  {agent.name}: {savings['sent']} sent, {savings['saved']} saved "
+              f"over {savings['requests']} requests")
@@ -1,11 +1,17 @@
-import os
+import asyncio
 import time
-from openai import OpenAI
 from dotenv import load_dotenv
+from checkpoint import Checkpoint, print_checkpoint
+from context_window import print_savings
+from instrumentation import print_profile
+from llm_backend import get_backend
+from speculation import SpeculativeTurns, print_speculation
+from transcript import Transcript
+from transcript_sink import TranscriptSink, print_transcript
 
 # Load API key from .env file for secure access to the OpenAI API
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+backend = get_backend()
 
 class Agent:
     def __init__(self, name, role, system_prompt):
@@ -20,51 +26,130 @@ class Agent:
         self.name = name
         self.role = role
         self.system_prompt = system_prompt
-        # Initialize with system prompt
-        self.messages = [{"role": "system", "content": system_prompt}]
+        # The agent's view of the conversation, created when it joins a transcript
+        self.transcript = None
+        self.context = None
 
-    def act(self):
+    def join(self, transcript):
         """
-        Generate a response from the agent based on its own conversation history.
+        Join a conversation. All agents share one append-only transcript; each agent
+        only keeps a view of it, which builds the agent's messages (its system prompt
+        followed by as much of the conversation as fits in its token budget) on demand.
         
-        :return: The generated response from the agent
+        :param transcript: The shared Transcript of the conversation
+        """
+        self.transcript = transcript
+        self.context = transcript.view_from_env(self.name, self.system_prompt, backend)
+
+    async def respond(self, round_num=None, messages=None):
         """
-        # Make the API call to generate a response
-        response = client.chat.completions.create(
+        Generate the agent's next line from its view of the conversation, without
+        adding it to the transcript yet.
+        
+        :param round_num: The round of the conversation, recorded with the call's span
+        :param messages: The messages to send, if already built from the view (see
+                         speculation.py); by default they are built now
+        :return: The ChatResponse
+        """
+        if messages is None:
+            messages = await self.context.amessages()
+        # Make the API call without blocking the event loop, so that other agents
+        # can generate at the same time (see speculation.py)
+        return await backend.acomplete(
             model="gpt-4o",
-            messages=self.messages
+            messages=messages,
+            meta={"agent": self.name, "round": round_num}
         )
+
+    def commit(self, response):
+        """
+        Add a response to the shared transcript, where every agent will see it.
         
+        :param response: A ChatResponse returned by respond()
+        :return: The cleaned up text of the response
+        """
         # Extract and clean up the response content
-        response_content = response.choices[0].message.content.strip()
+        response_content = response.content.strip()
         
         # Remove the agent's name if it appears at the start of the response
         if response_content.startswith(self.name):
             response_content = response_content[len(self.name):].strip(" :")
         
-        # Add the response to the agent's message history
-        self.messages.append({"role": "assistant", "content": response_content})
-        
+        self.transcript.append(self.name, response_content)
         return response_content
 
-def simulation_loop(agents, rounds):
-    for round_num in range(1, rounds + 1):
-        print(f"\nRound {round_num}:\n")
+    async def act(self, round_num=None):
+        """
+        Generate a response from the agent based on its own conversation history.
+        
+        :param round_num: The round of the conversation, recorded with the call's span
+        :return: The generated response from the agent
+        """
+        return self.commit(await self.respond(round_num))
+
+class Turn:
+    def __init__(self, agent, round_num):
+        """
+        An agent's turn in a given round, as SpeculativeTurns runs it.
         
-        for agent in agents:
-            # Each agent generates a response based on its own conversation history
-            response = agent.act()
-            
-            # Print the agent's response for this round
-            print(f"{agent.name}: {response}")
-            
-            # Share the response with all other agents by appending it to their history
-            for other_agent in agents:
-                if other_agent != agent:
-                    other_agent.messages.append(
-                        {"role": "assistant", 
-                         "content": f"{agent.name}: {response}"}
-                    )
+        :param agent: The Agent that speaks
+        :param round_num: The round of the turn
+        """
+        self.agent = agent
+        self.name = agent.name
+        self.context = agent.context
+        self.round_num = round_num
+
+    def respond(self, messages=None):
+        return self.agent.respond(self.round_num, messages)
+
+    def commit(self, response):
+        return self.agent.commit(response)
+
+def render_line(record):
+    """
+    Render a line of the conversation on the console (see transcript_sink.py).
+    """
+    line = f"{record['speaker']}: {record['text']}"
+    return f"\nRound {record['round']}:\n\n{line}" if record["index"] == 0 else line
+
+async def simulation_loop(agents, rounds, checkpoint=None, speculate=None, sink=None):
+    """
+    Let the agents take turns in a conversation.
+    
+    :param agents: A list of Agent objects
+    :param rounds: The number of rounds to run the simulation
+    :param checkpoint: An optional Checkpoint; every completed turn is recorded, and
+                       the turns it already holds are restored instead of run again
+    :param speculate: The number of next speakers that start generating before their
+                      turn (see speculation.py); by default LLM_SPECULATE, or none
+    :param sink: The TranscriptSink the lines are written to; by default one
+                 configured from the environment (see transcript_sink.py)
+    :return: The SpeculativeTurns that ran the conversation, with its report
+    """
+    # A single transcript is shared by all agents, so a response is stored only once
+    transcript = Transcript()
+    for agent in agents:
+        agent.join(transcript)
+
+    turns = SpeculativeTurns.from_env(transcript)
+    if speculate is not None:
+        turns.depth = speculate
+    if sink is None:
+        sink = TranscriptSink.from_env(render_line)
+
+    # The agents speak in the same order every round
+    order = [(f"round {round_num}: {agent.name}", Turn(agent, round_num))
+             for round_num in range(1, rounds + 1) for agent in agents]
+
+    async def write(index, response):
+        # Write each line as soon as its turn is done
+        await sink.emit(order[index][1].name, response, round=order[index][1].round_num,
+                        kind="line", index=index % len(agents))
+
+    async with sink:
+        await turns.run(order, checkpoint, on_turn=write)
+    return turns
 
 if __name__ == "__main__":
     # Define the system prompts for each president, shaping their identity
@@ -101,12 +186,24 @@ if __name__ == "__main__":
     # Store the agents in a list for easy iteration
     agents = [reagan, nixon, carter]
 
+    # With LLM_CHECKPOINT=conversation.ckpt every completed turn is saved, and with
+    # LLM_RESUME=1 an interrupted conversation continues where it stopped
+    checkpoint = Checkpoint.from_env()
+
     # Record the start time of the simulation for performance measurement
     start_time = time.time()
     
-    # Run the conversation simulation loop for the specified number of rounds
-    simulation_loop(agents, 2)
+    # Run the conversation simulation loop for the specified number of rounds. With
+    # LLM_SPECULATE=2 the next two speakers start before their turn, and only
+    # generate again if a line they missed addresses them
+    sink = TranscriptSink.from_env(render_line)
+    turns = asyncio.run(simulation_loop(agents, 2, checkpoint, sink=sink))
     
     # Record the end time and calculate the total execution time of the simulation
     end_time = time.time()
     print(f"Execution time: {end_time - start_time:.2f} seconds")
+    print_speculation(turns)
+    print_transcript(sink)
+    print_checkpoint(checkpoint)
+    print_savings(agents)
+    print_profile(backend)
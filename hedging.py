@@ -0,0 +1,217 @@
+"""
+Hedged and deadline-aware requests.
+
+LLM latencies have a long tail: most calls answer quickly, but a few take several
+times longer. When a debate turn blocks every turn after it, or a round waits for
+its slowest agent, those few calls decide how long the whole run takes. A
+HedgedBackend watches the latencies it observes, and when a call is slower than
+their 90th percentile it sends the same request a second time and keeps whichever
+answer arrives first. Only a small share of calls is hedged (max_ratio), and the
+extra requests and tokens are counted, so the price of the shorter tail is known.
+
+A deadline bounds the time a call may take in total (for a stream: until its first
+token). A call that misses it fails with a BackendError instead of stalling the run.
+
+Only asynchronous calls are hedged; synchronous calls are forwarded unchanged.
+"""
+import asyncio
+import contextlib
+import os
+import time
+from collections import deque
+
+from llm_backend import BackendError, BackendWrapper, estimate_tokens, find_wrapper
+
+
+class HedgedBackend(BackendWrapper):
+    def __init__(self, backend, quantile=0.9, min_samples=20, window=500, max_ratio=0.1,
+                 deadline=None, cancel=True):
+        """
+        Hedge slow calls and enforce deadlines.
+
+        :param backend: The backend to send requests to (usually a ScheduledBackend, so
+                        that duplicates respect the rate limits too)
+        :param quantile: Send a duplicate once a call is slower than this quantile of
+                         the observed latencies; None disables hedging
+        :param min_samples: How many latencies must be observed before hedging starts
+        :param window: How many recent latencies the quantile is computed from
+        :param max_ratio: The largest share of calls that may be hedged
+        :param deadline: The default number of seconds a call may take, or None;
+                         request.meta["deadline"] overrides it per call
+        :param cancel: Whether the slower of two hedged calls is cancelled; if False
+                       it runs to completion and its tokens count as extra spend
+        """
+        super().__init__(backend)
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.deadline = deadline
+        self.cancel = cancel
+        self.latencies = deque(maxlen=window)  # seconds until a complete response
+        self.first_tokens = deque(maxlen=window)  # seconds until the first chunk of a stream
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.deadline_misses = 0
+        self.extra_prompt_tokens = 0
+        self.extra_completion_tokens = 0
+        self._background = set()
+
+    def hedge_delay(self, samples):
+        """
+        Seconds after which a call is hedged, or None if it should not be.
+        """
+        if self.quantile is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[int(self.quantile * (len(ordered) - 1))]
+
+    def _timed(self, samples, call):
+        """
+        Wrap `call` so that its latency is recorded. A call that is cancelled because
+        the other one won records how long it ran, a lower bound of its latency, so
+        that the slow calls hedging cuts short still count in the quantile.
+        """
+        async def timed():
+            start = time.perf_counter()
+            try:
+                result = await call()
+            except asyncio.CancelledError:
+                samples.append(time.perf_counter() - start)
+                raise
+            samples.append(time.perf_counter() - start)
+            return result
+        return timed
+
+    async def _race(self, request, call, samples, discard):
+        """
+        Run `call`, start a second one if the first is slow, and return the result of
+        whichever succeeds first. `discard` disposes of the other one.
+        """
+        tasks = [asyncio.ensure_future(call())]
+        try:
+            delay = self.hedge_delay(samples)
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.hedged < self.max_ratio * self.calls:
+                    self.hedged += 1
+                    self.extra_prompt_tokens += sum(estimate_tokens(m["content"]) + 4
+                                                    for m in request.messages)
+                    tasks.append(asyncio.ensure_future(call()))
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # If both finished at once, prefer the original call
+                for task in sorted(done, key=tasks.index):
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is not tasks[0]:
+                        self.hedge_wins += 1
+                    for other in tasks:
+                        if other is not task and not (other.done() and other.exception()):
+                            discard(other)
+                    return task.result()
+            raise error
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def _with_deadline(self, request, coroutine):
+        deadline = request.meta.get("deadline", self.deadline)
+        if deadline is None:
+            return await coroutine
+        try:
+            return await asyncio.wait_for(coroutine, deadline)
+        except asyncio.TimeoutError:
+            self.deadline_misses += 1
+            raise BackendError(f"No response within the deadline of {deadline}s") from None
+
+    def _discard_response(self, task):
+        if self.cancel:
+            task.cancel()
+            return
+
+        def settle(task):
+            self._background.discard(task)
+            if not task.cancelled() and task.exception() is None:
+                self.extra_completion_tokens += task.result().usage.get("completion_tokens", 0)
+        # Keep a reference, so that the loser is not garbage collected while it runs
+        self._background.add(task)
+        task.add_done_callback(settle)
+
+    def _discard_stream(self, task):
+        # The slower stream is always closed; nobody would read the rest of it
+        if not task.done():
+            task.cancel()
+        else:
+            stream, _ = task.result()
+            closing = asyncio.ensure_future(stream.aclose())
+            self._background.add(closing)
+            closing.add_done_callback(self._background.discard)
+
+    async def asend(self, request):
+        self.calls += 1
+        call = self._timed(self.latencies, lambda: self.backend.asend(request))
+        return await self._with_deadline(
+            request, self._race(request, call, self.latencies, self._discard_response))
+
+    async def astream(self, request):
+        self.calls += 1
+
+        async def open_stream():
+            stream = self.backend.astream(request)
+            try:
+                return stream, await stream.__anext__()
+            except BaseException:
+                await stream.aclose()
+                raise
+
+        call = self._timed(self.first_tokens, open_stream)
+        stream, first = await self._with_deadline(
+            request, self._race(request, call, self.first_tokens, self._discard_stream))
+        async with contextlib.aclosing(stream):
+            yield first
+            async for chunk in stream:
+                yield chunk
+
+    def report(self):
+        """
+        A one-line summary of how often calls were hedged and what it cost.
+        """
+        share = self.hedged / self.calls if self.calls else 0.0
+        return (f"{self.hedged} of {self.calls} calls hedged ({share:.0%}), "
+                f"{self.hedge_wins} won by the duplicate, {self.deadline_misses} missed "
+                f"the deadline; extra spend ~{self.extra_prompt_tokens} prompt and "
+                f"{self.extra_completion_tokens} completion tokens")
+
+
+def hedge_from_env(backend):
+    """
+    Wrap `backend` in a HedgedBackend if LLM_HEDGE=1 or LLM_DEADLINE is set.
+
+    LLM_HEDGE_QUANTILE (default 0.9), LLM_HEDGE_MAX_RATIO (default 0.1) and
+    LLM_HEDGE_CANCEL (default 1) tune hedging; LLM_DEADLINE is the default deadline
+    of a call in seconds.
+    """
+    hedge = os.getenv("LLM_HEDGE", "0").lower() in ("1", "true", "yes")
+    deadline = os.getenv("LLM_DEADLINE")
+    if not hedge and not deadline:
+        return backend
+    return HedgedBackend(
+        backend,
+        quantile=float(os.getenv("LLM_HEDGE_QUANTILE", "0.9")) if hedge else None,
+        max_ratio=float(os.getenv("LLM_HEDGE_MAX_RATIO", "0.1")),
+        deadline=float(deadline) if deadline else None,
+        cancel=os.getenv("LLM_HEDGE_CANCEL", "1").lower() not in ("0", "false", "no"),
+    )
+
+
+def print_hedging(backend):
+    """
+    Print the hedging report of the HedgedBackend in `backend`'s chain, if there is one.
+    """
+    hedged = find_wrapper(backend, HedgedBackend)
+    if hedged is not None:
+        print(f"Hedging: {hedged.report()}")
@@ -0,0 +1,361 @@
+"""
+Per-call spans: where the wall time of a simulation goes.
+
+"Execution time: 41.3 seconds" does not say whether the time went to waiting for
+the rate limiter, to one slow call that everybody waited for, to turns that ran one
+after another although they could have overlapped, or to prompts that grow every
+round. With LLM_PROFILE=debate, every LLM call becomes a span that records the
+agent and round (from request.meta), when the call started and ended, how long it
+waited in the scheduler's queue, the network latency, the time to the first token,
+the prompt, completion and cached tokens, and the estimated cost. Spans are written
+to debate.spans.jsonl as they finish, and at the end to debate.chrome.json, a
+timeline that chrome://tracing and https://ui.perfetto.dev open, with one row per
+agent.
+
+The summary reconstructs the critical path from the timeline: starting from the call
+that finished last, it steps back to the call that finished most recently before the
+current one started, which is the call it most likely waited for. Per round, that
+shows how much of the round's wall time was spent in calls on the path, in their
+queue wait and in gaps between them (time in Python, or turns that waited on each
+other). Per agent, it shows how much of the run's critical path was theirs.
+"""
+import bisect
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from llm_backend import BackendWrapper, ChatResponse, estimate_tokens, find_wrapper
+
+# US dollars per million tokens: prompt, cached prompt and completion tokens
+PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+
+# The span of the call in progress, so that the scheduler can add its queue wait
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def estimate_cost(model, usage):
+    """
+    The estimated price of a call in US dollars, or 0.0 for a model without a price.
+    Dated model names (e.g., "gpt-4o-2024-08-06") use the price of their family.
+    """
+    family = max((name for name in PRICES if (model or "").startswith(name)), key=len, default=None)
+    if family is None:
+        return 0.0
+    prompt, cached, completion = PRICES[family]
+    cached_tokens = usage.get("cached_tokens", 0)
+    return (prompt * (usage.get("prompt_tokens", 0) - cached_tokens) + cached * cached_tokens
+            + completion * usage.get("completion_tokens", 0)) / 1e6
+
+
+def add_queue_wait(seconds):
+    """
+    Add time a call spent waiting for the scheduler to its span, if it has one.
+    """
+    span = _current_span.get()
+    if span is not None:
+        span.queue_wait += seconds
+
+
+class Span:
+    __slots__ = ("agent", "round", "model", "start", "end", "queue_wait", "time_to_first_token",
+                 "prompt_tokens", "completion_tokens", "cached_tokens", "cost", "status")
+
+    def __init__(self, request, start):
+        """
+        One LLM call. Times are in seconds since the profiler started.
+        """
+        self.agent = request.meta.get("agent", "")
+        self.round = request.meta.get("round")
+        self.model = request.model
+        self.start = start
+        self.end = None
+        self.queue_wait = 0.0
+        self.time_to_first_token = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        self.status = "ok"
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def latency(self):
+        """
+        The time the call spent outside the scheduler's queue.
+        """
+        return max(self.duration - self.queue_wait, 0.0)
+
+    def as_dict(self):
+        return {**{name: getattr(self, name) for name in self.__slots__},
+                "duration": self.duration, "latency": self.latency}
+
+
+class InstrumentedBackend(BackendWrapper):
+    def __init__(self, backend, prefix=None):
+        """
+        Record a Span for every call.
+
+        :param backend: The backend to send requests to
+        :param prefix: An optional prefix of output files: every span is appended to
+                       <prefix>.spans.jsonl as it ends, and print_profile() writes
+                       <prefix>.chrome.json
+        """
+        super().__init__(backend)
+        self.prefix = prefix
+        self.spans = []
+        self.origin = time.perf_counter()
+        self.file = open(f"{prefix}.spans.jsonl", "w", encoding="utf-8") if prefix else None
+        self.lock = threading.Lock()
+
+    def _begin(self, request):
+        span = Span(request, time.perf_counter() - self.origin)
+        return span, _current_span.set(span)
+
+    def _finish(self, span, response=None, text=None, request=None):
+        span.end = time.perf_counter() - self.origin
+        if response is not None:
+            usage = response.usage
+            if response.time_to_first_token is not None and span.time_to_first_token is None:
+                span.time_to_first_token = response.time_to_first_token
+            if response.cache_hit:
+                span.status = "cached"
+        elif text is not None:
+            # A stream closed by a stop predicate never reports its usage; estimate it
+            usage = {"prompt_tokens": sum(estimate_tokens(m["content"]) + 4 for m in request.messages),
+                     "completion_tokens": estimate_tokens(text)}
+            span.status = "stopped"
+        else:
+            usage = {}
+            span.status = "error"
+        span.prompt_tokens = usage.get("prompt_tokens", 0)
+        span.completion_tokens = usage.get("completion_tokens", 0)
+        span.cached_tokens = usage.get("cached_tokens", 0)
+        if span.status != "cached":
+            span.cost = estimate_cost(span.model, usage)
+        with self.lock:
+            self.spans.append(span)
+            if self.file is not None:
+                self.file.write(json.dumps(span.as_dict()) + "\n")
+                self.file.flush()
+
+    def send(self, request):
+        span, token = self._begin(request)
+        response = None
+        try:
+            response = self.backend.send(request)
+            return response
+        finally:
+            _current_span.reset(token)
+            self._finish(span, response)
+
+    async def asend(self, request):
+        span, token = self._begin(request)
+        response = None
+        try:
+            response = await self.backend.asend(request)
+            return response
+        finally:
+            _current_span.reset(token)
+            self._finish(span, response)
+
+    def _first_chunk(self, span):
+        # Like the backends' own measurement, from the moment the request was sent
+        if span.time_to_first_token is None:
+            span.time_to_first_token = (time.perf_counter() - self.origin - span.start
+                                        - span.queue_wait)
+
+    def stream(self, request):
+        previous = _current_span.get()
+        span, _ = self._begin(request)
+        text, response = "", None
+        try:
+            with contextlib.closing(self.backend.stream(request)) as chunks:
+                for chunk in chunks:
+                    if isinstance(chunk, ChatResponse):
+                        response = chunk
+                    else:
+                        self._first_chunk(span)
+                        text += chunk
+                    yield chunk
+        finally:
+            # A generator may be closed from another context, so restore the
+            # variable instead of resetting its token
+            _current_span.set(previous)
+            self._finish(span, response, text if text else None, request)
+
+    async def astream(self, request):
+        previous = _current_span.get()
+        span, _ = self._begin(request)
+        text, response = "", None
+        try:
+            async with contextlib.aclosing(self.backend.astream(request)) as chunks:
+                async for chunk in chunks:
+                    if isinstance(chunk, ChatResponse):
+                        response = chunk
+                    else:
+                        self._first_chunk(span)
+                        text += chunk
+                    yield chunk
+        finally:
+            _current_span.set(previous)
+            self._finish(span, response, text if text else None, request)
+
+    def export_jsonl(self, path):
+        """
+        Write every span as one JSON line.
+        """
+        with open(path, "w", encoding="utf-8") as file:
+            for span in self.spans:
+                file.write(json.dumps(span.as_dict()) + "\n")
+
+    def export_chrome_trace(self, path):
+        """
+        Write the spans in the Chrome trace event format (chrome://tracing, Perfetto):
+        one row per agent, with the queue wait drawn inside each call.
+        """
+        lanes = {}
+        events = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            lane = lanes.setdefault(span.agent, len(lanes) + 1)
+            label = f"round {span.round}" if span.round is not None else span.agent or "call"
+            events.append({"name": label, "cat": span.status, "ph": "X", "pid": 1, "tid": lane,
+                           "ts": span.start * 1e6, "dur": span.duration * 1e6,
+                           "args": span.as_dict()})
+            if span.queue_wait:
+                events.append({"name": "queue wait", "cat": "queue", "ph": "X", "pid": 1,
+                               "tid": lane, "ts": span.start * 1e6, "dur": span.queue_wait * 1e6})
+        for agent, lane in lanes.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": lane,
+                           "args": {"name": agent or "(unnamed)"}})
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+    def report(self):
+        """
+        Per-agent totals, and the critical path of every round and of the whole run.
+        """
+        return summary(self.spans)
+
+
+def critical_path(spans):
+    """
+    The chain of calls that set the wall time of `spans`, reconstructed from their
+    start and end times alone.
+
+    :return: The spans on the path, earliest first
+    """
+    ordered = sorted(spans, key=lambda s: s.end)
+    if not ordered:
+        return []
+    ends = [span.end for span in ordered]
+    path = [ordered[-1]]
+    while True:
+        # The call that finished most recently before this one started (within a
+        # millisecond, the time it takes Python to start the next turn)
+        index = bisect.bisect_right(ends, path[-1].start + 1e-3) - 1
+        if index < 0 or ordered[index] is path[-1] or ordered[index].end > path[-1].end:
+            return path[::-1]
+        path.append(ordered[index])
+
+
+def _path_line(label, spans):
+    path = critical_path(spans)
+    wall = max(s.end for s in spans) - min(s.start for s in spans)
+    queue = sum(s.queue_wait for s in path)
+    calls = sum(s.latency for s in path)
+    gaps = max(wall - queue - calls, 0.0)
+    slowest = max(spans, key=lambda s: s.duration)
+    durations = sorted(s.duration for s in spans)
+    median = durations[len(durations) // 2]
+    line = (f"{label:<10}{wall:>8.2f}{len(spans):>7}{len(path):>6}{calls:>9.2f}{queue:>8.2f}"
+            f"{gaps:>8.2f}{sum(s.prompt_tokens for s in spans) / len(spans):>9.0f}"
+            f"  {slowest.agent or '(unnamed)'} {slowest.duration:.2f}s")
+    if median and slowest.duration > 3 * median:
+        line += f" ({slowest.duration / median:.0f}x the median)"
+    return line, path
+
+
+def summary(spans, agents=10):
+    """
+    A text report of a list of spans; see the module docstring.
+
+    :param spans: The spans to summarize
+    :param agents: How many agents to list, those with the most time on the critical
+                   path (then the busiest) first
+    """
+    spans = [span for span in spans if span.end is not None]
+    if not spans:
+        return "No calls were recorded."
+    lines = [f"{len(spans)} calls, {sum(s.prompt_tokens for s in spans)} prompt "
+             f"({sum(s.cached_tokens for s in spans)} cached) and "
+             f"{sum(s.completion_tokens for s in spans)} completion tokens, "
+             f"~${sum(s.cost for s in spans):.4f}"]
+
+    lines.append(f"\n{'round':<10}{'wall s':>8}{'calls':>7}{'path':>6}{'calls s':>9}{'queue':>8}"
+                 f"{'gaps':>8}{'prompt':>9}  slowest call")
+    by_round = defaultdict(list)
+    for span in spans:
+        by_round[span.round].append(span)
+    if set(by_round) != {None}:
+        for round_num in sorted(by_round, key=lambda r: (r is None, r)):
+            label = str(round_num) if round_num is not None else "-"
+            lines.append(_path_line(label, by_round[round_num])[0])
+    line, path = _path_line("run", spans)
+    lines.append(line)
+
+    on_path = defaultdict(float)
+    for span in path:
+        on_path[span.agent] += span.duration
+    wall = max(s.end for s in spans) - min(s.start for s in spans)
+    lines.append(f"\n{'agent':<28}{'calls':>6}{'busy s':>8}{'queue s':>8}{'ttft s':>8}"
+                 f"{'prompt':>8}{'cost $':>9}{'on path':>9}")
+    by_agent = defaultdict(list)
+    for span in spans:
+        by_agent[span.agent].append(span)
+    ranked = sorted(by_agent.items(), key=lambda item: (-on_path[item[0]],
+                                                        -sum(s.duration for s in item[1])))
+    for agent, agent_spans in ranked[:agents]:
+        first_tokens = [s.time_to_first_token for s in agent_spans if s.time_to_first_token is not None]
+        ttft = f"{sum(first_tokens) / len(first_tokens):.2f}" if first_tokens else "-"
+        lines.append(f"{(agent or '(unnamed)')[:27]:<28}{len(agent_spans):>6}"
+                     f"{sum(s.duration for s in agent_spans):>8.2f}"
+                     f"{sum(s.queue_wait for s in agent_spans):>8.2f}{ttft:>8}"
+                     f"{sum(s.prompt_tokens for s in agent_spans) / len(agent_spans):>8.0f}"
+                     f"{sum(s.cost for s in agent_spans):>9.4f}{on_path[agent] / wall:>9.0%}")
+    if len(ranked) > agents:
+        lines.append(f"... and {len(ranked) - agents} more agents")
+    return "\n".join(lines)
+
+
+def instrument_from_env(backend):
+    """
+    Wrap `backend` in an InstrumentedBackend if LLM_PROFILE is set. Its value is the
+    prefix of the output files: <prefix>.spans.jsonl and <prefix>.chrome.json.
+    """
+    prefix = os.getenv("LLM_PROFILE")
+    return InstrumentedBackend(backend, prefix) if prefix else backend
+
+
+def print_profile(backend):
+    """
+    Print the summary of the InstrumentedBackend in `backend`'s chain, if there is
+    one, and write its Chrome trace.
+    """
+    instrumented = find_wrapper(backend, InstrumentedBackend)
+    if instrumented is None:
+        return
+    print(instrumented.report())
+    if instrumented.prefix:
+        instrumented.export_chrome_trace(f"{instrumented.prefix}.chrome.json")
+        print(f"Spans in {instrumented.prefix}.spans.jsonl, "
+              f"timeline in {instrumented.prefix}.chrome.json")
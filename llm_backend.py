@@ -0,0 +1,506 @@
+import contextlib
+import hashlib
+import json
+import math
+import os
+import time
+
+
+def estimate_tokens(text):
+    """
+    A rough token count: about four characters per token, as for English text.
+    """
+    return max(1, math.ceil(len(text) / 4))
+
+
+class BackendError(Exception):
+    """
+    An error returned by an LLM backend.
+
+    :param message: A human readable description of the failure
+    :param status: The HTTP-like status code of the failure (e.g., 500)
+    :param retryable: Whether repeating the same request may succeed
+    """
+
+    def __init__(self, message, status=None, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+class RateLimitError(BackendError):
+    """
+    The provider rejected the request because a rate limit was exceeded (HTTP 429).
+
+    :param retry_after: Seconds the provider asked us to wait, if it said so
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message, status=429, retryable=True)
+        self.retry_after = retry_after
+
+
+class ChatRequest:
+    def __init__(self, model, messages, params=None, meta=None):
+        """
+        A single chat completion request, independent of the backend that serves it.
+
+        :param model: The model name (e.g., "gpt-4o")
+        :param messages: The list of chat messages sent to the model
+        :param params: Sampling parameters passed to the API (e.g., temperature, max_tokens)
+        :param meta: Simulation metadata that is never sent to the API
+                     (e.g., {"agent": "Groucho Marx", "round": 2})
+        """
+        self.model = model
+        self.messages = messages
+        self.params = dict(params or {})
+        self.meta = dict(meta or {})
+
+    def payload(self):
+        """
+        Build the JSON body of the request as the OpenAI API expects it.
+        """
+        return {"model": self.model, "messages": self.messages, **self.params}
+
+    def key(self):
+        """
+        A content hash of everything that influences the model output.
+        Two requests with the same key are interchangeable.
+        """
+        canonical = json.dumps(self.payload(), sort_keys=True, separators=(",", ":"),
+                               ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ChatResponse:
+    def __init__(self, content, model=None, usage=None, latency=None, finish_reason="stop",
+                 cache_hit=False, time_to_first_token=None):
+        """
+        The result of a chat completion request.
+
+        :param content: The generated text
+        :param model: The model that actually produced the text
+        :param usage: Token counts: prompt_tokens, completion_tokens and cached_tokens
+        :param latency: Seconds spent waiting for the backend
+        :param finish_reason: Why the model stopped (e.g., "stop", "length")
+        :param cache_hit: True if the response was served from a local cache
+        :param time_to_first_token: Seconds until the first token arrived, for streamed responses
+        """
+        self.content = content
+        self.model = model
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+        self.usage.update(usage or {})
+        self.latency = latency
+        self.finish_reason = finish_reason
+        self.cache_hit = cache_hit
+        self.time_to_first_token = time_to_first_token
+
+
+class Backend:
+    """
+    Base class of every LLM backend.
+
+    Agents call complete() or acomplete() with the same keyword arguments they would
+    pass to client.chat.completions.create(). Subclasses implement send() and asend(),
+    which receive a ChatRequest and return a ChatResponse, and may implement stream()
+    and astream() to deliver the text as it is generated.
+    """
+
+    def complete(self, model, messages, meta=None, **params):
+        """
+        Synchronously generate a completion.
+
+        :param model: The model name (e.g., "gpt-4o")
+        :param messages: The list of chat messages
+        :param meta: Simulation metadata that is not sent to the API
+        :param params: Any other API parameters (e.g., temperature=0.8)
+        :return: A ChatResponse
+        """
+        return self.send(ChatRequest(model, messages, params, meta))
+
+    async def acomplete(self, model, messages, meta=None, **params):
+        """
+        Asynchronously generate a completion. Takes the same arguments as complete().
+        """
+        return await self.asend(ChatRequest(model, messages, params, meta))
+
+    def send(self, request):
+        raise NotImplementedError
+
+    async def asend(self, request):
+        raise NotImplementedError
+
+    def stream(self, request):
+        """
+        Generate a completion piece by piece. Yields the text deltas as str, followed by
+        the complete ChatResponse as the last item. Closing the generator early cancels
+        the request. Backends that cannot stream yield the whole text at once.
+        """
+        response = self.send(request)
+        yield response.content
+        yield response
+
+    async def astream(self, request):
+        """
+        The asynchronous counterpart of stream().
+        """
+        response = await self.asend(request)
+        yield response.content
+        yield response
+
+    async def submit_batch(self, path):
+        """
+        Submit a JSONL file of requests in the OpenAI Batch API format (see batch.py)
+        for asynchronous, discounted processing.
+
+        :param path: The JSONL file to submit
+        :return: The id of the batch
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support batches")
+
+    async def batch_status(self, batch_id):
+        """
+        The status of a batch: "validating", "in_progress", "finalizing", "completed",
+        "failed", "expired", "cancelling" or "cancelled".
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support batches")
+
+    async def batch_results(self, batch_id):
+        """
+        The results of a finished batch.
+
+        :return: A dict mapping the custom_id of each request to its ChatResponse,
+                 or to a BackendError if that request failed
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support batches")
+
+
+class BackendWrapper(Backend):
+    """
+    A backend that adds behaviour (rate limiting, caching, ...) around another backend.
+    By default every call is forwarded unchanged.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def send(self, request):
+        return self.backend.send(request)
+
+    async def asend(self, request):
+        return await self.backend.asend(request)
+
+    def stream(self, request):
+        with contextlib.closing(self.backend.stream(request)) as chunks:
+            yield from chunks
+
+    async def astream(self, request):
+        async with contextlib.aclosing(self.backend.astream(request)) as chunks:
+            async for chunk in chunks:
+                yield chunk
+
+    async def submit_batch(self, path):
+        return await self.backend.submit_batch(path)
+
+    async def batch_status(self, batch_id):
+        return await self.backend.batch_status(batch_id)
+
+    async def batch_results(self, batch_id):
+        return await self.backend.batch_results(batch_id)
+
+
+def find_wrapper(backend, cls):
+    """
+    The first backend of type `cls` in a chain of wrappers, or None.
+    """
+    while backend is not None:
+        if isinstance(backend, cls):
+            return backend
+        backend = getattr(backend, "backend", None)
+    return None
+
+
+class OpenAIBackend(Backend):
+    def __init__(self, api_key=None, base_url=None, max_retries=2, config=None):
+        """
+        Serve requests through the official OpenAI Python client. The clients come
+        from the process-wide registry in clients.py and are only created on the
+        first call, so creating the backend (and importing a script) costs nothing.
+
+        :param api_key: The API key; defaults to the OPENAI_API_KEY environment variable
+        :param base_url: An alternative endpoint, e.g. the local stub server
+        :param max_retries: How often the client itself retries a failed request
+        :param config: A clients.ClientConfig for the connection pool; defaults to
+                       one configured from the environment
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.config = config
+
+    @property
+    def client(self):
+        from clients import get_client
+
+        return get_client(self.api_key, self.base_url, self.max_retries, self.config)
+
+    @property
+    def async_client(self):
+        from clients import get_async_client
+
+        return get_async_client(self.api_key, self.base_url, self.max_retries, self.config)
+
+    def send(self, request):
+        start = time.perf_counter()
+        try:
+            response = self.client.chat.completions.create(**request.payload())
+        except Exception as error:
+            raise _translate_error(error) from error
+        return _to_chat_response(response, time.perf_counter() - start)
+
+    async def asend(self, request):
+        start = time.perf_counter()
+        try:
+            response = await self.async_client.chat.completions.create(**request.payload())
+        except Exception as error:
+            raise _translate_error(error) from error
+        return _to_chat_response(response, time.perf_counter() - start)
+
+
+    def _stream_payload(self, request):
+        return {**request.payload(), "stream": True, "stream_options": {"include_usage": True}}
+
+    def stream(self, request):
+        start = time.perf_counter()
+        state = _StreamState(request, start)
+        try:
+            with contextlib.closing(self.client.chat.completions.create(
+                    **self._stream_payload(request))) as chunks:
+                for chunk in chunks:
+                    delta = state.add(chunk)
+                    if delta:
+                        yield delta
+        except Exception as error:
+            raise _translate_error(error) from error
+        yield state.response()
+
+    async def astream(self, request):
+        start = time.perf_counter()
+        state = _StreamState(request, start)
+        try:
+            chunks = await self.async_client.chat.completions.create(
+                **self._stream_payload(request))
+            try:
+                async for chunk in chunks:
+                    delta = state.add(chunk)
+                    if delta:
+                        yield delta
+            finally:
+                # Closing the connection stops generation, so unread tokens are not billed
+                await chunks.close()
+        except Exception as error:
+            raise _translate_error(error) from error
+        yield state.response()
+
+
+    async def submit_batch(self, path):
+        try:
+            with open(path, "rb") as file:
+                uploaded = await self.async_client.files.create(file=file, purpose="batch")
+            batch = await self.async_client.batches.create(
+                input_file_id=uploaded.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+        except Exception as error:
+            raise _translate_error(error) from error
+        return batch.id
+
+    async def batch_status(self, batch_id):
+        try:
+            return (await self.async_client.batches.retrieve(batch_id)).status
+        except Exception as error:
+            raise _translate_error(error) from error
+
+    async def batch_results(self, batch_id):
+        results = {}
+        try:
+            batch = await self.async_client.batches.retrieve(batch_id)
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    content = await self.async_client.files.content(file_id)
+                    for line in content.text.splitlines():
+                        if line.strip():
+                            custom_id, result = _parse_batch_line(json.loads(line))
+                            results[custom_id] = result
+        except Exception as error:
+            raise _translate_error(error) from error
+        return results
+
+
+def _parse_batch_line(record):
+    """
+    Convert one line of a Batch API output file into (custom_id, ChatResponse or BackendError).
+    """
+    response = record.get("response") or {}
+    error = record.get("error")
+    if error or response.get("status_code") != 200:
+        message = (error or response.get("body", {}).get("error") or {}).get("message", "Batch request failed")
+        status = response.get("status_code")
+        return record["custom_id"], BackendError(message, status=status,
+                                                 retryable=status is None or status >= 500 or status == 429)
+    body = response["body"]
+    choice = body["choices"][0]
+    usage = body.get("usage") or {}
+    return record["custom_id"], ChatResponse(
+        choice["message"]["content"],
+        model=body.get("model"),
+        usage={
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        },
+        finish_reason=choice.get("finish_reason"),
+    )
+
+
+class _StreamState:
+    """
+    Accumulates the chunks of a streamed OpenAI completion.
+    """
+
+    def __init__(self, request, start):
+        self.request = request
+        self.start = start
+        self.first_token = None
+        self.parts = []
+        self.usage = {}
+        self.model = request.model
+        self.finish_reason = None
+
+    def add(self, chunk):
+        self.model = chunk.model or self.model
+        if chunk.usage is not None:
+            details = getattr(chunk.usage, "prompt_tokens_details", None)
+            self.usage = {"prompt_tokens": chunk.usage.prompt_tokens,
+                          "completion_tokens": chunk.usage.completion_tokens,
+                          "cached_tokens": getattr(details, "cached_tokens", 0) or 0}
+        if not chunk.choices:
+            return None
+        choice = chunk.choices[0]
+        self.finish_reason = choice.finish_reason or self.finish_reason
+        delta = choice.delta.content
+        if delta:
+            if self.first_token is None:
+                self.first_token = time.perf_counter() - self.start
+            self.parts.append(delta)
+        return delta
+
+    def response(self):
+        return ChatResponse("".join(self.parts), model=self.model, usage=self.usage,
+                            latency=time.perf_counter() - self.start,
+                            finish_reason=self.finish_reason,
+                            time_to_first_token=self.first_token)
+
+
+def _to_chat_response(response, latency):
+    """
+    Convert an OpenAI ChatCompletion object into a ChatResponse.
+    """
+    choice = response.choices[0]
+    usage = {}
+    if response.usage is not None:
+        usage["prompt_tokens"] = response.usage.prompt_tokens
+        usage["completion_tokens"] = response.usage.completion_tokens
+        details = getattr(response.usage, "prompt_tokens_details", None)
+        usage["cached_tokens"] = getattr(details, "cached_tokens", 0) or 0
+    return ChatResponse(choice.message.content, model=response.model, usage=usage,
+                        latency=latency, finish_reason=choice.finish_reason)
+
+
+def _translate_error(error):
+    """
+    Map exceptions raised by the OpenAI client onto BackendError, so that callers
+    do not need to know which backend they are talking to.
+    """
+    import openai
+
+    if isinstance(error, openai.RateLimitError):
+        retry_after = error.response.headers.get("retry-after") if error.response else None
+        return RateLimitError(str(error), float(retry_after) if retry_after else None)
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return BackendError(str(error), retryable=True)
+    if isinstance(error, openai.APIStatusError):
+        return BackendError(str(error), status=error.status_code,
+                            retryable=error.status_code >= 500)
+    return error
+
+
+def create_base_backend():
+    """
+    Create the backend selected by the LLM_BACKEND environment variable.
+
+    LLM_BACKEND=openai (the default) talks to the OpenAI API, or to OPENAI_BASE_URL if set.
+    LLM_BACKEND=stub answers locally with simulated latency and costs nothing;
+    see stub_server.py for the STUB_* variables that shape its behaviour.
+    """
+    name = os.getenv("LLM_BACKEND", "openai").lower()
+    if name == "openai":
+        # Retries are handled by the scheduler, which backs off for all callers at once
+        return OpenAIBackend(base_url=os.getenv("OPENAI_BASE_URL"), max_retries=0)
+    if name == "stub":
+        from stub_server import StubBackend, StubConfig
+
+        return StubBackend(StubConfig.from_env())
+    raise ValueError(f"Unknown LLM_BACKEND: {name!r} (expected 'openai' or 'stub')")
+
+
+def get_backend(base=None):
+    """
+    Build the backend used by the simulation scripts.
+
+    :param base: The backend that serves the requests; defaults to create_base_backend()
+    :return: `base` wrapped in a ScheduledBackend configured from the LLM_RPM, LLM_TPM,
+             LLM_MAX_IN_FLIGHT and LLM_MAX_RETRIES environment variables, in a
+             HedgedBackend if LLM_HEDGE or LLM_DEADLINE is set (see hedging.py), and
+             in a response cache if LLM_CACHE is set (see response_cache.py), and in
+             a PromptCacheMeter that counts provider prompt-cache hits (see
+             prompt_layout.py). LLM_PROFILE records a span for every call (see
+             instrumentation.py). LLM_RECORD records every exchange to a trace file,
+             and LLM_REPLAY answers from one instead of `base`, without the response
+             cache (see trace_replay.py).
+             LLM_ROUTES sends each role to its own model (see routing.py)
+    :raises ValueError: If LLM_BATCH is combined with LLM_CACHE or LLM_RECORD, whose
+                        wrappers batch results would bypass (see batch.py)
+    """
+    from batch import batch_from_env
+    from hedging import hedge_from_env
+    from instrumentation import instrument_from_env
+    from prompt_layout import PromptCacheMeter
+    from response_cache import CachedBackend, cache_from_env
+    from routing import route_from_env
+    from scheduler import ScheduledBackend, Scheduler
+    from trace_replay import RecordingBackend, record_from_env, replay_from_env
+
+    replay = replay_from_env()
+    backend = replay
+    if backend is None:
+        backend = base if base is not None else create_base_backend()
+    backend = ScheduledBackend(backend, Scheduler.from_env())
+    # Duplicates of slow calls go through the scheduler like any other call
+    backend = hedge_from_env(backend)
+    # Cache hits are answered before the scheduler, so they never wait for rate limits.
+    # A replayed trace already holds the answers the cache gave while recording; a
+    # cache in front of it would change which requests reach the trace
+    if replay is None:
+        backend = cache_from_env(backend)
+    backend = PromptCacheMeter(backend)
+    # Spans cover everything the agent waits for: cache, queue, retries and hedging
+    backend = instrument_from_env(backend)
+    # The trace records what the agents saw
+    backend = record_from_env(backend)
+    if batch_from_env() and (find_wrapper(backend, CachedBackend) or find_wrapper(backend, RecordingBackend)):
+        raise ValueError("LLM_BATCH cannot be combined with LLM_CACHE or LLM_RECORD: batch results "
+                         "would be neither cached nor recorded")
+    # Every model a cascade tries is recorded, so that a routed run can be replayed
+    return route_from_env(backend)
@@ -0,0 +1,204 @@
+"""
+Large, compact audiences built from persona templates.
+
+An audience of hand-written agents costs one full system prompt and one growing
+message history per agent, which is fine for three groups and impossible for ten
+thousand voters. A Population stores each voter as a handful of small integer codes
+in typed arrays: which persona template it belongs to and one code per attribute
+(age group, region, ...). A voter's system prompt is the template's text, which is
+interned once and shared by every voter of the template, followed by a short
+sentence describing the attributes. Prompts are only built when a voter is asked,
+and each distinct combination is built once.
+
+Asking every voter every round would cost one API call per voter. sample() draws a
+stratified sample instead: every stratum (by default, every template) gets a share
+of the calls proportional to its size, and each sampled voter carries a weight equal
+to the number of voters it stands for, so that tally() estimates the result for the
+whole population.
+"""
+import random
+import sys
+from array import array
+
+
+class PersonaTemplate:
+    def __init__(self, name, prompt, share=1.0):
+        """
+        A kind of voter.
+
+        :param name: The name of the group (e.g., "Independents")
+        :param prompt: The system prompt shared by all voters of this group
+        :param share: The relative size of the group in the population
+        """
+        self.name = sys.intern(name)
+        self.prompt = sys.intern(prompt)
+        self.share = share
+
+
+# Attributes that vary within a template, with the sentence that describes each value
+ATTRIBUTES = {
+    "age": ("You are 18 to 29 years old.", "You are 30 to 44 years old.",
+            "You are 45 to 64 years old.", "You are 65 or older."),
+    "region": ("You live in the Northeast.", "You live in the Midwest.",
+               "You live in the South.", "You live in the West."),
+    "engagement": ("You follow politics closely.", "You only follow politics casually."),
+}
+
+
+class Voter:
+    __slots__ = ("population", "index")
+
+    def __init__(self, population, index):
+        """
+        A lightweight handle on one voter; the data itself lives in the population.
+        """
+        self.population = population
+        self.index = index
+
+    @property
+    def segment(self):
+        return self.population.segments[self.index]
+
+    @property
+    def template(self):
+        return self.population.templates[self.segment]
+
+    @property
+    def name(self):
+        return f"{self.template.name} #{self.index}"
+
+    def attribute(self, name):
+        """
+        The code of one attribute, e.g. voter.attribute("region") == 1 for the Midwest.
+        """
+        return self.population.columns[name][self.index]
+
+    @property
+    def system_prompt(self):
+        return self.population.prompt(self.index)
+
+
+class Population:
+    def __init__(self, templates, attributes=ATTRIBUTES):
+        """
+        An empty population. Use generate() to fill it.
+
+        :param templates: The PersonaTemplates voters are drawn from
+        :param attributes: A dict mapping each attribute name to the sentences that
+                           describe its values (at most 256 values each)
+        """
+        self.templates = list(templates)
+        self.attributes = dict(attributes)
+        self.segments = array("B")  # voter -> template index
+        self.columns = {name: array("B") for name in self.attributes}  # voter -> value code
+        self.prompts = {}  # (template, codes...) -> interned system prompt
+        self._strata = {}  # by -> (population size, strata)
+
+    @classmethod
+    def generate(cls, templates, size, attributes=ATTRIBUTES, seed=None):
+        """
+        Create `size` voters. Templates are drawn according to their share and
+        attribute values uniformly at random. Without a seed, the seed is drawn from
+        the global random generator, so that seeding it makes the population
+        reproducible.
+        """
+        population = cls(templates, attributes)
+        rng = random.Random(seed if seed is not None else random.getrandbits(64))
+        shares = [template.share for template in population.templates]
+        population.segments.extend(rng.choices(range(len(shares)), weights=shares, k=size))
+        for name, values in population.attributes.items():
+            population.columns[name].extend(rng.choices(range(len(values)), k=size))
+        return population
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __getitem__(self, index):
+        return Voter(self, index)
+
+    def nbytes(self):
+        """
+        The memory used by the per-voter data.
+        """
+        arrays = [self.segments] + list(self.columns.values())
+        return sum(column.itemsize * len(column) for column in arrays)
+
+    def prompt(self, index):
+        """
+        The system prompt of a voter: the shared template prompt plus a description
+        of its attributes. Each distinct combination is built and interned once.
+        """
+        key = (self.segments[index],) + tuple(column[index] for column in self.columns.values())
+        prompt = self.prompts.get(key)
+        if prompt is None:
+            details = " ".join(values[code] for values, code
+                               in zip(self.attributes.values(), key[1:]))
+            prompt = sys.intern(f"{self.templates[key[0]].prompt} {details}")
+            self.prompts[key] = prompt
+        return prompt
+
+    def strata(self, by=("segment",)):
+        """
+        Group voter indexes by the values of `by` ("segment" and/or attribute names).
+        The grouping takes a pass over every voter, so it is done once per `by` and
+        kept until the population grows; do not modify the returned arrays.
+
+        :return: A dict mapping each stratum's key to an array of voter indexes
+        """
+        by = tuple(by)
+        size, strata = self._strata.get(by, (None, None))
+        if size == len(self):
+            return strata
+        columns = [self.segments if name == "segment" else self.columns[name] for name in by]
+        strata = {}
+        for index in range(len(self)):
+            key = tuple(column[index] for column in columns)
+            if key not in strata:
+                strata[key] = array("I")
+            strata[key].append(index)
+        self._strata[by] = (len(self), strata)
+        return strata
+
+    def sample(self, size, by=("segment",), rng=random):
+        """
+        Draw a stratified sample of about `size` voters. Calls are allocated to strata
+        in proportion to their size, with at least one per stratum, so small groups
+        are always heard.
+
+        :return: A list of (Voter, weight) pairs; the weights add up to len(self)
+        """
+        strata = self.strata(by)
+        if size >= len(self):
+            return [(self[index], 1.0) for members in strata.values() for index in members]
+        # Largest remainder allocation, with one call per stratum to start with
+        counts = {key: 1 for key in strata}
+        remaining = max(size - len(strata), 0)
+        quotas = {key: remaining * (len(members) - 1) / max(len(self) - len(strata), 1)
+                  for key, members in strata.items()}
+        for key in strata:
+            counts[key] += int(quotas[key])
+        leftover = remaining - sum(int(quota) for quota in quotas.values())
+        for key in sorted(strata, key=lambda k: quotas[k] - int(quotas[k]), reverse=True)[:leftover]:
+            counts[key] += 1
+
+        sample = []
+        for key, members in strata.items():
+            chosen = rng.sample(range(len(members)), min(counts[key], len(members)))
+            weight = len(members) / len(chosen)
+            sample.extend((self[members[i]], weight) for i in chosen)
+        return sample
+
+
+def tally(votes):
+    """
+    Estimate how the whole population votes from a weighted sample.
+
+    :param votes: (choice, weight) pairs, e.g. ("Kamala Harris", 833.3); a choice
+                  of None counts as undecided
+    :return: A dict mapping each choice to its estimated share of the population
+    """
+    totals = {}
+    for choice, weight in votes:
+        totals[choice] = totals.get(choice, 0.0) + weight
+    total = sum(totals.values())
+    return {choice: weight / total for choice, weight in totals.items()} if total else {}
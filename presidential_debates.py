@@ -1,141 +1,342 @@
-import os
 import asyncio
 import random
 import time
-from openai import AsyncOpenAI
 from dotenv import load_dotenv
+from checkpoint import Checkpoint, print_checkpoint
+from context_window import ContextWindow, print_savings
+from hedging import print_hedging
+from instrumentation import print_profile
+from llm_backend import get_backend
+from population import PersonaTemplate, Population, tally
+from prompt_layout import assemble, print_prompt_cache
+from routing import print_routing
+from scheduler import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL
+from streaming import astream_completion, stop_after_sentences
+from transcript_sink import TranscriptSink, print_transcript
+from turn_graph import TurnGraph
+from verdicts import INSTRUCTIONS, VerdictTable, format_verdict
 
 # Load API key from the .env file for secure access to the OpenAI API
 load_dotenv()
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+backend = get_backend()
 
 class Agent:
-    def __init__(self, name, role, system_prompt):
+    def __init__(self, name, role, system_prompt, priority=PRIORITY_NORMAL, route=None):
         """
         Initialize an Agent with a name, role, and system prompt.
         
         :param name: The name of the agent (e.g., "Donald Trump")
         :param role: The agent's role or identity (e.g., "former President")
         :param system_prompt: The system prompt that defines the agent's behavior
+        :param priority: The scheduling priority of the agent's API calls; when the
+                         rate limit is tight, PRIORITY_HIGH calls go first
+        :param route: The role that picks the model of the agent's API calls (e.g.,
+                      "moderator"; see routing.py); by default they use gpt-4o
         """
         self.name = name
         self.role = role
-        self.messages = [{"role": "system", "content": system_prompt}]  # Initialize with system prompt
+        self.priority = priority
+        self.route = route
+        # The agent's memory starts with the system prompt. Only the most recent turns
+        # that fit in a token budget are sent to the model, so long debates do not get
+        # slower and more expensive with every round.
+        self.context = ContextWindow.from_env(system_prompt, backend)
     
-    async def act(self, additional_message):
+    async def act(self, additional_message, stop=None, round_num=None):
         """
         Generate a response from the agent based on the additional message and 
         update the agent's message history.
         
         :param additional_message: The new message or prompt to which the agent 
                                    will respond
+        :param stop: Stop predicates that end the response early (see streaming.py)
+        :param round_num: The round of the debate, recorded with the call's span
         :return: The generated response from the agent
         """
         # Add the new user message to the agent's message history
-        self.messages.append({"role": "user", "content": additional_message})
+        self.context.append("user", additional_message)
         
-        # Make an asynchronous API call to generate a response
-        response = await client.chat.completions.create(
+        # Stream the response; a stop predicate closes the stream early, so the
+        # tokens after it are never generated
+        response = await astream_completion(
+            backend,
+            stop=stop,
             model="gpt-4o",
-            messages=self.messages
+            messages=await self.context.amessages(),
+            meta={"agent": self.name, "round": round_num, "priority": self.priority,
+                  "role": self.route}
         )
         
         # Append the generated response to the agent's message history
-        self.messages.append({"role": "assistant", 
-                              "content": response.choices[0].message.content})
+        self.context.append("assistant", response.content)
         
         # Return the generated response content
-        return response.choices[0].message.content
+        return response.content
 
-async def simulation_loop(candidate1, candidate2, moderator, audience, rounds):
+# "Short and crisp" candidate answers are cut after this many sentences
+CANDIDATE_SENTENCES = 4
+
+# The audience is a population of voters; only a stratified sample is asked each
+# round, and their votes are weighted back to the whole population
+AUDIENCE_SIZE = 10_000
+AUDIENCE_SAMPLE = 12
+AUDIENCE_SENTENCES = 2
+
+# Every voter's request starts with the same system prompt and the same transcript of
+# the round, and only then says who the voter is, so that the provider can serve the
+# long shared prefix from its prompt cache (see prompt_layout.py)
+AUDIENCE_SYSTEM = ("You are a member of the audience of a televised presidential debate. "
+                   "You will read a round of the debate, be told who you are, and say "
+                   "who won the round from your point of view.")
+AUDIENCE_QUESTION = "Who do you think won this round and why? Start with the winner's name."
+
+
+def ask(agent, prompt, stop=None, round_num=None):
+    """
+    Create a debate turn in which `agent` responds to a prompt.
+
+    :param agent: The agent that speaks
+    :param prompt: A function that builds the prompt from the results of the turns
+                   this turn depends on
+    :param stop: Stop predicates that end the response early
+    :param round_num: The round the turn belongs to
+    """
+    async def turn(inputs):
+        return (await agent.act(prompt(inputs), stop=stop, round_num=round_num)).strip()
+    return turn
+
+
+def react(voter, weight, prompt, candidates, round_num, verdicts=None):
+    """
+    Create a turn in which a voter of the audience reacts to the round. Voters keep
+    no history, so the request is just the round and who the voter is.
+
+    :param voter: The sampled Voter
+    :param weight: The number of voters this one stands for
+    :param prompt: A function that builds the transcript of the round from its turns
+    :param candidates: The two candidate agents
+    :param round_num: The round, for the VerdictTable
+    :param verdicts: An optional VerdictTable; if given, the voter answers in JSON
+    :return: A turn whose result is the tuple (text to print, name of the winner or None)
+    """
+    async def turn(inputs):
+        params = {"stop": [stop_after_sentences(AUDIENCE_SENTENCES)]}
+        # The voter's persona comes last: it is the only part that differs between voters
+        question = f"{voter.system_prompt}\n{AUDIENCE_QUESTION}"
+        if verdicts is not None:
+            # A JSON verdict must not be cut short
+            params = {"response_format": verdicts.response_format()}
+            question = f"{question}\n{INSTRUCTIONS}"
+        response = await astream_completion(
+            backend,
+            model="gpt-4o",
+            messages=assemble(AUDIENCE_SYSTEM, [prompt(inputs)], question),
+            # A voter must name one of the candidates; with LLM_ROUTES a small model
+            # answers first, and the big one only if it does not (see routing.py)
+            meta={"agent": voter.name, "round": round_num, "priority": PRIORITY_LOW,
+                  "role": "audience", "choices": [candidate.name for candidate in candidates]},
+            **params
+        )
+        text = response.content.strip()
+        if verdicts is None:
+            return text, vote(text, candidates)
+        verdict = verdicts.add(round_num, text, segment=voter.segment, weight=weight)
+        return (format_verdict(verdict), verdict["winner"]) if verdict else (text, None)
+    return turn
+
+
+def render_debate(record):
+    """
+    Render a record of the debate's transcript on the console (see transcript_sink.py).
+    """
+    kind, line = record["kind"], f"{record['speaker']}: {record['text']}"
+    if kind == "question":
+        return f"\nRound {record['round']}:\n\n{line}"
+    if kind in ("answer", "rebuttal"):
+        return f"\n{record['cue']}\n{line}"
+    if kind == "reaction":
+        return ("\nAudience Decisions:\n\n" if record["index"] == 0 else "") + line + "\n"
+    return f"Estimated result among {record['voters']:,} voters: {record['text']}\n\n"
+
+
+def vote(reaction, candidates):
+    """
+    The candidate a reaction names first (by surname), or None if it names neither.
+    """
+    positions = [(reaction.find(candidate.name.split()[-1]), candidate.name)
+                 for candidate in candidates]
+    found = [(position, name) for position, name in positions if position != -1]
+    return min(found)[1] if found else None
+
+
+async def simulation_loop(candidate1, candidate2, moderator, audience, rounds,
+                          sample_size=AUDIENCE_SAMPLE, verdicts=None, checkpoint=None, sink=None):
     """
     Simulate a debate between two candidates, moderated by a third agent, and 
     observed by an audience of agents.
+
+    The debate is declared as a graph of turns, each listing the turns it depends on.
+    Turns that do not depend on each other overlap: the moderator prepares the next
+    question and the audience reacts to a round while the candidates already debate
+    the next one.
     
     :param candidate1: The first candidate agent participating in the debate
     :param candidate2: The second candidate agent participating in the debate
     :param moderator: The moderator agent guiding the debate
-    :param audience: A list of audience agents reacting to the debate
+    :param audience: A Population of voters reacting to the debate
     :param rounds: The number of rounds to run the simulation
+    :param sample_size: How many voters are asked each round
+    :param verdicts: An optional VerdictTable; if given, voters answer in JSON and
+                     every verdict is recorded in it
+    :param checkpoint: An optional Checkpoint; every completed turn is recorded, and
+                       the turns it already holds are restored instead of run again
+    :param sink: The TranscriptSink the rounds are written to; by default one
+                 configured from the environment (see transcript_sink.py)
+    :return: The executed TurnGraph, which can report the critical path
     """
+    if sink is None:
+        sink = TranscriptSink.from_env(render_debate)
+    graph = TurnGraph(checkpoint)
+    question = None  # the previous round's question turn
+    last_turn = None  # the previous round's last candidate turn
+    previous_report = None
+
     for round_num in range(1, rounds + 1):
-        print(f"\nRound {round_num}:\n")
-        
-        # The moderator generates a new debate question
-        question = await moderator.act("Create a new debate question.")
-        print(f"{moderator.name}: {question.strip()}")
+        def name(step):
+            return f"round {round_num}: {step}"
+
+        # The moderator generates a new debate question; it only depends on the
+        # moderator's own previous question
+        question = graph.add(name("question"),
+                             ask(moderator, lambda inputs: "Create a new debate question.",
+                                 round_num=round_num),
+                             deps=[question] if question else [], state=[moderator.context])
 
         # Randomly choose which candidate answers first
         first_candidate = random.choice([candidate1, candidate2])
         second_candidate = candidate2 if first_candidate == candidate1 else candidate1
+        # Both candidates must have finished the previous round before answering
+        turn_deps = [question] + ([last_turn] if last_turn else [])
 
         # The first candidate responds to the question
-        print(f"\n{moderator.name}: {first_candidate.name}, you are the first to answer.")
-        first_response = await first_candidate.act(
-            f"{moderator.name}: {question.strip()}\n"
-            "Please give a short and crisp answer."
-        )
-        print(f"{first_candidate.name}: {first_response.strip()}")
+        first = graph.add(name("first answer"), ask(
+            first_candidate,
+            lambda inputs, q=question: f"{moderator.name}: {inputs[q]}\n"
+                                       "Please give a short and crisp answer.",
+            stop=[stop_after_sentences(CANDIDATE_SENTENCES)], round_num=round_num
+        ), deps=turn_deps, state=[first_candidate.context])
 
         # The second candidate responds, considering the first candidate's answer
-        print(f"\n{moderator.name}: {second_candidate.name}, your response.")
-        second_response = await second_candidate.act(
-            f"{moderator.name}: {question.strip()}\n"
-            f"{first_candidate.name} answered: {first_response.strip()}\n"
-            "Now it's your turn. Please keep it short and crisp."
-        )
-        print(f"{second_candidate.name}: {second_response.strip()}")
+        second = graph.add(name("second answer"), ask(
+            second_candidate,
+            lambda inputs, q=question, a=first, c=first_candidate:
+                f"{moderator.name}: {inputs[q]}\n"
+                f"{c.name} answered: {inputs[a]}\n"
+                "Now it's your turn. Please keep it short and crisp.",
+            stop=[stop_after_sentences(CANDIDATE_SENTENCES)], round_num=round_num
+        ), deps=[question, first], state=[second_candidate.context])
 
         # Two rounds of back and forth between the candidates
-        for _ in range(2):  
-            # The first candidate rebuts the second candidate's response
-            print(f"\n{moderator.name}: {first_candidate.name}, your rebuttal.")
-            back_and_forth_response_1 = await first_candidate.act(
-                f"{second_candidate.name} said: {second_response.strip()}\n"
-                "Respond to their points. Please keep it short and crisp."
-            )
-            print(f"{first_candidate.name}: {back_and_forth_response_1.strip()}")
-
+        rebuttals = []
+        previous = second
+        for exchange in range(2):
+            # The first candidate rebuts the second candidate's latest response
+            rebuttal_1 = graph.add(name(f"rebuttal {exchange + 1} by first"), ask(
+                first_candidate,
+                lambda inputs, p=previous, c=second_candidate:
+                    f"{c.name} said: {inputs[p]}\n"
+                    "Respond to their points. Please keep it short and crisp.",
+                stop=[stop_after_sentences(CANDIDATE_SENTENCES)], round_num=round_num
+            ), deps=[previous], state=[first_candidate.context])
             # The second candidate rebuts the first candidate's rebuttal
-            print(f"\n{moderator.name}: {second_candidate.name}, your rebuttal.")
-            back_and_forth_response_2 = await second_candidate.act(
-                f"{first_candidate.name} said: {back_and_forth_response_1.strip()}\n"
-                "Respond to their points. Please keep it short and crisp."
+            rebuttal_2 = graph.add(name(f"rebuttal {exchange + 1} by second"), ask(
+                second_candidate,
+                lambda inputs, p=rebuttal_1, c=first_candidate:
+                    f"{c.name} said: {inputs[p]}\n"
+                    "Respond to their points. Please keep it short and crisp.",
+                stop=[stop_after_sentences(CANDIDATE_SENTENCES)], round_num=round_num
+            ), deps=[rebuttal_1], state=[second_candidate.context])
+            rebuttals += [rebuttal_1, rebuttal_2]
+            previous = rebuttal_2
+        last_turn = previous
+
+        # A stratified sample of the audience reacts to the entire round, including
+        # the initial responses and rebuttals. Reactions are concurrent; the backend's
+        # scheduler keeps the number of requests in flight within the rate limit.
+        def audience_context(inputs, first=first, rebuttals=rebuttals,
+                             first_candidate=first_candidate, second_candidate=second_candidate):
+            return (
+                f"Here are the responses from the candidates:\n"
+                f"{first_candidate.name}: {inputs[first]}\n"
+                f"{second_candidate.name}: {inputs[rebuttals[1]]}\n"
+                f"{first_candidate.name}: {inputs[rebuttals[2]]}\n"
+                f"{second_candidate.name}: {inputs[rebuttals[3]]}"
             )
-            print(f"{second_candidate.name}: {back_and_forth_response_2.strip()}")
-
-            # Update the context for the next round of back and forth
-            second_response = back_and_forth_response_2
-
-        # Audience reacts to the entire round, including the initial responses 
-        # and rebuttals
-        audience_context = (
-            f"Here are the responses from the candidates:\n"
-            f"{first_candidate.name}: {first_response.strip()}\n"
-            f"{second_candidate.name}: {second_response.strip()}\n"
-            f"{first_candidate.name}: {back_and_forth_response_1.strip()}\n"
-            f"{second_candidate.name}: {back_and_forth_response_2.strip()}\n"
-            "Who do you think won this round and why?"
-        )
-        
-        # Collect responses from all audience members concurrently
-        audience_responses = await asyncio.gather(
-            *[aud.act(audience_context) for aud in audience]
+
+        round_turns = [first, second] + rebuttals
+        sample = audience.sample(sample_size, rng=random)
+        reactions = [graph.add(name(f"reaction of {voter.name}"),
+                               react(voter, weight, audience_context,
+                                     [first_candidate, second_candidate], round_num, verdicts),
+                               deps=[first] + rebuttals,
+                               state=[verdicts] if verdicts is not None else [])
+                     for voter, weight in sample]
+
+        async def report(inputs, round_num=round_num, question=question, round_turns=round_turns,
+                         sample=sample, reactions=reactions, first_candidate=first_candidate,
+                         second_candidate=second_candidate):
+            # Write the whole round once it is complete, in debate order
+            first, second, *rebuttals = (inputs[turn] for turn in round_turns)
+            await sink.emit(moderator.name, inputs[question], round=round_num, kind="question")
+            await sink.emit(first_candidate.name, first, round=round_num, kind="answer",
+                            cue=f"{moderator.name}: {first_candidate.name}, you are the first to answer.")
+            await sink.emit(second_candidate.name, second, round=round_num, kind="answer",
+                            cue=f"{moderator.name}: {second_candidate.name}, your response.")
+            for rebuttal_1, rebuttal_2 in zip(rebuttals[::2], rebuttals[1::2]):
+                await sink.emit(first_candidate.name, rebuttal_1, round=round_num, kind="rebuttal",
+                                cue=f"{moderator.name}: {first_candidate.name}, your rebuttal.")
+                await sink.emit(second_candidate.name, rebuttal_2, round=round_num, kind="rebuttal",
+                                cue=f"{moderator.name}: {second_candidate.name}, your rebuttal.")
+
+            # The audience decisions, then the estimate for the whole population
+            votes = []
+            for index, ((voter, weight), reaction) in enumerate(zip(sample, reactions)):
+                text, choice = inputs[reaction]
+                await sink.emit(voter.name, text, round=round_num, kind="reaction", index=index,
+                                segment=voter.segment, weight=weight, winner=choice)
+                votes.append((choice, weight))
+            shares = tally(votes)
+            await sink.emit("Audience", ", ".join(
+                f"{choice or 'Undecided'} {share:.0%}"
+                for choice, share in sorted(shares.items(), key=lambda item: -item[1])),
+                round=round_num, kind="result", voters=len(audience), shares=shares)
+
+        # Rounds are printed in order, after the previous round's report
+        previous_report = graph.add(
+            name("report"), report,
+            deps=[question] + round_turns + reactions + ([previous_report] if previous_report else []),
+            # A resumed run prints the restored rounds again
+            checkpoint=False
         )
-        
-        # Display audience decisions
-        print("\nAudience Decisions:\n")
-        for aud, response in zip(audience, audience_responses):
-            print(f"{aud.name}: {response.strip()}\n")
-        print("\n")
+
+    # The rounds go to the transcript sink, which writes them in the background
+    async with sink:
+        await graph.run()
+    return graph
 
 if __name__ == "__main__":
+    # With LLM_CHECKPOINT=debate.ckpt every completed turn is saved, and with
+    # LLM_RESUME=1 an interrupted debate continues where it stopped. The checkpoint
+    # is opened first, so that the audience is generated from the same random state.
+    checkpoint = Checkpoint.from_env()
+
     # Define the first candidate as Donald Trump with his specific characteristics
     candidate1 = Agent(
         "Donald Trump", 
         "former President known for his bold statements and unique rhetoric", 
         "You are Donald Trump, the former President known for your bold statements, "
-        "unique rhetoric, and unfiltered personality. Be true to all aspects of your character."
+        "unique rhetoric, and unfiltered personality. Be true to all aspects of your character.",
+        priority=PRIORITY_HIGH
     )
     
     # Define the second candidate as Kamala Harris with her specific characteristics
@@ -143,7 +344,8 @@ if __name__ == "__main__":
         "Kamala Harris", 
         "Vice President known for her articulate and sharp responses", 
         "You are Kamala Harris, the Vice President known for your articulate and sharp "
-        "responses, compassion, and firm stances. Be true to all aspects of your character."
+        "responses, compassion, and firm stances. Be true to all aspects of your character.",
+        priority=PRIORITY_HIGH
     )
     
     # Define the moderator as Bret Baier, known for fair and balanced moderation
@@ -151,43 +353,64 @@ if __name__ == "__main__":
         "Bret Baier", 
         "Fox News anchor known for his fair and balanced moderation",
         "You are Bret Baier, a Fox News anchor known for your fair and balanced moderation. "
-        "When asked to create a new debate question, simply ask the question without any preamble or introductory phrases."
+        "When asked to create a new debate question, simply ask the question without any preamble or introductory phrases.",
+        # The moderator only asks the questions, a low-stakes turn for a smaller model
+        priority=PRIORITY_HIGH, route="moderator"
     )
     
-    # Define the audience as three distinct groups with different ideological leanings
-    audience = [
-        Agent(
-            "Liberal Democrats", 
-            "a group of progressives advocating for social justice",
-            "You are a group of progressives who prioritize social justice, equality, "
+    # Define the audience as a population drawn from three distinct groups with
+    # different ideological leanings; each voter also has an age, region and
+    # engagement level
+    audience = Population.generate([
+        PersonaTemplate(
+            "Liberal Democrats",
+            "You are a progressive voter who prioritizes social justice, equality, "
             "and inclusive policies. You advocate for a fairer society and believe in "
             "the power of government to address systemic issues. React passionately to "
             "the candidates' responses."
         ),
-        Agent(
-            "Conservatives", 
-            "a group of conservatives who uphold traditional values",
-            "You are a group of conservatives who uphold traditional values, personal "
+        PersonaTemplate(
+            "Conservatives",
+            "You are a conservative voter who upholds traditional values, personal "
             "responsibility, and a strong adherence to the Constitution. You believe in "
             "limited government, free markets, and the importance of preserving the "
             "nation's foundational principles. React strongly to the candidates' responses."
         ),
-        Agent(
-            "Independents", 
-            "a group of independent voters seeking pragmatic solutions",
-            "You are a group of independent voters who value pragmatism, balanced "
+        PersonaTemplate(
+            "Independents",
+            "You are an independent voter who values pragmatism, balanced "
             "perspectives, and clear, actionable plans. You are not ideologically bound "
             "and seek practical solutions that work for the majority of people. React "
             "thoughtfully to the candidates' responses."
         )
-    ]
+    ], AUDIENCE_SIZE)
+    print(f"Audience: {len(audience):,} voters in {audience.nbytes():,} bytes")
+
+    # With LLM_VERDICTS=json, voters answer with structured verdicts that are
+    # aggregated per template and round
+    verdicts = VerdictTable.from_env([candidate1.name, candidate2.name],
+                                     segments=[template.name for template in audience.templates])
 
     # Measure the start time of the simulation
     start_time = time.time()
     
     # Run the simulation loop asynchronously
-    asyncio.run(simulation_loop(candidate1, candidate2, moderator, audience, 2))
+    # With LLM_TRANSCRIPT=debate.jsonl (or .parquet) every line is also saved for
+    # analysis, and LLM_TRANSCRIPT_CONSOLE=0 keeps large runs off the console
+    sink = TranscriptSink.from_env(render_debate)
+    graph = asyncio.run(simulation_loop(candidate1, candidate2, moderator, audience, 2,
+                                        verdicts=verdicts, checkpoint=checkpoint, sink=sink))
     
     # Measure and display the total execution time
     end_time = time.time()
     print(f"Execution time: {end_time - start_time:.2f} seconds")
+    print(graph.report())
+    print_transcript(sink)
+    print_checkpoint(checkpoint)
+    print_savings([candidate1, candidate2, moderator])
+    print_hedging(backend)
+    print_prompt_cache(backend)
+    print_routing(backend)
+    print_profile(backend)
+    if verdicts is not None:
+        print(verdicts.summary())
@@ -0,0 +1,135 @@
+"""
+Prompt layout for provider-side prefix caching.
+
+Providers cache the longest prompt prefix they have seen recently (for OpenAI, from
+1024 tokens on). Cached tokens are cheaper and the answer starts sooner, but only
+if the prefix is byte-identical: a persona, a round number or a timestamp near the
+start of the prompt makes every prefix unique. assemble() builds a message list in
+a fixed order, from the content shared by the most calls to the content of this one
+call, so that calls share the longest possible prefix:
+
+1. the system prompt that every caller of this kind shares,
+2. shared context, e.g. the transcript of the round every voter reacts to, and
+3. the volatile part: who this caller is and what it should do now.
+
+A PromptCacheMeter adds up the prompt and cached tokens the backend reports, per
+agent, to show the hit ratio.
+"""
+import contextlib
+from collections import defaultdict
+
+from llm_backend import BackendWrapper, ChatResponse, find_wrapper
+
+
+def assemble(system, shared=(), volatile=None):
+    """
+    Build a message list with the stable content first and the volatile content last.
+
+    :param system: The system prompt; keep it identical for all calls that should
+                   share a prefix
+    :param shared: Texts shared with other calls, most widely shared first; each
+                   becomes a user message
+    :param volatile: The text specific to this call, sent as the last user message
+    :return: The list of messages
+    """
+    messages = [{"role": "system", "content": system}]
+    messages.extend({"role": "user", "content": text} for text in shared)
+    if volatile:
+        messages.append({"role": "user", "content": volatile})
+    return messages
+
+
+class PromptCacheMeter(BackendWrapper):
+    """
+    A backend wrapper that records the prompt and cached tokens of every response,
+    per agent (request.meta["agent"]). Streams that are closed early (e.g., by a stop
+    predicate) report no usage, so they are only counted as stopped, and the report
+    says how many calls the hit ratio leaves out. Responses from the local response
+    cache are not counted.
+    """
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.prompt_tokens = defaultdict(int)
+        self.cached_tokens = defaultdict(int)
+        self.requests = defaultdict(int)
+        self.stopped = defaultdict(int)
+
+    def _count(self, request, response):
+        if response.cache_hit or not response.usage.get("prompt_tokens"):
+            return response
+        agent = request.meta.get("agent", "")
+        self.requests[agent] += 1
+        self.prompt_tokens[agent] += response.usage["prompt_tokens"]
+        self.cached_tokens[agent] += response.usage.get("cached_tokens", 0)
+        return response
+
+    def send(self, request):
+        return self._count(request, self.backend.send(request))
+
+    async def asend(self, request):
+        return self._count(request, await self.backend.asend(request))
+
+    def _stopped(self, request):
+        self.stopped[request.meta.get("agent", "")] += 1
+
+    def stream(self, request):
+        complete = False
+        try:
+            with contextlib.closing(self.backend.stream(request)) as chunks:
+                for chunk in chunks:
+                    if isinstance(chunk, ChatResponse):
+                        self._count(request, chunk)
+                        complete = True
+                    yield chunk
+        except GeneratorExit:
+            if not complete:
+                self._stopped(request)
+            raise
+
+    async def astream(self, request):
+        complete = False
+        try:
+            async with contextlib.aclosing(self.backend.astream(request)) as chunks:
+                async for chunk in chunks:
+                    if isinstance(chunk, ChatResponse):
+                        self._count(request, chunk)
+                        complete = True
+                    yield chunk
+        except GeneratorExit:
+            if not complete:
+                self._stopped(request)
+            raise
+
+    def hit_ratio(self):
+        """
+        The share of all counted prompt tokens that were served from the prefix cache.
+        """
+        prompt = sum(self.prompt_tokens.values())
+        return sum(self.cached_tokens.values()) / prompt if prompt else 0.0
+
+    def report(self, agents=5):
+        """
+        The hit ratio overall, and for the `agents` agents that sent the most prompt
+        tokens, one line each.
+        """
+        lines = [f"Prompt cache: {sum(self.cached_tokens.values())} of "
+                 f"{sum(self.prompt_tokens.values())} prompt tokens cached ({self.hit_ratio():.0%}) "
+                 f"over {sum(self.requests.values())} requests"]
+        if self.stopped:
+            lines[0] += (f"; {sum(self.stopped.values())} streams closed early report no usage "
+                         f"and are not included")
+        for agent in sorted(self.prompt_tokens, key=self.prompt_tokens.get, reverse=True)[:agents]:
+            stopped = f" ({self.stopped[agent]} stopped streams not included)" if self.stopped[agent] else ""
+            lines.append(f"  {agent or '(unnamed)'}: {self.cached_tokens[agent]} of "
+                         f"{self.prompt_tokens[agent]} cached over {self.requests[agent]} requests{stopped}")
+        return "\n".join(lines)
+
+
+def print_prompt_cache(backend):
+    """
+    Print the report of the PromptCacheMeter in `backend`'s chain, if there is one.
+    """
+    meter = find_wrapper(backend, PromptCacheMeter)
+    if meter is not None:
+        print(meter.report())
@@ -0,0 +1,331 @@
+"""
+An opt-in, content-addressed cache of model responses.
+
+The comedian scripts send the very same request every round, and scenarios are rerun
+many times during development. CachedBackend keys every request on a hash of its full
+payload (model, messages and sampling parameters) and keeps responses in two tiers:
+
+* MemoryCache - a bounded LRU inside the process, and
+* DiskCache - a SQLite file that survives between runs, with TTL and size eviction.
+
+With variants=1 a cached response is returned as is. With variants=N the first N
+calls for a request go to the model and later calls pick one of the N stored answers
+at random, so runs with temperature > 0 keep some diversity.
+"""
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from llm_backend import BackendError, BackendWrapper, ChatResponse, estimate_tokens
+
+
+def _to_entry(response):
+    return {"content": response.content, "model": response.model, "usage": response.usage,
+            "finish_reason": response.finish_reason}
+
+
+def _from_entry(entry):
+    return ChatResponse(entry["content"], model=entry["model"], usage=entry["usage"],
+                        latency=0.0, finish_reason=entry["finish_reason"], cache_hit=True)
+
+
+class MemoryCache:
+    def __init__(self, max_entries=10000):
+        """
+        A least-recently-used map from request key to the list of cached variants.
+
+        :param max_entries: How many request keys are kept before the oldest is dropped
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        variants = self.entries.get(key)
+        if variants is not None:
+            self.entries.move_to_end(key)
+        return variants
+
+    def put(self, key, variants):
+        self.entries[key] = variants
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class DiskCache:
+    def __init__(self, path, ttl=None, max_bytes=256 * 1024 * 1024):
+        """
+        A persistent cache stored in a SQLite database.
+
+        :param path: The database file; its directory is created if needed
+        :param ttl: Seconds after which an entry expires, or None to keep entries forever
+        :param max_bytes: When the stored responses exceed this size, the least recently
+                          used ones are deleted
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT, variant INTEGER, created REAL, used REAL, size INTEGER, data TEXT,"
+            " PRIMARY KEY (key, variant))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            if self.ttl is not None:
+                self._delete("WHERE key = ? AND created < ?", (key, now - self.ttl))
+            rows = self.db.execute(
+                "SELECT data FROM responses WHERE key = ? ORDER BY variant", (key,)
+            ).fetchall()
+            if not rows:
+                return None
+            self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+        return [json.loads(data) for (data,) in rows]
+
+    def add(self, key, variant, entry):
+        data = json.dumps(entry, ensure_ascii=False)
+        now = time.time()
+        with self.lock:
+            # A variant may replace one that was cut short (see CachedBackend._store)
+            self._delete("WHERE key = ? AND variant = ?", (key, variant))
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, variant, now, now, len(data), data),
+            )
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _delete(self, where, args):
+        freed = self.db.execute(f"SELECT COALESCE(SUM(size), 0) FROM responses {where}",
+                                args).fetchone()[0]
+        if freed:
+            self.db.execute(f"DELETE FROM responses {where}", args)
+            self.size -= freed
+
+    def _evict(self):
+        """
+        Delete least recently used entries until the cache is 10% below its size limit.
+        """
+        target = self.max_bytes * 0.9
+        rows = self.db.execute("SELECT key, variant, size FROM responses ORDER BY used")
+        doomed = []
+        size = self.size
+        for key, variant, entry_size in rows:
+            if size <= target:
+                break
+            doomed.append((key, variant))
+            size -= entry_size
+        self.db.executemany("DELETE FROM responses WHERE key = ? AND variant = ?", doomed)
+        self.size = size
+
+
+class CachedBackend(BackendWrapper):
+    def __init__(self, backend, memory=None, disk=None, variants=1, seed=None):
+        """
+        Serve repeated requests from a cache instead of the model.
+
+        :param backend: The backend that serves cache misses
+        :param memory: A MemoryCache; defaults to a new one
+        :param disk: An optional DiskCache shared between runs
+        :param variants: How many different answers are collected per request before
+                         the cache starts answering; 1 reuses a single answer
+        :param seed: Seed for picking among cached variants
+        """
+        super().__init__(backend)
+        self.memory = memory if memory is not None else MemoryCache()
+        self.disk = disk
+        self.variants = variants
+        self.random = random.Random(seed)
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}
+
+    def _lookup(self, key):
+        variants = self.memory.get(key)
+        if variants is None and self.disk is not None:
+            variants = self.disk.get(key)
+            if variants is not None:
+                self.memory.put(key, variants)
+        return variants or []
+
+    def _store(self, key, response):
+        variants = self._lookup(key)
+        entry = _to_entry(response)
+        if len(variants) < self.variants:
+            index = len(variants)
+        else:
+            # A complete answer replaces one that a stop predicate cut short
+            stopped = [i for i, variant in enumerate(variants) if variant["finish_reason"] == "stopped"]
+            if not stopped or entry["finish_reason"] == "stopped":
+                return
+            index = stopped[0]
+        self.memory.put(key, variants[:index] + [entry] + variants[index + 1:])
+        if self.disk is not None:
+            self.disk.add(key, index, entry)
+
+    def _hit(self, key):
+        # Text that was cut short is never served as a complete answer
+        variants = [variant for variant in self._lookup(key) if variant["finish_reason"] != "stopped"]
+        if len(variants) < self.variants:
+            return None
+        self.hits += 1
+        return _from_entry(self.random.choice(variants))
+
+    def _stopped_key(self, key, request):
+        # Streams cut by stop predicates are kept apart from complete answers, per
+        # set of predicates (see streaming.with_stop)
+        stop = request.meta.get("stop")
+        return f"{key}:stop={','.join(stop)}" if stop else None
+
+    def _stream_hit(self, key, request):
+        """
+        A complete answer, which any caller can cut, or else a stream that was cut
+        short by the same stop predicates as this caller's.
+        """
+        cached = self._hit(key)
+        stopped_key = self._stopped_key(key, request)
+        if cached is not None or stopped_key is None:
+            return cached
+        variants = self._lookup(stopped_key)
+        if len(variants) < self.variants:
+            return None
+        self.hits += 1
+        return _from_entry(self.random.choice(variants))
+
+    def _store_stopped(self, key, request, text):
+        """
+        Cache a stream that its stop predicates closed early. The text received so far
+        is what the same predicates will cut again from the cached answer. Streams
+        closed for any other reason, or by unnamed predicates, are not cached.
+        """
+        stopped_key = self._stopped_key(key, request)
+        if text and stopped_key is not None:
+            usage = {"prompt_tokens": sum(estimate_tokens(m["content"]) + 4 for m in request.messages),
+                     "completion_tokens": estimate_tokens(text)}
+            self._store(stopped_key, ChatResponse(text, model=request.model, usage=usage,
+                                                  finish_reason="stopped"))
+
+    def send(self, request):
+        key = request.key()
+        cached = self._hit(key)
+        if cached is not None:
+            return cached
+        self.misses += 1
+        response = self.backend.send(request)
+        self._store(key, response)
+        return response
+
+    async def asend(self, request):
+        key = request.key()
+        cached = self._hit(key)
+        if cached is not None:
+            return cached
+        if self.variants == 1 and key in self._pending:
+            # The same request is already on its way to the model; share its answer
+            self.hits += 1
+            return await asyncio.shield(self._pending[key])
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        if self.variants == 1:
+            self._pending[key] = future
+        try:
+            response = await self.backend.asend(request)
+            self._store(key, response)
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.set_exception(BackendError("The shared request was cancelled", retryable=True))
+            future.exception()  # Mark as retrieved when nobody else is waiting
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            future.exception()
+            raise
+        finally:
+            self._pending.pop(key, None)
+
+
+    def stream(self, request):
+        key = request.key()
+        cached = self._stream_hit(key, request)
+        if cached is not None:
+            yield cached.content
+            yield cached
+            return
+        self.misses += 1
+        text, complete = "", False
+        try:
+            with contextlib.closing(self.backend.stream(request)) as chunks:
+                for chunk in chunks:
+                    if isinstance(chunk, ChatResponse):
+                        self._store(key, chunk)
+                        complete = True
+                    else:
+                        text += chunk
+                    yield chunk
+        except GeneratorExit:
+            if not complete:
+                self._store_stopped(key, request, text)
+            raise
+
+    async def astream(self, request):
+        key = request.key()
+        cached = self._stream_hit(key, request)
+        if cached is not None:
+            yield cached.content
+            yield cached
+            return
+        self.misses += 1
+        text, complete = "", False
+        try:
+            async with contextlib.aclosing(self.backend.astream(request)) as chunks:
+                async for chunk in chunks:
+                    if isinstance(chunk, ChatResponse):
+                        self._store(key, chunk)
+                        complete = True
+                    else:
+                        text += chunk
+                    yield chunk
+        except GeneratorExit:
+            if not complete:
+                self._store_stopped(key, request, text)
+            raise
+
+
+def cache_from_env(backend):
+    """
+    Wrap `backend` in a CachedBackend if LLM_CACHE is "memory" or "disk".
+
+    LLM_CACHE_DIR (default .llm_cache), LLM_CACHE_TTL (seconds), LLM_CACHE_MAX_MB and
+    LLM_CACHE_VARIANTS tune the cache. Returns `backend` unchanged if caching is off.
+    """
+    mode = os.getenv("LLM_CACHE", "off").lower()
+    if mode in ("", "off", "0", "false"):
+        return backend
+    if mode not in ("memory", "disk"):
+        raise ValueError(f"Unknown LLM_CACHE: {mode!r} (expected 'off', 'memory' or 'disk')")
+    disk = None
+    if mode == "disk":
+        ttl = os.getenv("LLM_CACHE_TTL")
+        disk = DiskCache(
+            os.path.join(os.getenv("LLM_CACHE_DIR", ".llm_cache"), "responses.sqlite"),
+            ttl=float(ttl) if ttl else None,
+            max_bytes=int(float(os.getenv("LLM_CACHE_MAX_MB", "256")) * 1024 * 1024),
+        )
+    return CachedBackend(backend, disk=disk, variants=int(os.getenv("LLM_CACHE_VARIANTS", "1")))
@@ -0,0 +1,311 @@
+"""
+Route each role to the model it needs, and escalate only when the answer is not good enough.
+
+Every call used to go to gpt-4o, although an audience member naming the winner of a
+round or a jury picking the best joke is a small task that a small model answers in
+a fraction of the time and for about a fifteenth of the price. A ModelRouter picks
+the model from the role in request.meta["role"]:
+
+    LLM_ROUTES="audience=gpt-4o-mini>gpt-4o,jury=gpt-4o-mini>gpt-4o,moderator=gpt-4o-mini"
+
+A single model replaces the requested one. A chain separated by ">" is a cascade:
+the first model answers, and if the answer fails a check, the request is sent again
+to the next one. The check uses request.meta["choices"], the names the answer must
+choose from (e.g., the candidates): a free-text answer must name one of them, and a
+JSON verdict must be valid and at least LLM_CASCADE_CONFIDENCE (default 0.6)
+confident. Requests without choices only need a non-empty answer.
+
+`python routing.py evaluate debate.trace --cheap gpt-4o-mini` measures what a cascade
+would save on a run recorded with the big model: it asks the cheap model every
+routed request of the trace and compares cost, latency and answers with the
+recorded ones.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+from llm_backend import BackendWrapper, ChatRequest, ChatResponse, find_wrapper
+from instrumentation import estimate_cost
+
+
+def parse_routes(text):
+    """
+    Parse "role=model,role=cheap>big" into {"role": ["model"], "role": ["cheap", "big"]}.
+    """
+    routes = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        role, _, models = item.partition("=")
+        routes[role.strip()] = [model.strip() for model in models.split(">") if model.strip()]
+    return routes
+
+
+def _json_answer(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`").removeprefix("json").strip()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def choice_of(text, choices):
+    """
+    The choice an answer makes: the "winner" of a JSON verdict, or else the choice a
+    free-text answer names first (by full name or last word of the name), or None.
+    """
+    data = _json_answer(text)
+    if data is not None:
+        return data.get("winner") if data.get("winner") in choices else None
+    found = []
+    for choice in choices:
+        positions = [text.find(name) for name in (choice, choice.split()[-1])]
+        positions = [position for position in positions if position != -1]
+        if positions:
+            found.append((min(positions), choice))
+    return min(found)[1] if found else None
+
+
+def accept(text, meta, min_confidence=0.6):
+    """
+    Whether an answer is good enough to keep, judged by request.meta["choices"].
+    """
+    choices = meta.get("choices")
+    if not choices:
+        return bool(text.strip())
+    if choice_of(text, choices) is None:
+        return False
+    data = _json_answer(text)
+    if data is None:
+        return True
+    try:
+        return float(data.get("confidence", 1.0)) >= min_confidence
+    except (TypeError, ValueError):
+        return False
+
+
+def _role(request):
+    return request.meta.get("role") or ""
+
+
+class ModelRouter(BackendWrapper):
+    def __init__(self, backend, routes, min_confidence=0.6):
+        """
+        Send each request to the model of its role.
+
+        :param backend: The backend to send requests to
+        :param routes: A dict mapping roles to a list of models; with more than one,
+                       they are tried in order until an answer passes accept()
+        :param min_confidence: The confidence a JSON verdict needs to be kept
+        """
+        super().__init__(backend)
+        self.routes = routes
+        self.min_confidence = min_confidence
+        self.stats = defaultdict(lambda: {"calls": 0, "escalated": 0, "cost": 0.0,
+                                          "seconds": 0.0, "models": defaultdict(int)})
+
+    def _models(self, request):
+        return self.routes.get(_role(request)) or [request.model]
+
+    def _attempt(self, request, model):
+        return ChatRequest(model, request.messages, request.params, request.meta)
+
+    def _count(self, request, model, response, seconds, escalated):
+        stats = self.stats[_role(request)]
+        stats["models"][model] += 1
+        stats["cost"] += estimate_cost(model, response.usage)
+        stats["seconds"] += seconds
+        stats["escalated"] += escalated
+
+    def _cascade(self, request, response, model, models, seconds):
+        """
+        Count an answer, and decide whether it is kept (True) or escalated (False).
+        """
+        last = model == models[-1]
+        kept = last or accept(response.content, request.meta, self.min_confidence)
+        self._count(request, model, response, seconds, not kept)
+        return kept
+
+    def send(self, request):
+        models = self._models(request)
+        self.stats[_role(request)]["calls"] += 1
+        for model in models:
+            start = time.perf_counter()
+            response = self.backend.send(self._attempt(request, model))
+            if self._cascade(request, response, model, models, time.perf_counter() - start):
+                return response
+
+    async def asend(self, request):
+        models = self._models(request)
+        self.stats[_role(request)]["calls"] += 1
+        for model in models:
+            start = time.perf_counter()
+            response = await self.backend.asend(self._attempt(request, model))
+            if self._cascade(request, response, model, models, time.perf_counter() - start):
+                return response
+
+    def stream(self, request):
+        # The cheaper models of a cascade answer in full, so that their answer can be
+        # checked before anything is shown; only the last model is streamed
+        models = self._models(request)
+        self.stats[_role(request)]["calls"] += 1
+        for model in models[:-1]:
+            start = time.perf_counter()
+            response = self.backend.send(self._attempt(request, model))
+            if self._cascade(request, response, model, models, time.perf_counter() - start):
+                yield response.content
+                yield response
+                return
+        start = time.perf_counter()
+        with contextlib.closing(self.backend.stream(self._attempt(request, models[-1]))) as chunks:
+            for chunk in chunks:
+                if isinstance(chunk, ChatResponse):
+                    self._count(request, models[-1], chunk, time.perf_counter() - start, False)
+                yield chunk
+
+    async def astream(self, request):
+        models = self._models(request)
+        self.stats[_role(request)]["calls"] += 1
+        for model in models[:-1]:
+            start = time.perf_counter()
+            response = await self.backend.asend(self._attempt(request, model))
+            if self._cascade(request, response, model, models, time.perf_counter() - start):
+                yield response.content
+                yield response
+                return
+        start = time.perf_counter()
+        # Closing this stream (e.g., by a stop predicate) closes the wrapped one at once
+        async with contextlib.aclosing(self.backend.astream(self._attempt(request, models[-1]))) as chunks:
+            async for chunk in chunks:
+                if isinstance(chunk, ChatResponse):
+                    self._count(request, models[-1], chunk, time.perf_counter() - start, False)
+                yield chunk
+
+    def report(self):
+        """
+        Calls, escalations and spend per routed role.
+        """
+        lines = []
+        for role, stats in sorted(self.stats.items()):
+            if role not in self.routes:
+                continue
+            models = ", ".join(f"{model} {count}" for model, count in stats["models"].items())
+            share = stats["escalated"] / stats["calls"] if stats["calls"] else 0.0
+            lines.append(f"  {role}: {stats['calls']} calls, {stats['escalated']} escalated "
+                         f"({share:.0%}); {models}; ~${stats['cost']:.4f}")
+        return "Routing:\n" + "\n".join(lines) if lines else "Routing: no routed calls"
+
+
+def route_from_env(backend):
+    """
+    Wrap `backend` in a ModelRouter if LLM_ROUTES is set (see the module docstring).
+    """
+    routes = parse_routes(os.getenv("LLM_ROUTES", ""))
+    if not routes:
+        return backend
+    return ModelRouter(backend, routes,
+                       min_confidence=float(os.getenv("LLM_CASCADE_CONFIDENCE", "0.6")))
+
+
+def print_routing(backend):
+    """
+    Print the report of the ModelRouter in `backend`'s chain, if there is one.
+    """
+    router = find_wrapper(backend, ModelRouter)
+    if router is not None:
+        print(router.report())
+
+
+async def evaluate(trace, cheap, backend, roles=None, min_confidence=0.6, concurrency=8):
+    """
+    Replay the routed requests of a recorded run against a cheaper model.
+
+    :param trace: A trace recorded with LLM_RECORD (see trace_replay.py)
+    :param cheap: The model that would answer first
+    :param backend: The backend that serves the cheap model
+    :param roles: The roles to evaluate; by default every role in the trace
+    :return: A dict mapping each role to its totals
+    """
+    records = []
+    with open(trace, encoding="utf-8") as file:
+        file.readline()
+        for line in file:
+            record = json.loads(line)
+            role = record["meta"].get("role")
+            if role and (roles is None or role in roles):
+                records.append(record)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    totals = defaultdict(lambda: defaultdict(float))
+
+    async def compare(record):
+        payload = dict(record["request"])
+        messages = payload.pop("messages")
+        big_model = payload.pop("model")
+        meta = record["meta"]
+        request = ChatRequest(cheap, messages, payload, meta)
+        async with semaphore:
+            start = time.perf_counter()
+            response = await backend.asend(request)
+            seconds = time.perf_counter() - start
+        big = record["response"]
+        big_cost = estimate_cost(big_model, big["usage"])
+        cheap_cost = estimate_cost(cheap, response.usage)
+        kept = accept(response.content, meta, min_confidence)
+        choices = meta.get("choices") or []
+        big_choice = choice_of(big["content"], choices) if choices else None
+        cheap_choice = choice_of(response.content, choices) if choices else None
+        role = totals[meta["role"]]
+        role["requests"] += 1
+        role["escalated"] += not kept
+        role["big_cost"] += big_cost
+        role["cascade_cost"] += cheap_cost + (0.0 if kept else big_cost)
+        role["big_seconds"] += record["latency"]
+        role["cascade_seconds"] += seconds + (0.0 if kept else record["latency"])
+        if big_choice is not None:
+            role["compared"] += 1
+            role["cheap_agree"] += cheap_choice == big_choice
+            # An escalated request ends with the big model's answer
+            role["cascade_agree"] += (cheap_choice if kept else big_choice) == big_choice
+
+    await asyncio.gather(*(compare(record) for record in records))
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate model routing on recorded runs")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("evaluate", help="compare a cascade with a recorded run")
+    run.add_argument("trace", help="a trace recorded with LLM_RECORD, using the big model")
+    run.add_argument("--cheap", default="gpt-4o-mini", help="the model that answers first")
+    run.add_argument("--roles", help="comma separated roles; by default all of them")
+    run.add_argument("--min-confidence", type=float, default=0.6)
+    args = parser.parse_args(argv)
+
+    from llm_backend import get_backend
+    # The recorded requests go to the live (or stub) model, not to a replay
+    os.environ.pop("LLM_REPLAY", None)
+    os.environ.pop("LLM_ROUTES", None)
+    totals = asyncio.run(evaluate(args.trace, args.cheap, get_backend(),
+                                  args.roles.split(",") if args.roles else None,
+                                  args.min_confidence))
+    print(f"{'role':<12}{'requests':>9}{'escalated':>10}{'cost big $':>11}{'cascade $':>11}"
+          f"{'saved':>7}{'time big s':>11}{'cascade s':>10}{'agree cheap':>12}{'agree cascade':>14}")
+    for role, t in sorted(totals.items()):
+        saved = 1 - t["cascade_cost"] / t["big_cost"] if t["big_cost"] else 0.0
+        compared = t["compared"] or float("nan")
+        print(f"{role:<12}{t['requests']:>9.0f}{t['escalated'] / t['requests']:>10.0%}"
+              f"{t['big_cost']:>11.4f}{t['cascade_cost']:>11.4f}{saved:>7.0%}"
+              f"{t['big_seconds']:>11.2f}{t['cascade_seconds']:>10.2f}"
+              f"{t['cheap_agree'] / compared:>12.0%}{t['cascade_agree'] / compared:>14.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,461 @@
+"""
+A rate-limit-aware scheduler for LLM calls.
+
+Starting every agent.act() at once with asyncio.gather is fine for three agents, but
+with hundreds of agents the provider answers with HTTP 429 and the run stalls. The
+Scheduler sits between the agents and the backend and
+
+* keeps requests-per-minute and tokens-per-minute within budget using token buckets,
+* caps the number of requests in flight,
+* retries failed calls with jittered exponential backoff, and
+* lets high-priority turns (moderator, candidates) overtake low-priority ones (audience).
+
+Scripts keep using asyncio.gather; the ScheduledBackend decides when each call may go.
+"""
+import asyncio
+import contextlib
+import heapq
+import itertools
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from instrumentation import add_queue_wait
+from llm_backend import BackendWrapper, ChatResponse, RateLimitError, estimate_tokens
+
+# Lower numbers are served first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Completion tokens reserved for a request that does not set max_tokens
+DEFAULT_COMPLETION_ESTIMATE = 256
+
+
+class TokenBucket:
+    def __init__(self, per_minute, capacity=None):
+        """
+        A token bucket that refills continuously at `per_minute` tokens per minute.
+
+        :param per_minute: The sustained budget, e.g. the provider's RPM or TPM limit
+        :param capacity: The largest burst allowed; defaults to one minute of budget
+        """
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """
+        How many seconds until `amount` tokens are available (0 if they are now).
+        Requests larger than the capacity only wait for a full bucket.
+        """
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        """
+        Remove `amount` tokens. The balance may go negative when a request turns out to
+        be more expensive than estimated; later requests then wait for the debt.
+        """
+        self._refill()
+        self.tokens -= amount
+
+    def give(self, amount):
+        """
+        Return tokens that were reserved but not used.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class SharedTokenBucket:
+    def __init__(self, path, name, per_minute, capacity=None):
+        """
+        A token bucket whose balance lives in a SQLite file, so that several processes,
+        or several hosts sharing the file, draw from one budget. It has the same
+        methods as TokenBucket. Hosts must have synchronized clocks.
+
+        :param path: The SQLite file holding the balance
+        :param name: The name of the budget (e.g., "rpm")
+        :param per_minute: The sustained budget shared by all users of the file
+        :param capacity: The largest burst allowed; defaults to one minute of budget
+        """
+        self.path = path
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        # SQLite connections must not cross a fork, so each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                               check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS buckets "
+                                     "(name TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            self._connection.execute("INSERT OR IGNORE INTO buckets VALUES (?, ?, ?)",
+                                     (self.name, self.capacity, time.time()))
+            self._pid = os.getpid()
+        return self._connection
+
+    def _balance(self, connection):
+        tokens, updated = connection.execute("SELECT tokens, updated FROM buckets WHERE name = ?",
+                                             (self.name,)).fetchone()
+        return min(self.capacity, tokens + (time.time() - updated) * self.rate)
+
+    def _change(self, amount):
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            tokens = min(self.capacity, self._balance(connection) + amount)
+            connection.execute("UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?",
+                               (tokens, time.time(), self.name))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def wait_time(self, amount):
+        missing = min(amount, self.capacity) - self._balance(self._connect())
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        # Another process may take tokens between wait_time() and take(); the balance
+        # then goes negative and everybody waits for the debt, as with TokenBucket
+        self._change(-amount)
+
+    def give(self, amount):
+        self._change(amount)
+
+
+def _bucket(per_minute, shared_store, name):
+    if not per_minute:
+        return None
+    if shared_store:
+        return SharedTokenBucket(shared_store, name, per_minute)
+    return TokenBucket(per_minute)
+
+
+class Scheduler:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_in_flight=32,
+                 max_retries=5, base_delay=0.5, max_delay=30.0, shared_store=None):
+        """
+        Decide when each LLM call may start.
+
+        :param requests_per_minute: The RPM budget, or None for no limit
+        :param tokens_per_minute: The TPM budget (prompt + completion), or None for no limit
+        :param max_in_flight: The maximum number of concurrent requests
+        :param max_retries: How many times a retryable failure is retried
+        :param base_delay: The first backoff delay in seconds; it doubles on every retry
+        :param max_delay: The upper bound of a single backoff delay
+        :param shared_store: A SQLite file through which all processes using it share
+                             the RPM and TPM budgets (see SharedTokenBucket)
+        """
+        self.requests = _bucket(requests_per_minute, shared_store, "rpm")
+        self.tokens = _bucket(tokens_per_minute, shared_store, "tpm")
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.retries = 0
+        self._queue = []  # heap of (priority, sequence, tokens, future)
+        self._sequence = itertools.count()
+        self._loop = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a scheduler from LLM_RPM, LLM_TPM, LLM_MAX_IN_FLIGHT and LLM_MAX_RETRIES.
+        If LLM_RATE_STORE names a SQLite file, the RPM and TPM budgets are shared with
+        every other process that uses the same file.
+        """
+        rpm = os.getenv("LLM_RPM")
+        tpm = os.getenv("LLM_TPM")
+        return cls(
+            requests_per_minute=float(rpm) if rpm else None,
+            tokens_per_minute=float(tpm) if tpm else None,
+            max_in_flight=int(os.getenv("LLM_MAX_IN_FLIGHT", "32")),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "5")),
+            shared_store=os.getenv("LLM_RATE_STORE") or None,
+        )
+
+    def backoff(self, attempt, error):
+        """
+        The delay before retry number `attempt`: "full jitter" exponential backoff,
+        but never shorter than the provider's Retry-After.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if isinstance(error, RateLimitError) and error.retry_after:
+            delay = max(delay, error.retry_after)
+        return delay
+
+    def _budget_wait(self, tokens):
+        """
+        Seconds until a request of `tokens` tokens fits in every budget.
+        """
+        wait = max(0.0, self.paused_until - time.monotonic())
+        if self.requests:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def _take(self, tokens):
+        self.in_flight += 1
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(tokens)
+
+    def _dispatch(self):
+        """
+        Start as many queued requests as the budgets allow, highest priority first.
+        The head of the queue is never skipped, so low-priority work cannot starve
+        high-priority work by slipping into gaps in the budget.
+        """
+        self._timer = None
+        while self._queue and self.in_flight < self.max_in_flight:
+            _, _, tokens, future = self._queue[0]
+            if future.cancelled():
+                heapq.heappop(self._queue)
+                continue
+            wait = self._budget_wait(tokens)
+            if wait > 0:
+                self._timer = self._loop.call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._queue)
+            self._take(tokens)
+            future.set_result(None)
+
+    async def acquire(self, tokens, priority=PRIORITY_NORMAL):
+        """
+        Wait until a request may start. Every acquire() must be paired with release().
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # A new event loop (e.g. a second asyncio.run) starts with an empty queue
+            self._loop, self._queue, self._timer = loop, [], None
+        future = loop.create_future()
+        heapq.heappush(self._queue, (priority, next(self._sequence), tokens, future))
+        if self._timer is None:
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Cancelled right after being admitted: hand the slot back
+                self.release(tokens)
+            raise
+
+    def release(self, reserved, used=None):
+        """
+        Mark a request as finished and settle its token reservation.
+
+        :param reserved: The tokens reserved by acquire()
+        :param used: The tokens the request actually consumed, if known
+        """
+        self.in_flight -= 1
+        if self.tokens and used is not None:
+            if used < reserved:
+                self.tokens.give(reserved - used)
+            else:
+                self.tokens.take(used - reserved)
+        if self._loop is not None and self._timer is None:
+            self._dispatch()
+
+    def pause(self, seconds):
+        """
+        Stop starting new requests for a while, e.g. after the provider returned 429.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire_sync(self, tokens):
+        """
+        The blocking counterpart of acquire() for synchronous scripts.
+        """
+        while True:
+            with self._lock:
+                wait = self._budget_wait(tokens)
+                if wait <= 0 and self.in_flight < self.max_in_flight:
+                    self._take(tokens)
+                    return
+            time.sleep(max(wait, 0.01))
+
+    def release_sync(self, reserved, used=None):
+        with self._lock:
+            self.in_flight -= 1
+            if self.tokens and used is not None:
+                if used < reserved:
+                    self.tokens.give(reserved - used)
+                else:
+                    self.tokens.take(used - reserved)
+
+
+def estimate_request_tokens(request):
+    """
+    The number of tokens a request will count against the TPM budget at most.
+    """
+    prompt = sum(estimate_tokens(m["content"]) + 4 for m in request.messages)
+    completion = (request.params.get("max_tokens") or request.params.get("max_completion_tokens")
+                  or DEFAULT_COMPLETION_ESTIMATE)
+    return prompt + completion
+
+
+def _used_tokens(response):
+    return response.usage["prompt_tokens"] + response.usage["completion_tokens"] or None
+
+
+def _stream_tokens(request, response, text):
+    """
+    The tokens a stream consumed: its usage if it finished, or else an estimate of
+    its prompt and of the text delivered before it was closed (e.g. by a stop
+    predicate). None if nothing was delivered.
+    """
+    if response is not None:
+        return _used_tokens(response)
+    if not text:
+        return None
+    return sum(estimate_tokens(m["content"]) + 4 for m in request.messages) + estimate_tokens(text)
+
+
+class ScheduledBackend(BackendWrapper):
+    def __init__(self, backend, scheduler=None):
+        """
+        Send every request through a Scheduler. The priority of a request is taken
+        from request.meta["priority"] (PRIORITY_NORMAL if absent).
+
+        :param backend: The backend that actually serves the requests
+        :param scheduler: The Scheduler to use; several backends may share one
+        """
+        super().__init__(backend)
+        self.scheduler = scheduler or Scheduler()
+
+    def _retry_delay(self, error, attempt):
+        """
+        How long to wait before retrying after `error`, or None if it must be raised.
+        """
+        scheduler = self.scheduler
+        if not getattr(error, "retryable", False) or attempt == scheduler.max_retries:
+            return None
+        delay = scheduler.backoff(attempt, error)
+        if isinstance(error, RateLimitError):
+            # Everyone backs off, not only this caller
+            scheduler.pause(delay)
+        scheduler.retries += 1
+        return delay
+
+    async def asend(self, request):
+        scheduler = self.scheduler
+        tokens = estimate_request_tokens(request)
+        priority = request.meta.get("priority", PRIORITY_NORMAL)
+        for attempt in range(scheduler.max_retries + 1):
+            queued = time.perf_counter()
+            await scheduler.acquire(tokens, priority)
+            add_queue_wait(time.perf_counter() - queued)
+            response = None
+            try:
+                response = await self.backend.asend(request)
+                return response
+            except Exception as error:
+                delay = self._retry_delay(error, attempt)
+                if delay is None:
+                    raise
+            finally:
+                scheduler.release(tokens, _used_tokens(response) if response else None)
+            add_queue_wait(delay)
+            await asyncio.sleep(delay)
+
+    def send(self, request):
+        scheduler = self.scheduler
+        tokens = estimate_request_tokens(request)
+        for attempt in range(scheduler.max_retries + 1):
+            queued = time.perf_counter()
+            scheduler.acquire_sync(tokens)
+            add_queue_wait(time.perf_counter() - queued)
+            response = None
+            try:
+                response = self.backend.send(request)
+                return response
+            except Exception as error:
+                delay = self._retry_delay(error, attempt)
+                if delay is None:
+                    raise
+            finally:
+                scheduler.release_sync(tokens, _used_tokens(response) if response else None)
+            add_queue_wait(delay)
+            time.sleep(delay)
+
+    async def astream(self, request):
+        # A stream holds its slot until it is finished or closed. It is only retried
+        # if it failed before the first delta was delivered.
+        scheduler = self.scheduler
+        tokens = estimate_request_tokens(request)
+        priority = request.meta.get("priority", PRIORITY_NORMAL)
+        for attempt in range(scheduler.max_retries + 1):
+            queued = time.perf_counter()
+            await scheduler.acquire(tokens, priority)
+            add_queue_wait(time.perf_counter() - queued)
+            response = None
+            started = False
+            text = ""
+            try:
+                async with contextlib.aclosing(self.backend.astream(request)) as chunks:
+                    async for chunk in chunks:
+                        if isinstance(chunk, ChatResponse):
+                            response = chunk
+                        else:
+                            text += chunk
+                        started = True
+                        yield chunk
+                return
+            except Exception as error:
+                delay = None if started else self._retry_delay(error, attempt)
+                if delay is None:
+                    raise
+            finally:
+                scheduler.release(tokens, _stream_tokens(request, response, text))
+            add_queue_wait(delay)
+            await asyncio.sleep(delay)
+
+    def stream(self, request):
+        scheduler = self.scheduler
+        tokens = estimate_request_tokens(request)
+        for attempt in range(scheduler.max_retries + 1):
+            queued = time.perf_counter()
+            scheduler.acquire_sync(tokens)
+            add_queue_wait(time.perf_counter() - queued)
+            response = None
+            started = False
+            text = ""
+            try:
+                with contextlib.closing(self.backend.stream(request)) as chunks:
+                    for chunk in chunks:
+                        if isinstance(chunk, ChatResponse):
+                            response = chunk
+                        else:
+                            text += chunk
+                        started = True
+                        yield chunk
+                return
+            except Exception as error:
+                delay = None if started else self._retry_delay(error, attempt)
+                if delay is None:
+                    raise
+            finally:
+                scheduler.release_sync(tokens, _stream_tokens(request, response, text))
+            add_queue_wait(delay)
+            time.sleep(delay)
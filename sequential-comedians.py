@@ -1,7 +1,9 @@
-import os
+import asyncio
 import time
-from openai import OpenAI
 from dotenv import load_dotenv
+from llm_backend import get_backend
+from streaming import astream_completion, stop_at_newline
+from transcript_sink import TranscriptSink, print_transcript
 
 
 # This function looks for a file named .env in the current directory and loads
@@ -9,7 +11,7 @@ from dotenv import load_dotenv
 # This is useful for securely managing sensitive information like API keys.
 # The .env file should contain the API key in the format: OPENAI_API_KEY=your_openai_api_key
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+backend = get_backend()
 
 class Agent:
     def __init__(self, name, role):
@@ -23,15 +25,24 @@ class Agent:
         self.name = name
         self.role = role
         self.system_prompt = f"You are {self.name}, a famous comedian known for {self.role}."
+        # Seconds until the first token of each response arrived
+        self.first_token_times = []
 
-    def act(self, context):
+    async def act(self, context, on_token=None):
         """
         Generate a response from the agent based on the given context.
+        The response is streamed and stops at the end of the first line, since
+        a one-liner needs no more; the rest is never generated or billed.
 
         :param context: The context or prompt for the agent (e.g., "Tell a one-liner joke.")
+        :param on_token: Called with each piece of the response as it arrives
         :return: The generated response from the agent
         """
-        response = client.chat.completions.create(
+        # The call is awaited, so it does not block the event loop (or other agents)
+        response = await astream_completion(
+            backend,
+            on_token=on_token,
+            stop=[stop_at_newline()],
             model="gpt-4o",
             messages=[
                 {"role": "system", "content": self.system_prompt},
@@ -41,20 +52,30 @@ class Agent:
             max_tokens=60,    # Limits the length of the response
             frequency_penalty=0.7  # Penalizes repetition
         )
-        return response.choices[0].message.content
+        self.first_token_times.append(response.time_to_first_token)
+        return response.content
 
-def simulation_loop(agents, rounds):
+async def simulation_loop(agents, rounds, sink=None):
     """
     Simulate a conversation loop where each agent responds to a given context.
+    The agents still take turns, one after another: compare with
+    asynchronious-comedians.py, where they all tell their jokes at once.
 
     :param agents: A list of Agent objects
     :param rounds: The number of rounds to run the simulation
+    :param sink: The TranscriptSink the jokes are written to; by default one
+                 configured from the environment (see transcript_sink.py)
     """
     context = "Tell a one-liner joke."
-    for _ in range(rounds):
-        for agent in agents:
-            completion = agent.act(context)
-            print(f"{agent.name}: {completion.strip()}")
+    if sink is None:
+        sink = TranscriptSink.from_env()
+
+    async with sink:
+        for round_num in range(1, rounds + 1):
+            for agent in agents:
+                joke = await agent.act(context)
+                # Write each joke as soon as it is complete
+                await sink.emit(agent.name, joke.strip(), round=round_num, kind="joke")
 
 if __name__ == "__main__":
     # Initialize a list of agents, each representing a famous comedian
@@ -68,8 +89,14 @@ if __name__ == "__main__":
     start_time = time.time()
     
     # Run the simulation loop with the defined agents for a specified number of rounds
-    simulation_loop(agents, 2)
+    # With LLM_TRANSCRIPT=jokes.jsonl every joke is also saved for analysis
+    sink = TranscriptSink.from_env()
+    asyncio.run(simulation_loop(agents, 2, sink=sink))
     
     # Record the end time of the simulation and calculate the total execution time
     end_time = time.time()
     print(f"Execution time: {end_time - start_time:.2f} seconds")
+    print_transcript(sink)
+    first_token_times = [t for agent in agents for t in agent.first_token_times if t is not None]
+    if first_token_times:
+        print(f"Mean time to first token: {sum(first_token_times) / len(first_token_times):.2f} seconds")
@@ -0,0 +1,146 @@
+"""
+Speculative turn-taking: the next speakers start talking before it is their turn.
+
+In a conversation every turn waits for the one before it, so the wall time is the
+sum of all calls. Yet most lines do not change what the next speakers would say.
+With LLM_SPECULATE=K, when a turn starts, the next K speakers also start generating
+against the transcript as it stands. When it is a speaker's turn, its answer is
+checked against the lines it missed while it was generating. If none of them is
+material, the answer is kept, and the turn only waits for what is left of it.
+Otherwise it is discarded and the turn is generated again.
+
+A missed line is material when it addresses the speaker by name (e.g., "Jimmy, you
+of all people..."). Pass another `material` function to SpeculativeTurns to
+change that. Discarded answers cost money, so speculation stops once they have
+cost LLM_SPECULATE_MAX_COST dollars (0.50 by default), and the remaining turns run
+one after another.
+"""
+import asyncio
+import os
+
+from instrumentation import estimate_cost
+
+
+def addressed(name, lines):
+    """
+    Whether any of `lines` (speaker, text) names `name`, by first, last or full name.
+    """
+    words = [word for word in name.split() if len(word) > 2] + [name]
+    return any(word in text for _, text in lines for word in words)
+
+
+class SpeculativeTurns:
+    def __init__(self, transcript, depth=1, max_cost=0.5, material=addressed):
+        """
+        Run a fixed order of turns, generating up to `depth` of them ahead.
+
+        :param transcript: The Transcript the turns append to
+        :param depth: How many of the next speakers start generating early (0 turns
+                      speculation off); at most one turn per speaker is in flight
+        :param max_cost: The most the discarded answers may cost, in dollars
+        :param material: A function (speaker name, missed lines) -> bool that
+                         decides whether an early answer must be generated again
+        """
+        self.transcript = transcript
+        self.depth = depth
+        self.max_cost = max_cost
+        self.material = material
+        self.kept = 0
+        self.reissued = 0
+        self.wasted = 0.0  # dollars spent on discarded answers
+
+    @classmethod
+    def from_env(cls, transcript):
+        """
+        SpeculativeTurns configured from LLM_SPECULATE and LLM_SPECULATE_MAX_COST.
+        """
+        return cls(transcript, depth=int(os.getenv("LLM_SPECULATE", "0")),
+                   max_cost=float(os.getenv("LLM_SPECULATE_MAX_COST", "0.5")))
+
+    def _missed(self, seen):
+        transcript = self.transcript
+        return [(transcript.speakers[transcript.speaker[i]], transcript.texts[i])
+                for i in range(seen, len(transcript))]
+
+    def _start(self, agent):
+        # Build the messages before anything else can append to the transcript, so
+        # that the answer is based on exactly the lines counted here
+        messages = agent.context.messages()
+        return asyncio.ensure_future(agent.respond(messages)), len(self.transcript)
+
+    async def run(self, turns, checkpoint=None, on_turn=None):
+        """
+        Run the turns in order.
+
+        :param turns: A list of (name, agent) pairs. An agent has a `name`, a
+                      `context` view of the transcript, an async respond(messages=None)
+                      that returns a ChatResponse to the given messages (by default,
+                      its view's) without changing the transcript, and
+                      commit(response), which appends it and returns the text of the
+                      turn
+        :param checkpoint: An optional Checkpoint (see checkpoint.py)
+        :param on_turn: An optional async function called with the index and text of
+                        each turn as soon as it is done
+        :return: The texts of the turns, in order
+        """
+        in_flight = {}  # turn index -> (task, transcript length when it started)
+        texts = []
+        try:
+            for index, (name, agent) in enumerate(turns):
+                self._speculate(turns, index, in_flight, checkpoint)
+
+                async def turn(index=index, agent=agent):
+                    if index in in_flight:
+                        task, seen = in_flight.pop(index)
+                        response = await task
+                        if not self.material(agent.name, self._missed(seen)):
+                            self.kept += 1
+                            return agent.commit(response)
+                        self.reissued += 1
+                        self.wasted += estimate_cost(response.model, response.usage)
+                    return agent.commit(await agent.respond())
+
+                if checkpoint is None:
+                    texts.append(await turn())
+                else:
+                    texts.append(await checkpoint.arun(name, turn,
+                                                       state=[self.transcript, agent.context]))
+                if on_turn is not None:
+                    await on_turn(index, texts[-1])
+        finally:
+            for task, _ in in_flight.values():
+                task.cancel()
+        return texts
+
+    def _speculate(self, turns, index, in_flight, checkpoint):
+        """
+        Start the next speakers now, unless they are already generating, their turn
+        is in the checkpoint, or discarded answers cost too much already.
+        """
+        speakers = {turns[index][1].name}
+        for ahead in range(index + 1, min(index + 1 + self.depth, len(turns))):
+            name, speaker = turns[ahead]
+            # A speaker's earlier turn must be in the transcript before its next one
+            if speaker.name in speakers:
+                break
+            speakers.add(speaker.name)
+            if (ahead in in_flight or self.wasted >= self.max_cost
+                    or (checkpoint is not None and name in checkpoint)):
+                continue
+            in_flight[ahead] = self._start(speaker)
+
+    def report(self):
+        """
+        A one-line summary of how the early answers fared.
+        """
+        started = self.kept + self.reissued
+        return (f"Speculation: {self.kept} of {started} early answers kept, {self.reissued} "
+                f"generated again, ~${self.wasted:.4f} discarded (cap ${self.max_cost:.2f})")
+
+
+def print_speculation(turns):
+    """
+    Print the report of a SpeculativeTurns, if speculation was on.
+    """
+    if turns is not None and turns.depth:
+        print(turns.report())
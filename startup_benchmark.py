@@ -0,0 +1,146 @@
+"""
+Measure how fast the scripts start and how fast their first calls are.
+
+Two things slow down the start of a large run before any agent has said a word:
+importing the script (and everything it builds at import time), and opening the
+connections for the first calls. This benchmark measures both against the stub
+server (see stub_server.py), through the real OpenAI client, so no API key is
+needed and nothing is billed:
+
+    python startup_benchmark.py --agents 1000
+
+First, each script is imported in a fresh interpreter, as `python script.py` would
+do before running the simulation. Then a burst of `--agents` concurrent calls is
+sent twice: through the shared, pooled client of clients.py, and through a pool
+that keeps no idle connections, which opens a new connection for every call. The
+first call of a process also pays for creating the client, so it is reported on
+its own.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from benchmark import SCENARIOS, percentile
+from clients import ClientConfig, close_clients
+from llm_backend import ChatRequest, OpenAIBackend
+from stub_server import StubConfig, StubHTTPServer, StubModel, make_handler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Imports the script in a fresh interpreter and prints the seconds it took
+IMPORT_SNIPPET = """
+import time
+from benchmark import load_script
+start = time.perf_counter()
+load_script({filename!r})
+print(time.perf_counter() - start)
+"""
+
+
+def import_time(filename, repeat=3):
+    """
+    The fastest of `repeat` imports of a script, each in a new interpreter, in seconds.
+    """
+    # A real backend, so that client creation would be counted if it were eager
+    env = {**os.environ, "LLM_BACKEND": "openai", "OPENAI_API_KEY": "sk-startup-benchmark"}
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET.format(filename=filename)],
+                                cwd=HERE, env=env, capture_output=True, text=True, check=True)
+        times.append(float(output.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def start_stub_server(config):
+    """
+    Serve the stub model over HTTP on a free port, in a background thread.
+
+    :return: The server and its handler class, which counts accepted connections
+    """
+    handler = make_handler(StubModel(config))
+    server = StubHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler
+
+
+async def burst(backend, count):
+    """
+    Send `count` concurrent calls, as `count` agents starting a round would.
+
+    :return: The wall time and the latency of every call
+    """
+    async def call(i):
+        start = time.perf_counter()
+        await backend.asend(ChatRequest("gpt-4o", [{"role": "user", "content": f"Agent {i}"}],
+                                        {"max_tokens": 5}))
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(call(i) for i in range(count)))
+    return time.perf_counter() - start, latencies
+
+
+async def first_calls(base_url, agents, config, handler):
+    """
+    Time the first call of a process, the call after it, and two bursts of calls.
+    """
+    backend = OpenAIBackend(api_key="sk-startup-benchmark", base_url=base_url, max_retries=0,
+                            config=config)
+    request = ChatRequest("gpt-4o", [{"role": "user", "content": "Hello"}], {"max_tokens": 5})
+    results = {}
+    for name in ("first call", "second call"):
+        before = handler.connections
+        start = time.perf_counter()
+        await backend.asend(request)
+        results[name] = (time.perf_counter() - start, [], handler.connections - before)
+
+    cold = ClientConfig(max_connections=config.max_connections, max_keepalive=0,
+                        http2=config.http2, timeout=config.timeout,
+                        connect_timeout=config.connect_timeout)
+    for name, pool in (("burst, pooled", config), ("burst, no keep-alive", cold)):
+        before = handler.connections
+        wall, latencies = await burst(OpenAIBackend(api_key="sk-startup-benchmark", base_url=base_url,
+                                                    max_retries=0, config=pool), agents)
+        results[name] = (wall, latencies, handler.connections - before)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark script startup and first calls")
+    parser.add_argument("--scripts", default=",".join(SCENARIOS),
+                        help="comma separated scenario names (see benchmark.py)")
+    parser.add_argument("--agents", type=int, default=200,
+                        help="concurrent calls in each burst")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="median stub time to first token in seconds")
+    args = parser.parse_args(argv)
+
+    print(f"{'script':<26}{'import s':>9}")
+    for name in args.scripts.split(","):
+        print(f"{name:<26}{import_time(SCENARIOS[name][0]):>9.3f}")
+
+    server, handler = start_stub_server(StubConfig(latency=args.latency, tokens_per_second=1e6,
+                                                   prefix_cache_min=0))
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    config = ClientConfig.from_env()
+    try:
+        results = asyncio.run(first_calls(base_url, args.agents, config, handler))
+    finally:
+        close_clients()
+        server.shutdown()
+
+    print(f"\nPool: {config.max_connections} connections, {config.max_keepalive} kept alive, "
+          f"HTTP/{'2' if config.http2 else '1.1'}")
+    print(f"{'calls':<22}{'wall s':>8}{'p50 ms':>9}{'p99 ms':>9}{'connections':>13}")
+    for name, (wall, latencies, connections) in results.items():
+        print(f"{name:<22}{wall:>8.3f}{percentile(latencies or [wall], 0.5) * 1000:>9.1f}"
+              f"{percentile(latencies or [wall], 0.99) * 1000:>9.1f}{connections:>13}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+Streamed completions with early stopping.
+
+Instead of waiting for the whole completion, stream_completion() and
+astream_completion() hand every piece of text to a callback as soon as it arrives
+and measure the time to the first token. Stop predicates look at the text received
+so far and may cut it: as soon as one fires, the stream is closed, so the model stops
+generating and the remaining tokens are never billed.
+
+A stop predicate is a function that receives the text so far and returns the
+position where the text should end, or None to keep going. A predicate with a `name`
+attribute (as the ones below have) is named in request.meta["stop"], so that the
+response cache can keep a stream it cut short for callers that cut it the same way.
+"""
+import contextlib
+import re
+import time
+
+from llm_backend import ChatRequest, ChatResponse, estimate_tokens
+
+SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*(?=\s)")
+
+
+def stop_at_newline():
+    """
+    Stop at the first line break after some text, e.g. for one-liner jokes.
+    """
+    def predicate(text):
+        stripped = len(text) - len(text.lstrip())
+        position = text.find("\n", stripped)
+        return position if position != -1 else None
+    predicate.name = "newline"
+    return predicate
+
+
+def stop_after_sentences(count):
+    """
+    Stop after `count` complete sentences, e.g. for "short and crisp" answers.
+    A sentence only counts as complete once the whitespace after it has arrived,
+    so that "3.5" or "U.S." in the middle of a word does not end it.
+    """
+    def predicate(text):
+        for number, match in enumerate(SENTENCE_END.finditer(text), start=1):
+            if number == count:
+                return match.end()
+        return None
+    predicate.name = f"sentences:{count}"
+    return predicate
+
+
+def print_tokens(prefix=""):
+    """
+    A callback that prints the text as it arrives, preceded once by `prefix`.
+    """
+    state = {"started": False}
+
+    def on_token(delta):
+        if not state["started"]:
+            print(prefix, end="")
+            state["started"] = True
+        print(delta, end="", flush=True)
+    return on_token
+
+
+def with_stop(request, stop):
+    """
+    The request with the names of its stop predicates in meta["stop"], or the request
+    itself if there are none or one has no name.
+    """
+    names = [getattr(predicate, "name", None) for predicate in stop or ()]
+    if not names or None in names:
+        return request
+    return ChatRequest(request.model, request.messages, request.params,
+                       {**request.meta, "stop": sorted(names)})
+
+
+class _Collector:
+    def __init__(self, request, on_token, stop):
+        self.request = request
+        self.on_token = on_token
+        self.stop = list(stop or ())
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.text = ""
+        self.response = None
+        self.stopped = False
+
+    def add(self, chunk):
+        """
+        Take one item of a stream and return True when the stream should be closed.
+        """
+        if isinstance(chunk, ChatResponse):
+            self.response = chunk
+            return True
+        if self.first_token is None:
+            self.first_token = time.perf_counter() - self.start
+        before = len(self.text)
+        self.text += chunk
+        cuts = [cut for cut in (predicate(self.text) for predicate in self.stop) if cut is not None]
+        if cuts:
+            self.text = self.text[:min(cuts)]
+            self.stopped = True
+        if self.on_token and len(self.text) > before:
+            self.on_token(self.text[before:])
+        return self.stopped
+
+    def result(self):
+        if self.response is not None and not self.stopped:
+            response = self.response
+            if response.time_to_first_token is None:
+                response.time_to_first_token = self.first_token
+            return response
+        # Stopped early: report what was received; later tokens were never generated
+        usage = {
+            "prompt_tokens": sum(estimate_tokens(m["content"]) + 4 for m in self.request.messages),
+            "completion_tokens": estimate_tokens(self.text) if self.text else 0,
+        }
+        return ChatResponse(self.text, model=self.request.model, usage=usage,
+                            latency=time.perf_counter() - self.start, finish_reason="stopped",
+                            time_to_first_token=self.first_token)
+
+
+def stream_request(backend, request, on_token=None, stop=None):
+    """
+    Send a ChatRequest as a stream.
+
+    :param backend: The backend to use
+    :param request: The ChatRequest to send
+    :param on_token: Called with every piece of text as it arrives (e.g., print_tokens())
+    :param stop: A list of stop predicates (e.g., [stop_at_newline()])
+    :return: A ChatResponse with time_to_first_token set; its finish_reason is
+             "stopped" if a stop predicate ended the stream
+    """
+    collector = _Collector(request, on_token, stop)
+    with contextlib.closing(backend.stream(with_stop(request, stop))) as chunks:
+        for chunk in chunks:
+            if collector.add(chunk):
+                break
+    return collector.result()
+
+
+async def astream_request(backend, request, on_token=None, stop=None):
+    """
+    The asynchronous counterpart of stream_request().
+    """
+    collector = _Collector(request, on_token, stop)
+    async with contextlib.aclosing(backend.astream(with_stop(request, stop))) as chunks:
+        async for chunk in chunks:
+            if collector.add(chunk):
+                break
+    return collector.result()
+
+
+def stream_completion(backend, model, messages, meta=None, on_token=None, stop=None, **params):
+    """
+    Like stream_request(), but takes the same keyword arguments as Backend.complete().
+    """
+    return stream_request(backend, ChatRequest(model, messages, params, meta), on_token, stop)
+
+
+async def astream_completion(backend, model, messages, meta=None, on_token=None, stop=None,
+                             **params):
+    """
+    Like astream_request(), but takes the same keyword arguments as Backend.acomplete().
+    """
+    return await astream_request(backend, ChatRequest(model, messages, params, meta),
+                                 on_token, stop)
@@ -0,0 +1,473 @@
+"""
+A local stand-in for the OpenAI chat completions API.
+
+The stub never calls the network. It produces filler text with simulated latency,
+token throughput and failure rates, so that simulations can be benchmarked and
+tested for free. It can be used in two ways:
+
+* in-process, with LLM_BACKEND=stub (see llm_backend.get_backend), or
+* as an HTTP server that the real OpenAI client talks to:
+
+    python stub_server.py --port 8000 --latency-dist lognormal --latency 0.8
+    OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=stub python presidential_debates.py
+
+Like the real API, the stub caches prompt prefixes: a request whose first 1024 or more
+tokens match an earlier request reports them as cached_tokens and starts faster.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_backend import (Backend, BackendError, ChatRequest, ChatResponse, RateLimitError,
+                         estimate_tokens)
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal", "pareto")
+
+# Prompt prefixes are cached in blocks of this many tokens, as the OpenAI API does
+PREFIX_BLOCK_TOKENS = 128
+# The number of cached prefix blocks the stub remembers
+PREFIX_CACHE_ENTRIES = 100_000
+
+WORDS = (
+    "well you know the thing about politics is that nobody ever reads the fine print "
+    "and everybody wants a bigger slice of pie but nobody wants to bake it I told my "
+    "doctor I broke my leg in two places and he said stop going to those places the "
+    "economy is like a bicycle you have to keep pedaling or you fall over and that is "
+    "exactly what my opponent refuses to understand"
+).split()
+
+
+def sample_schema(schema, rng):
+    """
+    Make up a value that satisfies a (simple) JSON schema: objects, arrays, enums,
+    strings, numbers, integers and booleans.
+    """
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: sample_schema(value, rng) for name, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [sample_schema(schema.get("items", {}), rng) for _ in range(rng.randint(1, 3))]
+    if kind == "number":
+        return round(rng.uniform(schema.get("minimum", 0), schema.get("maximum", 1)), 2)
+    if kind == "integer":
+        return rng.randint(schema.get("minimum", 0), schema.get("maximum", 10))
+    if kind == "boolean":
+        return rng.random() < 0.5
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))).capitalize() + "."
+
+
+class StubConfig:
+    def __init__(self, latency_dist="lognormal", latency=0.5, latency_spread=0.5,
+                 tokens_per_second=80.0, error_rate=0.0, rate_limit_rate=0.0,
+                 completion_tokens=40, batch_latency=2.0, prefix_cache_min=1024, seed=None):
+        """
+        Describe how the stub model behaves.
+
+        :param latency_dist: Distribution of the time to first token, one of
+                             LATENCY_DISTRIBUTIONS
+        :param latency: The median time to first token in seconds
+        :param latency_spread: The shape of the distribution: the sigma of the lognormal,
+                               the relative half-width of the uniform, the relative standard
+                               deviation of the normal, or the tail index of the pareto
+        :param tokens_per_second: How fast completion tokens are produced after the first
+        :param error_rate: Probability that a call fails with a retryable server error
+        :param rate_limit_rate: Probability that a call is rejected with HTTP 429
+        :param completion_tokens: Typical length of a completion when max_tokens allows it
+        :param batch_latency: Seconds until a submitted batch is completed
+        :param prefix_cache_min: The shortest prompt prefix, in tokens, that is served
+                                 from the prefix cache; 0 disables the prefix cache
+        :param seed: Seed of the random generator, for reproducible runs
+        """
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {latency_dist!r}")
+        self.latency_dist = latency_dist
+        self.latency = latency
+        self.latency_spread = latency_spread
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.completion_tokens = completion_tokens
+        self.batch_latency = batch_latency
+        self.prefix_cache_min = prefix_cache_min
+        self.seed = seed
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build a configuration from the STUB_* environment variables.
+        """
+        seed = os.getenv("STUB_SEED")
+        return cls(
+            latency_dist=os.getenv("STUB_LATENCY_DIST", "lognormal"),
+            latency=float(os.getenv("STUB_LATENCY", "0.5")),
+            latency_spread=float(os.getenv("STUB_LATENCY_SPREAD", "0.5")),
+            tokens_per_second=float(os.getenv("STUB_TOKENS_PER_SEC", "80")),
+            error_rate=float(os.getenv("STUB_ERROR_RATE", "0")),
+            rate_limit_rate=float(os.getenv("STUB_RATE_LIMIT_RATE", "0")),
+            completion_tokens=int(os.getenv("STUB_COMPLETION_TOKENS", "40")),
+            batch_latency=float(os.getenv("STUB_BATCH_LATENCY", "2")),
+            prefix_cache_min=int(os.getenv("STUB_PREFIX_CACHE_MIN", "1024")),
+            seed=int(seed) if seed is not None else None,
+        )
+
+
+class StubModel:
+    def __init__(self, config=None):
+        """
+        The simulated model behind both the in-process backend and the HTTP server.
+
+        :param config: A StubConfig; defaults to StubConfig()
+        """
+        self.config = config or StubConfig()
+        self.random = random.Random(self.config.seed)
+        self.lock = threading.Lock()
+        self.prefixes = OrderedDict()  # hashes of the prompt prefixes seen, oldest first
+
+    def sample_latency(self):
+        """
+        Draw a time to first token from the configured distribution.
+        """
+        c = self.config
+        with self.lock:
+            if c.latency_dist == "fixed":
+                value = c.latency
+            elif c.latency_dist == "uniform":
+                value = self.random.uniform(c.latency * (1 - c.latency_spread),
+                                            c.latency * (1 + c.latency_spread))
+            elif c.latency_dist == "normal":
+                value = self.random.gauss(c.latency, c.latency * c.latency_spread)
+            elif c.latency_dist == "lognormal":
+                value = self.random.lognormvariate(math.log(c.latency), c.latency_spread)
+            else:
+                # Pareto with the given tail index, scaled so that its median is `latency`
+                alpha = max(c.latency_spread, 0.1)
+                value = c.latency / 2 ** (1 / alpha) * self.random.paretovariate(alpha)
+        return max(value, 0.0)
+
+    def _filler_text(self, length):
+        """
+        `length` random words, cut into sentences, some of them on a new line.
+        """
+        words = [self.random.choice(WORDS) for _ in range(length)]
+        text = ""
+        while words:
+            size = self.random.randint(6, 14)
+            separator = "\n" if self.random.random() < 0.3 else " "
+            text += (separator if text else "") + " ".join(words[:size]).capitalize() + "."
+            words = words[size:]
+        return text
+
+    def _cached_tokens(self, request):
+        """
+        Look up the request's prompt in the prefix cache and add its prefixes to it.
+        The prompt is hashed block by block, and every block hash covers everything
+        before it, so only byte-identical prefixes match. Call with the lock held.
+
+        :return: The number of prompt tokens served from the cache
+        """
+        if not self.config.prefix_cache_min:
+            return 0
+        text = request.model + "".join(f"\n{m['role']}\n{m['content']}" for m in request.messages)
+        block = 4 * PREFIX_BLOCK_TOKENS  # about four characters per token
+        digest = hashlib.sha256()
+        cached, hit = 0, True
+        for start in range(0, len(text) - block + 1, block):
+            digest.update(text[start:start + block].encode("utf-8"))
+            key = digest.digest()
+            if hit and key in self.prefixes:
+                self.prefixes.move_to_end(key)
+                cached = start + block
+            else:
+                hit = False
+                self.prefixes[key] = True
+        while len(self.prefixes) > PREFIX_CACHE_ENTRIES:
+            self.prefixes.popitem(last=False)
+        tokens = cached // 4
+        return tokens if tokens >= self.config.prefix_cache_min else 0
+
+    def plan(self, request):
+        """
+        Decide the outcome of a request before any time is spent on it.
+
+        :param request: A ChatRequest
+        :return: A tuple (text, usage, time to first token, total delay)
+        :raises BackendError: If the simulated call fails
+        """
+        c = self.config
+        max_tokens = request.params.get("max_tokens") or request.params.get("max_completion_tokens")
+        response_format = request.params.get("response_format") or {}
+        with self.lock:
+            roll = self.random.random()
+            cached_tokens = self._cached_tokens(request)
+            if response_format.get("type") == "json_schema":
+                # Structured output: a random instance of the requested schema
+                text = json.dumps(sample_schema(response_format["json_schema"]["schema"], self.random))
+            else:
+                length = self.random.randint(max(1, c.completion_tokens // 2),
+                                             c.completion_tokens * 3 // 2)
+                text = self._filler_text(min(length, max_tokens or length))
+        if roll < c.rate_limit_rate:
+            raise RateLimitError("Stub rate limit exceeded", retry_after=c.latency)
+        if roll < c.rate_limit_rate + c.error_rate:
+            raise BackendError("Stub server error", status=500, retryable=True)
+
+        completion_tokens = len(text.split())
+        prompt_tokens = sum(estimate_tokens(m["content"]) + 4 for m in request.messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": min(cached_tokens, prompt_tokens),
+        }
+        # Cached prompt tokens do not have to be processed again, so the answer starts sooner
+        first_token = self.sample_latency() * (1 - 0.5 * usage["cached_tokens"] / prompt_tokens)
+        return text, usage, first_token, first_token + completion_tokens / c.tokens_per_second
+
+
+def stream_pieces(text):
+    """
+    Split a completion into the deltas of a stream: one word per token.
+    """
+    words = text.split(" ")
+    return [words[0]] + [" " + word for word in words[1:]]
+
+
+class StubBackend(Backend):
+    def __init__(self, config=None):
+        """
+        Serve requests in-process from a StubModel, sleeping to simulate latency.
+
+        :param config: A StubConfig; defaults to StubConfig()
+        """
+        self.model = StubModel(config)
+        self.batches = {}  # batch id -> (time when it completes, [(custom_id, ChatRequest)])
+
+    def send(self, request):
+        start = time.perf_counter()
+        text, usage, _, delay = self.model.plan(request)
+        time.sleep(delay)
+        return ChatResponse(text, model=request.model, usage=usage,
+                            latency=time.perf_counter() - start)
+
+    async def asend(self, request):
+        start = time.perf_counter()
+        text, usage, _, delay = self.model.plan(request)
+        await asyncio.sleep(delay)
+        return ChatResponse(text, model=request.model, usage=usage,
+                            latency=time.perf_counter() - start)
+
+    def stream(self, request):
+        start = time.perf_counter()
+        text, usage, first_token, _ = self.model.plan(request)
+        time.sleep(first_token)
+        ttft = time.perf_counter() - start
+        for piece in stream_pieces(text):
+            yield piece
+            time.sleep(1 / self.model.config.tokens_per_second)
+        yield ChatResponse(text, model=request.model, usage=usage,
+                           latency=time.perf_counter() - start, time_to_first_token=ttft)
+
+    async def astream(self, request):
+        start = time.perf_counter()
+        text, usage, first_token, _ = self.model.plan(request)
+        await asyncio.sleep(first_token)
+        ttft = time.perf_counter() - start
+        for piece in stream_pieces(text):
+            yield piece
+            await asyncio.sleep(1 / self.model.config.tokens_per_second)
+        yield ChatResponse(text, model=request.model, usage=usage,
+                           latency=time.perf_counter() - start, time_to_first_token=ttft)
+
+
+    async def submit_batch(self, path):
+        requests = []
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    record = json.loads(line)
+                    body = record["body"]
+                    params = {k: v for k, v in body.items() if k not in ("model", "messages")}
+                    requests.append((record["custom_id"],
+                                     ChatRequest(body["model"], body["messages"], params)))
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.batches[batch_id] = (time.monotonic() + self.model.config.batch_latency, requests)
+        return batch_id
+
+    async def batch_status(self, batch_id):
+        ready_at, _ = self.batches[batch_id]
+        return "completed" if time.monotonic() >= ready_at else "in_progress"
+
+    async def batch_results(self, batch_id):
+        _, requests = self.batches.pop(batch_id)
+        results = {}
+        for custom_id, request in requests:
+            try:
+                text, usage, _, _ = self.model.plan(request)
+                results[custom_id] = ChatResponse(text, model=request.model, usage=usage)
+            except BackendError as error:
+                results[custom_id] = error
+        return results
+
+
+def api_usage(usage):
+    """
+    The usage object of an API response, from the usage of StubModel.plan().
+    """
+    return {
+        "prompt_tokens": usage["prompt_tokens"],
+        "completion_tokens": usage["completion_tokens"],
+        "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"],
+        "prompt_tokens_details": {"cached_tokens": usage["cached_tokens"]},
+    }
+
+
+def make_handler(model):
+    """
+    Create an HTTP request handler class that answers /v1/chat/completions from `model`.
+    """
+    class StubHandler(BaseHTTPRequestHandler):
+        # Keep connections open between requests, as the real API does
+        protocol_version = "HTTP/1.1"
+        connections = 0  # connections accepted so far
+
+        def setup(self):
+            super().setup()
+            with model.lock:
+                StubHandler.connections += 1
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            params = {k: v for k, v in body.items() if k not in ("model", "messages")}
+            request = ChatRequest(body["model"], body["messages"], params)
+            try:
+                text, usage, first_token, delay = model.plan(request)
+            except RateLimitError as error:
+                self.reply(429, {"error": {"message": str(error), "type": "rate_limit_error"}},
+                           {"retry-after": f"{error.retry_after:.3f}"})
+                return
+            except BackendError as error:
+                self.reply(error.status, {"error": {"message": str(error), "type": "server_error"}})
+                return
+            if body.get("stream"):
+                include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+                self.stream_reply(request, text, usage, first_token, include_usage)
+                return
+            time.sleep(delay)
+            self.reply(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": text}}],
+                "usage": api_usage(usage),
+            })
+
+        def stream_reply(self, request, text, usage, first_token, include_usage):
+            """
+            Send the completion as Server-Sent Events, one chat.completion.chunk per
+            word, as the API does for "stream": true. The body is sent in chunked
+            transfer encoding, so that the connection can be kept for the next request.
+            """
+            chunk = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk",
+                     "created": int(time.time()), "model": request.model}
+            # Like the API, only the first delta names the role
+            deltas = [{"content": piece} for piece in stream_pieces(text)]
+            deltas[0]["role"] = "assistant"
+            events = [{**chunk, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                      for delta in deltas]
+            events.append({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if include_usage:
+                events.append({**chunk, "choices": [], "usage": api_usage(usage)})
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(first_token)
+            try:
+                for event in events:
+                    self.write_chunk(f"data: {json.dumps(event)}\n\n")
+                    if event["choices"] and event["choices"][0]["finish_reason"] is None:
+                        time.sleep(1 / model.config.tokens_per_second)
+                self.write_chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client closed the stream early (e.g., a stop predicate fired)
+                self.close_connection = True
+
+        def write_chunk(self, text):
+            data = text.encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def reply(self, status, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass  # Keep the console quiet; simulations print their own output
+
+    return StubHandler
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # Hundreds of agents connect at once; the default backlog of 5 would refuse them
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def serve(config=None, host="127.0.0.1", port=8000):
+    """
+    Run the stub as an OpenAI-compatible HTTP server until interrupted.
+    """
+    server = StubHTTPServer((host, port), make_handler(StubModel(config)))
+    print(f"Stub OpenAI server listening on http://{host}:{port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    defaults = StubConfig.from_env()
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI chat API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-dist", choices=LATENCY_DISTRIBUTIONS, default=defaults.latency_dist)
+    parser.add_argument("--latency", type=float, default=defaults.latency,
+                        help="median time to first token in seconds")
+    parser.add_argument("--latency-spread", type=float, default=defaults.latency_spread)
+    parser.add_argument("--tokens-per-sec", type=float, default=defaults.tokens_per_second)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--rate-limit-rate", type=float, default=defaults.rate_limit_rate)
+    parser.add_argument("--prefix-cache-min", type=int, default=defaults.prefix_cache_min)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args()
+
+    serve(StubConfig(latency_dist=args.latency_dist, latency=args.latency,
+                     latency_spread=args.latency_spread, tokens_per_second=args.tokens_per_sec,
+                     error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                     prefix_cache_min=args.prefix_cache_min, seed=args.seed),
+          host=args.host, port=args.port)
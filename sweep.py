@@ -0,0 +1,351 @@
+"""
+Run thousands of independent simulations across processes and hosts.
+
+Every script runs one simulation in one event loop on one core. A parameter sweep
+(many debates, conversations and comedy rounds with different temperatures, agent
+counts, round counts and seeds) is embarrassingly parallel, so this runner spreads
+it out:
+
+    python sweep.py add sweep.db --scripts presidential_debates,comedians-and-jury \\
+        --agents 3,10 --rounds 2,4 --temperature 0.2,0.8 --repeats 25
+    python sweep.py work sweep.db --processes 8      # on every host that should help
+    python sweep.py status sweep.db
+    python sweep.py export sweep.db results.jsonl
+
+The SQLite file is both the work queue and the result store. A worker claims one job
+at a time, so any number of workers (on hosts sharing the file) can drain the same
+queue. Each job runs in a pool process with its own event loop and its own backend,
+which is created once per process and reused for every job it runs. Finished jobs are
+never run again. Failed jobs are retried up to --max-attempts times, jobs of a worker
+that died are reclaimed once their lease expires, and `retry` re-queues jobs that
+failed for good. With LLM_RPM or LLM_TPM set, every process draws from one budget
+stored in the same file (see scheduler.SharedTokenBucket).
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import inspect
+import io
+import itertools
+import json
+import os
+import random
+import socket
+import sqlite3
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from benchmark import SCENARIOS, load_script, parse_list
+from llm_backend import BackendWrapper, ChatRequest, estimate_tokens, get_backend
+
+
+class SweepBackend(BackendWrapper):
+    """
+    A backend wrapper that applies a job's API parameters (e.g., temperature) to every
+    request and adds up the calls and tokens the job used.
+    """
+
+    def __init__(self, backend, params):
+        super().__init__(backend)
+        self.params = params
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def _prepare(self, request):
+        self.calls += 1
+        return ChatRequest(request.model, request.messages, {**request.params, **self.params},
+                           request.meta)
+
+    def _count(self, response):
+        self.prompt_tokens += response.usage.get("prompt_tokens", 0)
+        self.completion_tokens += response.usage.get("completion_tokens", 0)
+        return response
+
+    def _count_stopped(self, request, text):
+        # A stream closed by a stop predicate never delivers its usage; estimate it
+        self.prompt_tokens += sum(estimate_tokens(m["content"]) + 4 for m in request.messages)
+        self.completion_tokens += estimate_tokens(text)
+
+    def send(self, request):
+        return self._count(self.backend.send(self._prepare(request)))
+
+    async def asend(self, request):
+        return self._count(await self.backend.asend(self._prepare(request)))
+
+    def stream(self, request):
+        text, complete = "", False
+        try:
+            with contextlib.closing(self.backend.stream(self._prepare(request))) as chunks:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        text += chunk
+                    else:
+                        complete = self._count(chunk)
+                    yield chunk
+        finally:
+            if not complete and text:
+                self._count_stopped(request, text)
+
+    async def astream(self, request):
+        text, complete = "", False
+        try:
+            async with contextlib.aclosing(self.backend.astream(self._prepare(request))) as chunks:
+                async for chunk in chunks:
+                    if isinstance(chunk, str):
+                        text += chunk
+                    else:
+                        complete = self._count(chunk)
+                    yield chunk
+        finally:
+            if not complete and text:
+                self._count_stopped(request, text)
+
+
+def expand(scripts, agents, rounds, temperatures, repeats):
+    """
+    The jobs of a grid sweep: every combination of the given values, `repeats` times
+    with different seeds.
+
+    :return: A list of job specs (dicts)
+    """
+    return [
+        {"script": script, "agents": n, "rounds": r, "params": {"temperature": t}, "seed": seed}
+        for script, n, r, t, seed in itertools.product(scripts, agents, rounds, temperatures,
+                                                       range(repeats))
+    ]
+
+
+def job_id(spec):
+    """
+    A stable id for a job spec, so that adding the same sweep twice adds no jobs.
+    """
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class SweepStore:
+    def __init__(self, path):
+        """
+        The work queue and result store of a sweep, in one SQLite file.
+
+        :param path: The SQLite file; it is created if needed
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, spec TEXT, status TEXT, "
+            "attempts INTEGER, worker TEXT, claimed REAL, result TEXT, error TEXT)"
+        )
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never claim
+        # the same job
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def add(self, specs):
+        """
+        Queue jobs; jobs that are already in the store are left alone.
+
+        :return: The number of new jobs
+        """
+        with self._transaction() as db:
+            before = db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            db.executemany("INSERT OR IGNORE INTO jobs VALUES (?, ?, 'pending', 0, NULL, NULL, NULL, NULL)",
+                           [(job_id(spec), json.dumps(spec, sort_keys=True)) for spec in specs])
+            return db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] - before
+
+    def claim(self, worker, lease):
+        """
+        Take the next pending job. Jobs that have been running for longer than `lease`
+        seconds belong to a worker that died, and are pending again.
+
+        :return: A tuple (id, spec), or None if there is nothing left to do
+        """
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running' AND claimed < ?",
+                       (time.time() - lease,))
+            row = db.execute("SELECT id, spec FROM jobs WHERE status = 'pending' LIMIT 1").fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, "
+                       "claimed = ? WHERE id = ?", (worker, time.time(), row[0]))
+            return row[0], json.loads(row[1])
+
+    def finish(self, job, result):
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL WHERE id = ?",
+                       (json.dumps(result), job))
+
+    def fail(self, job, error, max_attempts):
+        """
+        Record a failure. The job is queued again unless it has used up its attempts.
+        """
+        with self._transaction() as db:
+            db.execute("UPDATE jobs SET status = CASE WHEN attempts < ? THEN 'pending' "
+                       "ELSE 'failed' END, error = ? WHERE id = ?", (max_attempts, error, job))
+
+    def retry(self):
+        """
+        Queue every job that failed for good again, with fresh attempts.
+
+        :return: The number of jobs queued
+        """
+        with self._transaction() as db:
+            return db.execute("UPDATE jobs SET status = 'pending', attempts = 0 "
+                              "WHERE status = 'failed'").rowcount
+
+    def counts(self):
+        """
+        The number of jobs per status.
+        """
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def results(self):
+        """
+        Yield (spec, result) for every finished job.
+        """
+        for spec, result in self.connection.execute(
+                "SELECT spec, result FROM jobs WHERE status = 'done' ORDER BY id"):
+            yield json.loads(spec), json.loads(result)
+
+
+# The backend and loaded scripts of a pool process, created once and reused by its jobs
+_process_backend = None
+_process_modules = {}
+
+
+def run_job(spec):
+    """
+    Run one simulation in the current process, with its own event loop.
+
+    :param spec: A job spec, as created by expand()
+    :return: A dict with the wall time, calls, tokens and the printed output
+    """
+    global _process_backend
+    if _process_backend is None:
+        _process_backend = get_backend()
+    filename, build = SCENARIOS[spec["script"]]
+    if filename not in _process_modules:
+        _process_modules[filename] = load_script(filename)
+    module = _process_modules[filename]
+    backend = SweepBackend(_process_backend, spec.get("params", {}))
+    module.backend = backend
+    random.seed(spec.get("seed"))
+    args = build(module, spec["agents"])
+
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        result = module.simulation_loop(*args, spec["rounds"])
+        if inspect.iscoroutine(result):
+            asyncio.run(result)
+    return {
+        "wall_time": time.perf_counter() - start,
+        "calls": backend.calls,
+        "prompt_tokens": backend.prompt_tokens,
+        "completion_tokens": backend.completion_tokens,
+        "output": output.getvalue(),
+    }
+
+
+def work(path, processes=None, lease=3600.0, max_attempts=3):
+    """
+    Drain the queue of a sweep with a pool of processes, until no job is pending.
+
+    :param path: The sweep's SQLite file
+    :param processes: The number of pool processes; defaults to the number of CPUs
+    :param lease: Seconds after which a running job is considered abandoned
+    :param max_attempts: How many times a job is tried before it counts as failed
+    :return: The number of jobs this worker finished
+    """
+    store = SweepStore(path)
+    processes = processes or os.cpu_count() or 1
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    if os.getenv("LLM_RPM") or os.getenv("LLM_TPM"):
+        # All pool processes, and the workers on other hosts, share one rate budget
+        os.environ.setdefault("LLM_RATE_STORE", os.path.abspath(path))
+
+    finished = 0
+    with ProcessPoolExecutor(processes) as pool:
+        running = {}
+        while True:
+            while len(running) < processes:
+                claimed = store.claim(worker, lease)
+                if claimed is None:
+                    break
+                running[pool.submit(run_job, claimed[1])] = claimed[0]
+            if not running:
+                return finished
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    store.finish(job, future.result())
+                    finished += 1
+                except Exception as error:
+                    store.fail(job, repr(error), max_attempts)
+                    print(f"Job {job} failed: {error!r}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run sweeps of independent simulations")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="queue the jobs of a grid sweep")
+    add.add_argument("store")
+    add.add_argument("--scripts", default=",".join(SCENARIOS),
+                     help="comma separated scenario names (see benchmark.py)")
+    add.add_argument("--agents", type=parse_list, default=[3])
+    add.add_argument("--rounds", type=parse_list, default=[2])
+    add.add_argument("--temperature", type=lambda text: [float(t) for t in text.split(",")],
+                     default=[1.0])
+    add.add_argument("--repeats", type=int, default=1, help="runs per combination")
+
+    run = commands.add_parser("work", help="run queued jobs until none is left")
+    run.add_argument("store")
+    run.add_argument("--processes", type=int, default=None)
+    run.add_argument("--lease", type=float, default=3600.0,
+                     help="seconds after which a running job of a dead worker is reclaimed")
+    run.add_argument("--max-attempts", type=int, default=3)
+
+    commands.add_parser("status", help="count the jobs per status").add_argument("store")
+    commands.add_parser("retry", help="queue failed jobs again").add_argument("store")
+
+    export = commands.add_parser("export", help="write the results as JSON lines")
+    export.add_argument("store")
+    export.add_argument("output")
+    args = parser.parse_args(argv)
+
+    if args.command == "add":
+        specs = expand(args.scripts.split(","), args.agents, args.rounds, args.temperature,
+                       args.repeats)
+        print(f"Queued {SweepStore(args.store).add(specs)} new jobs out of {len(specs)}")
+    elif args.command == "work":
+        finished = work(args.store, args.processes, args.lease, args.max_attempts)
+        print(f"Finished {finished} jobs")
+        print(SweepStore(args.store).counts())
+    elif args.command == "status":
+        print(SweepStore(args.store).counts())
+    elif args.command == "retry":
+        print(f"Queued {SweepStore(args.store).retry()} failed jobs again")
+    else:
+        count = 0
+        with open(args.output, "w", encoding="utf-8") as file:
+            for spec, result in SweepStore(args.store).results():
+                file.write(json.dumps({**spec, **result}) + "\n")
+                count += 1
+        print(f"Wrote {count} results to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
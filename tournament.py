@@ -0,0 +1,204 @@
+"""
+Judge a large field in small heats instead of one huge prompt.
+
+With 50 comedians, a single jury call reads 50 jokes: the prompt is long, the call
+is slow, and a model asked to compare that many options judges them badly. A
+Tournament splits the field into heats of LLM_TOURNAMENT_GROUP entries (2 by
+default). Heats run concurrently and are spread over several jury agents; only the
+levels of the schedule run one after another:
+
+- "bracket": single elimination. Heat winners advance until one is left, which
+  takes log_g(N) levels and about N / (g - 1) calls for N entries in heats of g.
+- "swiss": every entry judges in every level, against entries with the same number
+  of wins so far. log_g(N) levels of N / g heats give a full ranking, not only a
+  winner.
+
+Every heat updates an Elo rating per entry, which persists across the rounds of
+the simulation and is used to seed and pair the next heats. LLM_TOURNAMENT_CALLS
+bounds the number of judging calls per round: a bracket uses larger heats until its
+calls fit, and a Swiss tournament plays fewer levels (and uses larger heats only if
+a single level is too many calls).
+"""
+import asyncio
+import math
+import os
+
+SCHEDULES = ("bracket", "swiss")
+# How far a single heat moves the Elo ratings
+ELO_K = 32
+
+
+class Tournament:
+    def __init__(self, judges, schedule="swiss", group_size=2, max_calls=None):
+        """
+        Run judging tournaments and keep ratings across them.
+
+        :param judges: The jury agents; heats are spread over them in turn
+        :param schedule: "bracket" or "swiss"
+        :param group_size: The number of entries in a heat
+        :param max_calls: The most judging calls a tournament may make, or None
+        """
+        if schedule not in SCHEDULES:
+            raise ValueError(f"Unknown schedule: {schedule!r} (expected one of {SCHEDULES})")
+        if group_size < 2:
+            raise ValueError("A heat needs at least two entries")
+        self.judges = list(judges)
+        self.schedule = schedule
+        self.group_size = group_size
+        self.max_calls = max_calls
+        self.ratings = {}  # entry name -> Elo rating, across all tournaments
+        self.heat_size = group_size  # the heat size of the last tournament
+        self.calls = 0
+        self.levels = 0
+
+    @classmethod
+    def from_env(cls, judges):
+        """
+        A Tournament if LLM_TOURNAMENT names a schedule, or None for a single jury
+        call per round. LLM_TOURNAMENT_GROUP sets the heat size and
+        LLM_TOURNAMENT_CALLS the most judging calls per round.
+        """
+        schedule = os.getenv("LLM_TOURNAMENT")
+        if not schedule:
+            return None
+        calls = os.getenv("LLM_TOURNAMENT_CALLS")
+        return cls(judges, schedule=schedule.lower(),
+                   group_size=int(os.getenv("LLM_TOURNAMENT_GROUP", "2")),
+                   max_calls=int(calls) if calls else None)
+
+    def _rating(self, name):
+        return self.ratings.setdefault(name, 1000.0)
+
+    def _update(self, winner, heat):
+        """
+        Count a heat as a win of `winner` over every other entry of the heat.
+        """
+        for loser in heat:
+            if loser == winner:
+                continue
+            expected = 1 / (1 + 10 ** ((self._rating(loser) - self._rating(winner)) / 400))
+            self.ratings[winner] += ELO_K * (1 - expected)
+            self.ratings[loser] -= ELO_K * (1 - expected)
+
+    def _bracket_calls(self, entries, size):
+        """
+        The judging calls of a bracket of `entries` in heats of `size`.
+        """
+        calls = 0
+        while entries > 1:
+            heats = math.ceil(entries / size)
+            # Heats are filled evenly, so only a heat of one entry (a bye) is free
+            calls += heats - max(0, 2 * heats - entries)
+            entries = heats
+        return calls
+
+    def plan(self, entries):
+        """
+        The heat size and number of levels of a tournament of `entries`: heats are
+        made larger, and a Swiss tournament plays fewer levels, until the judging
+        calls fit in max_calls.
+        """
+        size = self.group_size
+        if self.schedule == "bracket":
+            while self.max_calls and size < entries and self._bracket_calls(entries, size) > self.max_calls:
+                size += 1
+            return size, max(1, math.ceil(math.log(entries, size))) if entries > 1 else 0
+        while self.max_calls and size < entries and math.ceil(entries / size) > self.max_calls:
+            size += 1
+        # Enough levels for a single entry to stay unbeaten
+        levels = max(1, math.ceil(math.log(entries, size))) if entries > 1 else 0
+        if self.max_calls:
+            levels = min(levels, max(1, self.max_calls // math.ceil(entries / size)))
+        return size, levels
+
+    async def _heats(self, heats, judge_heat):
+        """
+        Judge the heats of one level concurrently.
+
+        :return: The winner of each heat (None if its verdict was invalid, and the
+                 only entry of a bye)
+        """
+        async def judge(heat, judge_agent):
+            if len(heat) == 1:
+                return heat[0]  # a bye
+            return await judge_heat(judge_agent, heat)
+
+        judged = []
+        for heat in heats:
+            # The judges take turns, across levels and tournaments
+            judged.append(self.judges[self.calls % len(self.judges)] if len(heat) > 1 else None)
+            self.calls += len(heat) > 1
+        self.levels += 1
+        winners = await asyncio.gather(*(judge(heat, judge_agent)
+                                         for heat, judge_agent in zip(heats, judged)))
+        # Update the ratings in the order of the heats, not in the order the verdicts
+        # came back, so that the same verdicts always give the same ratings
+        for heat, winner in zip(heats, winners):
+            if len(heat) > 1 and winner is not None:
+                self._update(winner, heat)
+        return winners
+
+    def _split(self, names, size):
+        # Heats of equal size, as far as possible; an entry left alone gets a bye
+        count = math.ceil(len(names) / size)
+        return [names[i::count] for i in range(count)] if count else []
+
+    async def run(self, entries, judge_heat):
+        """
+        Play one tournament.
+
+        :param entries: The names of the entries (e.g., the comedians of a round)
+        :param judge_heat: An async function (judge, names of the heat) that returns
+                           the name of the winner, or None
+        :return: The standings, best first, as a list of (name, heats won, rating);
+                 byes do not count as heats won
+        """
+        wins = {name: 0 for name in entries}
+        size, levels = self.plan(len(entries))
+        self.heat_size = size
+        if self.schedule == "bracket":
+            # Seed by rating, so that the strongest entries meet last
+            alive = sorted(entries, key=self._rating, reverse=True)
+            while len(alive) > 1:
+                heats = self._split(alive, size)
+                winners = await self._heats(heats, judge_heat)
+                alive = []
+                for heat, winner in zip(heats, winners):
+                    # Only judged heats count as wins; without a valid verdict, the
+                    # higher rated entry goes through
+                    if len(heat) > 1 and winner is not None:
+                        wins[winner] += 1
+                    alive.append(winner or max(heat, key=self._rating))
+        else:
+            for _ in range(levels):
+                # Entries with the same number of wins meet each other
+                ranked = sorted(entries, key=lambda name: (wins[name], self._rating(name)),
+                                reverse=True)
+                heats = [ranked[i:i + size] for i in range(0, len(ranked), size)]
+                for heat, winner in zip(heats, await self._heats(heats, judge_heat)):
+                    if len(heat) > 1 and winner is not None:
+                        wins[winner] += 1
+        return sorted(((name, wins[name], self._rating(name)) for name in entries),
+                      key=lambda row: (row[1], row[2]), reverse=True)
+
+    def report(self, top=10):
+        """
+        The overall Elo ratings, best first, and the judging calls made.
+        """
+        ranked = sorted(self.ratings.items(), key=lambda item: -item[1])
+        width = max([len(name) for name, _ in ranked[:top]] + [5]) + 2
+        lines = [f"Tournament ({self.schedule}, heats of {self.heat_size}): {self.calls} "
+                 f"judging calls in {self.levels} levels",
+                 f"{'entry':<{width}}{'rating':>8}"]
+        lines += [f"{name:<{width}}{rating:>8.0f}" for name, rating in ranked[:top]]
+        if len(ranked) > top:
+            lines.append(f"... and {len(ranked) - top} more")
+        return "\n".join(lines)
+
+
+def print_tournament(tournament):
+    """
+    Print the ratings of a tournament, if one was played.
+    """
+    if tournament is not None and tournament.calls:
+        print(tournament.report())
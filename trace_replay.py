@@ -0,0 +1,420 @@
+"""
+Record every LLM exchange of a run, and replay it without the network.
+
+With LLM_RECORD=run.trace, every request and its response, latency, time to first
+token and token usage are appended to a trace file, one JSON line per call. With
+LLM_REPLAY=run.trace, the same script is answered from the trace instead: a 500-round
+debate reruns in seconds, so the orchestration overhead can be profiled, regressions
+can be bisected and tests are reproducible. LLM_REPLAY_SPEED chooses the timing:
+0 (the default) answers at once, 1 reproduces the recorded latencies and 10 replays
+ten times faster.
+
+Lookups use an index file next to the trace (run.trace.idx): a hash table of fixed
+size slots, memory-mapped, that maps a request's hash to the position of its record
+in the trace, which is memory-mapped too. Finding a response costs O(1) and nothing
+is loaded up front. The index is built on the first replay and rebuilt whenever the
+trace has grown. Identical requests are served in the order they were sent.
+
+Scripts that make random choices (e.g., which candidate answers first) only send the
+same requests again if the choices are the same, so recording seeds the global random
+generator and stores the seed in the trace, and replay restores it.
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from llm_backend import Backend, BackendError, BackendWrapper, ChatResponse, estimate_tokens
+
+
+class TraceIndex:
+    MAGIC = b"LLMTRIDX"
+    HEADER = struct.Struct("<8sQQ")  # magic, number of slots, size of the indexed trace
+    SLOT = struct.Struct("<16sQI4x")  # digest, offset of the record, length of the record
+
+    def __init__(self, path):
+        """
+        Open an index written by build().
+
+        :param path: The index file
+        """
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, self.trace_size = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{path} is not a trace index")
+
+    @staticmethod
+    def digest(key, occurrence):
+        """
+        The slot key of the `occurrence`-th request (counting from 0) with this hash.
+        """
+        return hashlib.sha256(f"{key}:{occurrence}".encode()).digest()[:16]
+
+    @classmethod
+    def build(cls, trace_path, index_path):
+        """
+        Scan a trace and write its index. The table is at most half full, so that
+        linear probing stays short.
+        """
+        entries = []
+        with open(trace_path, "rb") as file:
+            offset = 0
+            for line in file:
+                record = json.loads(line)
+                if "key" in record:
+                    entries.append((cls.digest(record["key"], record["occurrence"]),
+                                    offset, len(line)))
+                offset += len(line)
+        slots = 1
+        while slots < 2 * len(entries) + 1:
+            slots *= 2
+        table = bytearray(cls.HEADER.size + slots * cls.SLOT.size)
+        cls.HEADER.pack_into(table, 0, cls.MAGIC, slots, offset)
+        for digest, record_offset, length in entries:
+            slot = int.from_bytes(digest[:8], "little") & (slots - 1)
+            # Linear probing: a slot is free while its length is 0
+            while cls.SLOT.unpack_from(table, cls.HEADER.size + slot * cls.SLOT.size)[2]:
+                slot = (slot + 1) & (slots - 1)
+            cls.SLOT.pack_into(table, cls.HEADER.size + slot * cls.SLOT.size,
+                               digest, record_offset, length)
+        with open(index_path, "wb") as file:
+            file.write(table)
+
+    def find(self, key, occurrence):
+        """
+        The (offset, length) of a record in the trace, or None if it is not there.
+        """
+        digest = self.digest(key, occurrence)
+        slot = int.from_bytes(digest[:8], "little") & (self.slots - 1)
+        while True:
+            stored, offset, length = self.SLOT.unpack_from(
+                self.map, self.HEADER.size + slot * self.SLOT.size)
+            if length == 0:
+                return None
+            if stored == digest:
+                return offset, length
+            slot = (slot + 1) & (self.slots - 1)
+
+
+class RecordingBackend(BackendWrapper):
+    def __init__(self, backend, path, seed=None):
+        """
+        Append every successful exchange to a trace file.
+
+        :param backend: The backend that serves the requests
+        :param path: The trace file; an existing file is replaced
+        :param seed: The seed of the global random generator; chosen at random if None
+        """
+        super().__init__(backend)
+        self.path = path
+        self.seed = seed if seed is not None else random.randrange(2 ** 32)
+        random.seed(self.seed)
+        self.file = open(path, "w", encoding="utf-8")
+        self.file.write(json.dumps({"trace": 1, "seed": self.seed}) + "\n")
+        self.file.flush()
+        self.occurrences = defaultdict(int)
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def _reserve(self, request):
+        """
+        Number the request among identical ones when it is sent, as replay does. Numbered
+        on completion instead, identical requests that run concurrently would swap
+        their records. A call that fails keeps its number, and fails again on replay.
+        """
+        key = request.key()
+        with self.lock:
+            occurrence = self.occurrences[key]
+            self.occurrences[key] += 1
+        return occurrence
+
+    def _record(self, request, occurrence, response, started, latency, first_token=None):
+        with self.lock:
+            record = {
+                "key": request.key(),
+                "occurrence": occurrence,
+                "started": started - self.start,
+                "latency": latency,
+                "time_to_first_token": first_token,
+                "request": request.payload(),
+                "meta": request.meta,
+                "response": {"content": response.content, "model": response.model,
+                             "usage": response.usage, "finish_reason": response.finish_reason},
+            }
+            self.file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+            self.file.flush()
+
+    def send(self, request):
+        occurrence, started = self._reserve(request), time.perf_counter()
+        response = self.backend.send(request)
+        self._record(request, occurrence, response, started, time.perf_counter() - started)
+        return response
+
+    async def asend(self, request):
+        occurrence, started = self._reserve(request), time.perf_counter()
+        response = await self.backend.asend(request)
+        self._record(request, occurrence, response, started, time.perf_counter() - started)
+        return response
+
+    def _record_stream(self, request, occurrence, started, text, first_token, response):
+        if response is None:
+            # A stream closed early never reports its usage, so estimate it
+            usage = {"prompt_tokens": sum(estimate_tokens(m["content"]) + 4 for m in request.messages),
+                     "completion_tokens": estimate_tokens(text)}
+            response = ChatResponse(text, model=request.model, usage=usage, finish_reason="stopped")
+        self._record(request, occurrence, response, started, time.perf_counter() - started,
+                     first_token)
+
+    def stream(self, request):
+        occurrence = self._reserve(request)
+        started, text, first_token, response = time.perf_counter(), "", None, None
+        try:
+            with contextlib.closing(self.backend.stream(request)) as chunks:
+                for chunk in chunks:
+                    if isinstance(chunk, ChatResponse):
+                        response = chunk
+                    else:
+                        first_token = first_token or time.perf_counter() - started
+                        text += chunk
+                    yield chunk
+        except GeneratorExit:
+            # Closed early by a stop predicate (keep the text that was delivered), or
+            # by the caller as soon as it had the final response. Recorded even
+            # without text, since the request already has its occurrence number
+            self._record_stream(request, occurrence, started, text, first_token, response)
+            raise
+        self._record_stream(request, occurrence, started, text, first_token, response)
+
+    async def astream(self, request):
+        occurrence = self._reserve(request)
+        started, text, first_token, response = time.perf_counter(), "", None, None
+        try:
+            async with contextlib.aclosing(self.backend.astream(request)) as chunks:
+                async for chunk in chunks:
+                    if isinstance(chunk, ChatResponse):
+                        response = chunk
+                    else:
+                        first_token = first_token or time.perf_counter() - started
+                        text += chunk
+                    yield chunk
+        except GeneratorExit:
+            # Closed early by a stop predicate (keep the text that was delivered), or
+            # by the caller as soon as it had the final response. Recorded even
+            # without text, since the request already has its occurrence number
+            self._record_stream(request, occurrence, started, text, first_token, response)
+            raise
+        self._record_stream(request, occurrence, started, text, first_token, response)
+
+
+class ReplayBackend(Backend):
+    def __init__(self, path, speed=0.0, fallback=None):
+        """
+        Answer requests from a trace recorded by RecordingBackend.
+
+        :param path: The trace file
+        :param speed: 0 answers at once; otherwise the recorded latencies are divided
+                      by `speed` (1 replays in real time)
+        :param fallback: A backend for requests that are not in the trace; without it,
+                         they fail with a BackendError
+        """
+        self.path = path
+        self.speed = speed
+        self.fallback = fallback
+        self.occurrences = defaultdict(int)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        with open(path, "rb") as file:
+            header = json.loads(file.readline())
+            size = os.fstat(file.fileno()).st_size
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_path = path + ".idx"
+        index = TraceIndex(index_path) if os.path.exists(index_path) else None
+        if index is None or index.trace_size != size:
+            TraceIndex.build(path, index_path)
+            index = TraceIndex(index_path)
+        self.index = index
+        random.seed(header["seed"])
+
+    def _lookup(self, request):
+        """
+        The recorded exchange for a request, or None.
+        """
+        key = request.key()
+        with self.lock:
+            occurrence = self.occurrences[key]
+            self.occurrences[key] += 1
+        found = self.index.find(key, occurrence)
+        if found is None:
+            self.misses += 1
+            if self.fallback is None:
+                raise BackendError(f"Request {key[:12]} (occurrence {occurrence}) is not in the "
+                                   f"trace {self.path}")
+            return None
+        self.hits += 1
+        offset, length = found
+        return json.loads(self.map[offset:offset + length])
+
+    def _delay(self, seconds):
+        return seconds / self.speed if self.speed and seconds else 0.0
+
+    def _response(self, record):
+        response = record["response"]
+        return ChatResponse(response["content"], model=response["model"], usage=response["usage"],
+                            latency=self._delay(record["latency"]),
+                            finish_reason=response["finish_reason"],
+                            time_to_first_token=self._delay(record["time_to_first_token"]))
+
+    def _pieces(self, record):
+        """
+        The recorded text, split into word-sized deltas, with the delay before each.
+        """
+        words = record["response"]["content"].split(" ")
+        pieces = [words[0]] + [" " + word for word in words[1:]]
+        first = self._delay(record["time_to_first_token"] or record["latency"])
+        rest = max(self._delay(record["latency"]) - first, 0.0) / len(pieces)
+        return [(first if i == 0 else rest, piece) for i, piece in enumerate(pieces)]
+
+    def send(self, request):
+        record = self._lookup(request)
+        if record is None:
+            return self.fallback.send(request)
+        time.sleep(self._delay(record["latency"]))
+        return self._response(record)
+
+    async def asend(self, request):
+        record = self._lookup(request)
+        if record is None:
+            return await self.fallback.asend(request)
+        await asyncio.sleep(self._delay(record["latency"]))
+        return self._response(record)
+
+    def stream(self, request):
+        record = self._lookup(request)
+        if record is None:
+            yield from self.fallback.stream(request)
+            return
+        for delay, piece in self._pieces(record):
+            if delay:
+                time.sleep(delay)
+            yield piece
+        yield self._response(record)
+
+    async def astream(self, request):
+        record = self._lookup(request)
+        if record is None:
+            async for chunk in self.fallback.astream(request):
+                yield chunk
+            return
+        for delay, piece in self._pieces(record):
+            if delay:
+                await asyncio.sleep(delay)
+            yield piece
+        yield self._response(record)
+
+
+def replay_from_env():
+    """
+    A ReplayBackend if LLM_REPLAY names a trace file (timed by LLM_REPLAY_SPEED),
+    or None.
+    """
+    path = os.getenv("LLM_REPLAY")
+    if not path:
+        return None
+    return ReplayBackend(path, speed=float(os.getenv("LLM_REPLAY_SPEED", "0")))
+
+
+def record_from_env(backend):
+    """
+    Wrap `backend` in a RecordingBackend if LLM_RECORD names a trace file.
+    """
+    path = os.getenv("LLM_RECORD")
+    return RecordingBackend(backend, path) if path else backend
+
+
+def _transcript(path):
+    """
+    The records of a JSONL transcript (see transcript_sink.py), without their times.
+    """
+    with open(path, encoding="utf-8") as file:
+        return [{field: value for field, value in json.loads(line).items() if field != "time"}
+                for line in file]
+
+
+def check(script):
+    """
+    Record a run of a script, replay it, and compare the two transcripts.
+
+    :param script: A script that writes its transcript through a TranscriptSink
+    :return: None if the replay writes the same records, or a description of what differs
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        trace = os.path.join(folder, "run.trace")
+        transcripts = []
+        for name, variable in (("record", "LLM_RECORD"), ("replay", "LLM_REPLAY")):
+            transcript = os.path.join(folder, f"{name}.jsonl")
+            env = {key: value for key, value in os.environ.items()
+                   if key not in ("LLM_RECORD", "LLM_REPLAY")}
+            env.update({variable: trace, "LLM_TRANSCRIPT": transcript, "LLM_TRANSCRIPT_CONSOLE": "0"})
+            result = subprocess.run([sys.executable, script], env=env, capture_output=True, text=True)
+            if result.returncode:
+                return f"The {name} run failed:\n{result.stderr.strip()}"
+            if not os.path.exists(transcript):
+                return f"{script} writes no transcript (see transcript_sink.py)"
+            transcripts.append(_transcript(transcript))
+    # Scripts that write each line as soon as its call completes (e.g.,
+    # asynchronious-comedians.py) write them in another order when replay answers at
+    # once, so the records are compared regardless of their order
+    recorded, replayed = (Counter(json.dumps(record, sort_keys=True) for record in transcript)
+                          for transcript in transcripts)
+    missing = sorted((recorded - replayed).elements())
+    extra = sorted((replayed - recorded).elements())
+    if missing or extra:
+        return (f"{recorded.total()} records were recorded and {replayed.total()} replayed"
+                + "".join(f"\n  only recorded: {line}" for line in missing[:5])
+                + "".join(f"\n  only replayed: {line}" for line in extra[:5]))
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect a trace recorded with LLM_RECORD")
+    parser.add_argument("trace", nargs="?")
+    parser.add_argument("--check", metavar="SCRIPT",
+                        help="record and replay SCRIPT and compare the transcripts")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        problem = check(args.check)
+        print(problem or f"{args.check}: the replay reproduces the recorded run")
+        return 1 if problem else 0
+    if not args.trace:
+        parser.error("a trace or --check SCRIPT is required")
+    calls, prompt, completion, latency = 0, 0, 0, 0.0
+    with open(args.trace, encoding="utf-8") as file:
+        header = json.loads(file.readline())
+        for line in file:
+            record = json.loads(line)
+            calls += 1
+            prompt += record["response"]["usage"].get("prompt_tokens", 0)
+            completion += record["response"]["usage"].get("completion_tokens", 0)
+            latency += record["latency"]
+    TraceIndex.build(args.trace, args.trace + ".idx")
+    print(f"{args.trace}: seed {header['seed']}, {calls} calls, {prompt} prompt and "
+          f"{completion} completion tokens, {latency:.1f}s of call latency")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
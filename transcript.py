@@ -0,0 +1,241 @@
+"""
+A shared, append-only transcript with cheap per-agent views.
+
+Copying every response into every other agent's message list costs O(N^2) messages
+for N agents. Instead, all lines are appended once to a Transcript, and each agent
+holds a TranscriptView: the position at which it joined plus a function that builds
+its message list on demand. Own lines become "assistant" messages and everybody
+else's lines become "user" messages prefixed with the speaker's name.
+
+Records are compact: a speaker index and a running token total in typed arrays, and
+the (interned) text. Building a request costs O(window), not a copy of the history.
+"""
+import bisect
+import os
+import sys
+from array import array
+
+from context_window import STRATEGIES, TRIM_TO, LLMSummarizer, TokenCounter
+
+
+class Transcript:
+    def __init__(self, counter=None):
+        """
+        An append-only log of who said what.
+
+        :param counter: A TokenCounter used to count each line once; defaults to gpt-4o
+        """
+        self.counter = counter or TokenCounter()
+        self.speakers = []  # speaker index -> name
+        self.speaker_ids = {}  # name -> speaker index
+        self.speaker = array("I")  # record -> speaker index
+        self.texts = []  # record -> interned text
+        self.cumulative = array("Q", [0])  # record i spans tokens cumulative[i]..cumulative[i+1]
+        self.checkpointed = 0  # records before this position are in a checkpoint
+
+    def __len__(self):
+        return len(self.texts)
+
+    def append(self, name, text):
+        """
+        Record a line spoken by `name` and return its position in the transcript.
+        """
+        if name not in self.speaker_ids:
+            self.speaker_ids[name] = len(self.speakers)
+            self.speakers.append(sys.intern(name))
+        # The message is "Name: text" for other agents, so count the prefix too
+        tokens = self.counter.count(f"{name}: {text}") + 4
+        self.speaker.append(self.speaker_ids[name])
+        self.texts.append(sys.intern(text))
+        self.cumulative.append(self.cumulative[-1] + tokens)
+        return len(self.texts) - 1
+
+    def tokens(self, start, end):
+        """
+        The number of tokens of records start..end-1, in O(1).
+        """
+        return self.cumulative[end] - self.cumulative[start]
+
+    def checkpoint(self):
+        """
+        The lines appended since the last checkpoint (see checkpoint.py).
+        """
+        lines = [[self.speakers[self.speaker[i]], self.texts[i]]
+                 for i in range(self.checkpointed, len(self))]
+        self.checkpointed = len(self)
+        return lines
+
+    def restore(self, lines):
+        """
+        Append lines returned by checkpoint().
+        """
+        for name, text in lines:
+            self.append(name, text)
+        self.checkpointed = len(self)
+
+    def view(self, name, system_prompt, budget=3000, strategy="sliding", summarizer=None):
+        """
+        Create the view of an agent that joins the conversation now.
+
+        :param name: The agent's name, as used in append()
+        :param system_prompt: The agent's system prompt
+        :param budget: The maximum number of prompt tokens per request
+        :param strategy: "sliding" or "summarize" (see context_window.py)
+        :param summarizer: An LLMSummarizer, required by the "summarize" strategy
+        """
+        return TranscriptView(self, name, system_prompt, budget, strategy, summarizer)
+
+    def view_from_env(self, name, system_prompt, backend):
+        """
+        Like view(), configured by LLM_CONTEXT_BUDGET and LLM_CONTEXT_STRATEGY.
+        """
+        strategy = os.getenv("LLM_CONTEXT_STRATEGY", "sliding")
+        return self.view(name, system_prompt,
+                         budget=int(os.getenv("LLM_CONTEXT_BUDGET", "3000")),
+                         strategy=strategy,
+                         summarizer=LLMSummarizer(backend) if strategy == "summarize" else None)
+
+
+class TranscriptView:
+    def __init__(self, transcript, name, system_prompt, budget, strategy, summarizer):
+        """
+        One agent's window onto a shared Transcript. Use Transcript.view() to create it.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy: {strategy!r} (expected one of {STRATEGIES})")
+        if strategy == "summarize" and summarizer is None:
+            raise ValueError("The 'summarize' strategy needs a summarizer")
+        self.transcript = transcript
+        self.name = name
+        self.system = {"role": "system", "content": system_prompt}
+        self.system_tokens = transcript.counter.count_message(self.system)
+        self.budget = budget
+        self.strategy = strategy
+        self.summarizer = summarizer
+        self.offset = len(transcript)  # the agent only sees what was said after it joined
+        self.memo = ""
+        self.memo_tokens = 0
+        self.memo_end = self.offset  # records before this position are in the memo
+        self.window_start = self.offset  # the first record of the sliding window
+        self.rounds = []
+        self._saved = (0, "")  # requests and memo at the last checkpoint
+
+    def _window_start(self, budget):
+        """
+        The first record that still fits in `budget` tokens, found by binary search
+        over the running token totals. The newest record is always included.
+        """
+        transcript = self.transcript
+        end = len(transcript)
+        available = budget - self.system_tokens - self.memo_tokens
+        # Smallest start with cumulative[end] - cumulative[start] <= available
+        start = bisect.bisect_left(transcript.cumulative, transcript.cumulative[end] - available,
+                                   lo=self.memo_end, hi=end + 1)
+        return min(start, max(end - 1, self.memo_end))
+
+    def _sliding_start(self):
+        """
+        The first record to send. The window only moves when it is over budget, and
+        then down to TRIM_TO of the budget, so that consecutive requests share a prefix.
+        """
+        start = max(self.window_start, self.memo_end)
+        if self._window_start(self.budget) > start:
+            start = self._window_start(int(self.budget * TRIM_TO))
+        self.window_start = start
+        return start
+
+    def _to_fold(self):
+        """
+        With the "summarize" strategy, the range of records to fold into the memo when
+        the window is over budget. Folding goes down to half the budget, so that a
+        summary is not needed on every turn.
+        """
+        if self.strategy != "summarize" or self._window_start(self.budget) == self.memo_end:
+            return None
+        return self.memo_end, self._window_start(self.budget // 2)
+
+    def _fold_text(self, start, end):
+        transcript = self.transcript
+        return [{"role": "user", "content": f"{transcript.speakers[transcript.speaker[i]]}: "
+                                            f"{transcript.texts[i]}"}
+                for i in range(start, end)]
+
+    def _set_memo(self, memo, end):
+        self.memo = memo
+        self.memo_end = end
+        self.memo_tokens = (self.transcript.counter.count_message(self._memo_message())
+                            if memo else 0)
+
+    def _memo_message(self):
+        return {"role": "system", "content": f"Summary of the earlier conversation: {self.memo}"}
+
+    def _messages(self):
+        transcript = self.transcript
+        end = len(transcript)
+        start = self._sliding_start()
+        own = transcript.speaker_ids.get(self.name)
+        messages = [self.system]
+        if self.memo:
+            messages.append(self._memo_message())
+        for i in range(start, end):
+            speaker = transcript.speaker[i]
+            if speaker == own:
+                messages.append({"role": "assistant", "content": transcript.texts[i]})
+            else:
+                messages.append({"role": "user",
+                                 "content": f"{transcript.speakers[speaker]}: {transcript.texts[i]}"})
+        full = self.system_tokens + transcript.tokens(self.offset, end)
+        sent = self.system_tokens + self.memo_tokens + transcript.tokens(start, end)
+        self.rounds.append({"full": full, "sent": sent, "saved": full - sent})
+        return messages
+
+    def messages(self):
+        """
+        Build the agent's message list for its next request.
+        """
+        fold = self._to_fold()
+        if fold:
+            self._set_memo(self.summarizer.summarize(self.memo, self._fold_text(*fold)), fold[1])
+        return self._messages()
+
+    async def amessages(self):
+        """
+        The asynchronous counterpart of messages().
+        """
+        fold = self._to_fold()
+        if fold:
+            memo = await self.summarizer.asummarize(self.memo, self._fold_text(*fold))
+            self._set_memo(memo, fold[1])
+        return self._messages()
+
+    def savings(self):
+        """
+        Total prompt tokens sent, and saved compared with sending the full history.
+        """
+        sent = sum(r["sent"] for r in self.rounds)
+        saved = sum(r["saved"] for r in self.rounds)
+        return {"requests": len(self.rounds), "sent": sent, "saved": saved}
+
+    def checkpoint(self):
+        """
+        The changes to the view since the last checkpoint (see checkpoint.py). The
+        lines themselves are in the Transcript's checkpoint.
+        """
+        requests, memo = self._saved
+        changes = {"window_start": self.window_start, "memo_end": self.memo_end,
+                   "rounds": self.rounds[requests:]}
+        if self.memo != memo:
+            changes["memo"] = self.memo
+        self._saved = (len(self.rounds), self.memo)
+        return changes
+
+    def restore(self, changes):
+        """
+        Apply changes returned by checkpoint().
+        """
+        self.window_start = changes["window_start"]
+        self.rounds.extend(changes["rounds"])
+        if "memo" in changes:
+            self._set_memo(changes["memo"], changes["memo_end"])
+        self.memo_end = changes["memo_end"]
+        self._saved = (len(self.rounds), self.memo)
@@ -0,0 +1,218 @@
+"""
+Write the transcript of a simulation without blocking the event loop.
+
+The scripts used to print every line as it was produced, from inside the turns. A
+print is a blocking write, so a slow terminal (or a pipe nobody reads) stalls
+every agent, and once printed nothing is left to analyze. A TranscriptSink takes
+structured records instead:
+
+    await sink.emit("Groucho Marx", joke, round=2, kind="joke")
+
+emit() puts the record in a bounded queue and returns at once. A writer task takes
+the records in batches and appends them to a file in a worker thread: JSON lines
+(LLM_TRANSCRIPT=run.jsonl) or Parquet (LLM_TRANSCRIPT=run.parquet, needs pyarrow),
+which pandas, DuckDB or Polars read directly. A second task renders the records on
+the console; LLM_TRANSCRIPT_CONSOLE=0 turns it off for large runs. When a queue is
+full (LLM_TRANSCRIPT_BUFFER records, 1000 by default), emit() waits until the
+writer catches up, so memory stays bounded and the simulation slows down instead.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# The columns of every record; anything else passed to emit() goes in "extra"
+FIELDS = ("time", "round", "speaker", "kind", "text")
+# Parquet files are written in row groups of this many records
+ROW_GROUP = 10_000
+
+
+def render_line(record):
+    """
+    The default console rendering of a record: "speaker: text".
+    """
+    return f"{record['speaker']}: {record['text']}"
+
+
+class _JsonlWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write(self, records):
+        self.file.write("".join(json.dumps(record, ensure_ascii=False, default=str) + "\n"
+                                for record in records))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetWriter:
+    def __init__(self, path):
+        self.schema = pyarrow.schema([("time", pyarrow.float64()), ("round", pyarrow.int64()),
+                                      ("speaker", pyarrow.string()), ("kind", pyarrow.string()),
+                                      ("text", pyarrow.string()), ("extra", pyarrow.string())])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.columns = {name: [] for name in self.schema.names}
+
+    def write(self, records):
+        for record in records:
+            for field in FIELDS:
+                self.columns[field].append(record.get(field))
+            extra = {key: value for key, value in record.items() if key not in FIELDS}
+            self.columns["extra"].append(json.dumps(extra, ensure_ascii=False, default=str)
+                                         if extra else None)
+        if len(self.columns["time"]) >= ROW_GROUP:
+            self._flush()
+
+    def _flush(self):
+        if self.columns["time"]:
+            self.writer.write_table(pyarrow.table(self.columns, schema=self.schema))
+            self.columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+class TranscriptSink:
+    def __init__(self, path=None, console=True, render=render_line, buffer=1000, batch=256):
+        """
+        Collect transcript records and write them from background tasks.
+
+        :param path: The file to write, JSON lines or ".parquet"; None writes no file
+        :param console: Whether to render the records on stdout
+        :param render: A function that turns a record into the text to print, or None
+                       to print nothing for it
+        :param buffer: The number of records each queue holds before emit() waits
+        :param batch: The largest number of records written at once
+        """
+        if path and path.endswith(".parquet") and pyarrow is None:
+            raise ImportError("Writing a Parquet transcript requires pyarrow (pip install pyarrow)")
+        self.path = path
+        self.console = console
+        self.render = render
+        self.buffer = buffer
+        self.batch = batch
+        self.queues = []
+        self.tasks = []
+        self.records = 0
+        self.batches = 0
+        self.blocked = 0.0  # seconds emit() waited for a full queue
+        self.start = None
+
+    @classmethod
+    def from_env(cls, render=render_line):
+        """
+        A TranscriptSink configured from LLM_TRANSCRIPT, LLM_TRANSCRIPT_CONSOLE and
+        LLM_TRANSCRIPT_BUFFER (see the module docstring).
+        """
+        return cls(path=os.getenv("LLM_TRANSCRIPT") or None,
+                   console=os.getenv("LLM_TRANSCRIPT_CONSOLE", "1").lower() not in ("0", "false", "no"),
+                   render=render,
+                   buffer=int(os.getenv("LLM_TRANSCRIPT_BUFFER", "1000")))
+
+    async def __aenter__(self):
+        self.start = time.perf_counter()
+        if self.path:
+            writer = _ParquetWriter(self.path) if self.path.endswith(".parquet") else _JsonlWriter(self.path)
+            self._consume(self._write_file, writer)
+        if self.console:
+            self._consume(self._write_console, None)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _consume(self, write, writer):
+        queue = asyncio.Queue(maxsize=self.buffer)
+        self.queues.append(queue)
+        self.tasks.append(asyncio.create_task(self._drain(queue, write, writer)))
+
+    async def _drain(self, queue, write, writer):
+        # Take whatever is waiting, up to a batch, so that a burst of records costs
+        # one write instead of one per record; None marks the end of the transcript
+        done = False
+        while not done:
+            records = [await queue.get()]
+            while len(records) < self.batch and not queue.empty():
+                records.append(queue.get_nowait())
+            if records[-1] is None:
+                records.pop()
+                done = True
+            if records:
+                # The write runs in a thread, so the agents keep going meanwhile
+                await asyncio.to_thread(write, writer, records)
+                if writer is not None:
+                    self.batches += 1
+        if writer is not None:
+            await asyncio.to_thread(writer.close)
+
+    @staticmethod
+    def _write_file(writer, records):
+        writer.write(records)
+
+    def _write_console(self, writer, records):
+        lines = [line for line in map(self.render, records) if line is not None]
+        if lines:
+            # Look up sys.stdout now, so that redirect_stdout() applies
+            sys.stdout.write("".join(line + "\n" for line in lines))
+            sys.stdout.flush()
+
+    async def emit(self, speaker, text, round=None, kind="line", **extra):
+        """
+        Add a record to the transcript. Returns at once unless a queue is full.
+
+        :param speaker: Who said it (an agent's name)
+        :param text: What was said
+        :param round: The round it belongs to
+        :param kind: What it is, e.g. "question", "answer" or "verdict"
+        :param extra: More fields to store with the record (e.g., winner="Groucho Marx")
+        """
+        record = {"time": _round_time(time.perf_counter() - self.start), "round": round,
+                  "speaker": speaker, "kind": kind, "text": text, **extra}
+        self.records += 1
+        for queue, task in zip(self.queues, self.tasks):
+            if queue.full():
+                if task.done():
+                    task.result()  # a writer that failed would never empty its queue
+                waited = time.perf_counter()
+                await queue.put(record)
+                self.blocked += time.perf_counter() - waited
+            else:
+                queue.put_nowait(record)
+
+    async def close(self):
+        """
+        Write everything that is still queued and stop the background tasks.
+        """
+        for queue in self.queues:
+            await queue.put(None)
+        await asyncio.gather(*self.tasks)
+        self.queues, self.tasks = [], []
+
+    def report(self):
+        """
+        A one-line summary of what was written.
+        """
+        return (f"Transcript: {self.records} records in {self.batches} batches to {self.path}, "
+                f"{self.blocked:.2f}s waiting for a full buffer")
+
+
+def _round_time(seconds):
+    return round(seconds, 4)
+
+
+def print_transcript(sink):
+    """
+    Print what a sink wrote to its file, if it wrote one.
+    """
+    if sink is not None and sink.path:
+        print(sink.report())
@@ -0,0 +1,134 @@
+"""
+Run a simulation as a dependency graph of agent turns.
+
+A simulation loop that awaits every step in turn takes the sum of all call latencies,
+even when steps do not depend on each other: the moderator's next question does not
+depend on the audience's reaction, and the jury judging round N does not stop the
+comedians from writing round N+1. A TurnGraph declares each turn with the turns whose
+results it needs, and run() starts every turn as soon as its inputs are ready. The
+wall time then approaches the critical path, the longest chain of dependent turns.
+
+With a Checkpoint (see checkpoint.py), every completed turn is recorded, and a
+resumed run restores the turns that were completed instead of running them again.
+"""
+import asyncio
+import time
+
+
+class TurnGraph:
+    def __init__(self, checkpoint=None):
+        """
+        An empty graph. Add turns with add() and execute them with run().
+
+        :param checkpoint: An optional Checkpoint that records completed turns
+        """
+        self.checkpoint = checkpoint
+        self.actions = {}
+        self.deps = {}
+        self.state = {}
+        self.dependents = {}
+        self.results = {}
+        self.started = {}
+        self.finished = {}
+
+    def add(self, name, action, deps=(), state=(), checkpoint=True):
+        """
+        Declare a turn.
+
+        :param name: A unique name for the turn (e.g., "question 2")
+        :param action: An async function that receives a dict mapping each dependency's
+                       name to its result, and returns this turn's result
+        :param deps: Names of the turns that must finish first; they must already exist
+        :param state: The objects the turn changes, such as the agent's context window;
+                      their changes are checkpointed with the turn's result
+        :param checkpoint: False for turns that are cheap to run again when the run is
+                           resumed, such as printing a round
+        :return: The name, so that it can be used in the deps of later turns
+        """
+        if name in self.actions:
+            raise ValueError(f"Duplicate turn: {name!r}")
+        for dep in deps:
+            if dep not in self.actions:
+                raise ValueError(f"Turn {name!r} depends on unknown turn {dep!r}")
+        self.actions[name] = action
+        self.deps[name] = tuple(deps)
+        self.state[name] = tuple(state) if checkpoint else None
+        self.dependents[name] = []
+        for dep in deps:
+            self.dependents[dep].append(name)
+        return name
+
+    async def _run_turn(self, name):
+        inputs = {dep: self.results[dep] for dep in self.deps[name]}
+        self.started[name] = time.perf_counter()
+        try:
+            if self.checkpoint is None or self.state[name] is None:
+                self.results[name] = await self.actions[name](inputs)
+            else:
+                self.results[name] = await self.checkpoint.arun(
+                    name, lambda: self.actions[name](inputs), self.state[name])
+        finally:
+            self.finished[name] = time.perf_counter()
+        return name
+
+    async def run(self):
+        """
+        Execute every turn, running all turns whose dependencies are met concurrently.
+        If a turn fails, the turns still running are cancelled and the error is raised.
+
+        :return: A dict mapping each turn's name to its result
+        """
+        waiting = {name: len(deps) for name, deps in self.deps.items()}
+        running = {asyncio.ensure_future(self._run_turn(name))
+                   for name, count in waiting.items() if count == 0}
+        try:
+            while running:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = task.result()
+                    for dependent in self.dependents[name]:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            running.add(asyncio.ensure_future(self._run_turn(dependent)))
+        finally:
+            for task in running:
+                task.cancel()
+        return self.results
+
+    def duration(self, name):
+        return self.finished[name] - self.started[name]
+
+    def critical_path(self):
+        """
+        The chain of dependent turns with the largest total duration.
+
+        :return: A tuple (total seconds, list of turn names in order)
+        """
+        # Turns were added after their dependencies, so insertion order is topological
+        best = {}
+        for name in self.actions:
+            previous = max(self.deps[name], key=lambda dep: best[dep][0], default=None)
+            length = self.duration(name) + (best[previous][0] if previous else 0.0)
+            best[name] = (length, previous)
+        if not best:
+            return 0.0, []
+        name = max(best, key=lambda n: best[n][0])
+        length, path = best[name][0], []
+        while name is not None:
+            path.append(name)
+            name = best[name][1]
+        return length, path[::-1]
+
+    def report(self):
+        """
+        A short summary comparing the wall time with the critical path and the
+        sum of all turn durations (what a strictly sequential loop would take).
+        """
+        if not self.finished:
+            return "No turns were run."
+        wall = max(self.finished.values()) - min(self.started.values())
+        total = sum(self.duration(name) for name in self.finished)
+        length, path = self.critical_path()
+        return (f"{len(self.finished)} turns, wall time {wall:.2f}s, "
+                f"critical path {length:.2f}s over {len(path)} turns, "
+                f"sum of all turns {total:.2f}s")
@@ -0,0 +1,302 @@
+"""
+Structured verdicts from judge agents, aggregated with NumPy.
+
+A jury that answers in free text is pleasant to read but hard to count: statistics
+over thousands of rounds mean a slow and fragile regex pass after the run. With a
+VerdictTable, judges are asked for JSON that follows a schema (the winner, a score
+for every candidate, a confidence and a one-sentence reason), and each verdict is
+stored as a row of numbers. Win rates with confidence intervals, mean scores,
+Bradley-Terry ratings on the Elo scale and per-segment or per-round breakdowns are
+then computed on whole arrays at once. A verdict may also be about some of the
+candidates only (e.g., a heat of a tournament, see tournament.py); it then only
+counts for those who took part.
+"""
+import json
+import os
+
+import numpy as np
+
+INSTRUCTIONS = (
+    "Answer in JSON with the winner, a score from 0 to 10 for every candidate, "
+    "your confidence in the verdict from 0 to 1, and a one-sentence reason."
+)
+
+
+def verdict_schema(candidates):
+    """
+    The JSON schema of a verdict about `candidates` (a list of names).
+    """
+    return {
+        "type": "object",
+        "properties": {
+            "winner": {"type": "string", "enum": list(candidates)},
+            "scores": {
+                "type": "object",
+                "properties": {name: {"type": "number", "minimum": 0, "maximum": 10}
+                               for name in candidates},
+                "required": list(candidates),
+                "additionalProperties": False,
+            },
+            "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+            "reason": {"type": "string"},
+        },
+        "required": ["winner", "scores", "confidence", "reason"],
+        "additionalProperties": False,
+    }
+
+
+def parse_verdict(text, candidates):
+    """
+    Read a verdict from a model response.
+
+    :return: A dict with "winner", "scores" (name -> float), "confidence" and "reason"
+    :raises ValueError: If the text is not a valid verdict about `candidates`
+    """
+    text = text.strip()
+    if text.startswith("```"):
+        # Models without schema support like to wrap JSON in a code fence
+        text = text.strip("`").removeprefix("json").strip()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as error:
+        raise ValueError(f"Verdict is not JSON: {error}") from error
+    if not isinstance(data, dict) or data.get("winner") not in candidates:
+        raise ValueError(f"Verdict names no valid winner: {text[:80]!r}")
+    scores = data.get("scores") or {}
+    try:
+        return {
+            "winner": data["winner"],
+            "scores": {name: float(scores[name]) for name in candidates},
+            "confidence": min(max(float(data.get("confidence", 1.0)), 0.0), 1.0),
+            "reason": str(data.get("reason", "")),
+        }
+    except (KeyError, TypeError, ValueError) as error:
+        raise ValueError(f"Verdict has invalid scores: {text[:80]!r}") from error
+
+
+def format_verdict(verdict):
+    """
+    A one-paragraph, human-readable rendering of a parsed verdict.
+    """
+    scores = ", ".join(f"{name} {score:g}" for name, score in verdict["scores"].items())
+    return (f"{verdict['winner']} wins (confidence {verdict['confidence']:.0%}; "
+            f"scores: {scores}). {verdict['reason']}")
+
+
+class VerdictTable:
+    def __init__(self, candidates, segments=("all",)):
+        """
+        Collect verdicts about a fixed set of candidates.
+
+        :param candidates: The names the judges choose from
+        :param segments: Names of the groups judges belong to (e.g., audience templates)
+        """
+        self.candidates = list(candidates)
+        self.segments = list(segments)
+        self.rounds = []
+        self.segment_ids = []
+        self.winners = []
+        self.scores = []
+        self.confidence = []
+        self.weights = []
+        self.invalid = 0
+        self._saved = (0, 0)  # verdicts and invalid responses at the last checkpoint
+
+    @classmethod
+    def from_env(cls, candidates, segments=("all",)):
+        """
+        Create a table if LLM_VERDICTS is set to "json", or return None for the
+        default free-text verdicts.
+        """
+        if os.getenv("LLM_VERDICTS", "text").lower() != "json":
+            return None
+        return cls(candidates, segments)
+
+    def response_format(self, candidates=None):
+        """
+        The response_format parameter that makes the model follow the verdict schema.
+
+        :param candidates: The candidates the verdict is about; by default all of them
+        """
+        return {"type": "json_schema",
+                "json_schema": {"name": "verdict", "strict": True,
+                                "schema": verdict_schema(candidates or self.candidates)}}
+
+    def add(self, round_num, text, segment=0, weight=1.0, candidates=None):
+        """
+        Parse a judge's response and record it.
+
+        :param round_num: The round the verdict is about
+        :param text: The JSON response of the judge
+        :param segment: The index of the judge's segment
+        :param weight: How many judges this one stands for (see population.py)
+        :param candidates: The candidates the judge chose from; by default all of them
+        :return: The parsed verdict, or None if the response was not a valid verdict
+        """
+        candidates = candidates or self.candidates
+        try:
+            verdict = parse_verdict(text, candidates)
+        except ValueError:
+            self.invalid += 1
+            return None
+        self.rounds.append(round_num)
+        self.segment_ids.append(segment)
+        self.winners.append(self.candidates.index(verdict["winner"]))
+        # Candidates who did not take part get no score
+        self.scores.append([verdict["scores"].get(name, float("nan")) for name in self.candidates])
+        self.confidence.append(verdict["confidence"])
+        self.weights.append(weight)
+        return verdict
+
+    def __len__(self):
+        return len(self.winners)
+
+    def checkpoint(self):
+        """
+        The verdicts added since the last checkpoint (see checkpoint.py).
+        """
+        count, invalid = self._saved
+        rows = [list(row) for row in zip(self.rounds[count:], self.segment_ids[count:],
+                                         self.winners[count:], self.scores[count:],
+                                         self.confidence[count:], self.weights[count:])]
+        self._saved = (len(self), self.invalid)
+        return {"rows": rows, "invalid": self.invalid - invalid}
+
+    def restore(self, changes):
+        """
+        Add verdicts returned by checkpoint().
+        """
+        for round_num, segment, winner, scores, confidence, weight in changes["rows"]:
+            self.rounds.append(round_num)
+            self.segment_ids.append(segment)
+            self.winners.append(winner)
+            self.scores.append(scores)
+            self.confidence.append(confidence)
+            self.weights.append(weight)
+        self.invalid += changes["invalid"]
+        self._saved = (len(self), self.invalid)
+
+    def arrays(self):
+        """
+        The verdicts as NumPy arrays: rounds, segments, winners (candidate indexes),
+        scores (one column per candidate, NaN for those who did not take part),
+        present (whether each candidate took part), confidence and weights.
+        """
+        return {
+            "rounds": np.asarray(self.rounds, dtype=np.int32),
+            "segments": np.asarray(self.segment_ids, dtype=np.int16),
+            "winners": np.asarray(self.winners, dtype=np.int16),
+            "scores": np.asarray(self.scores, dtype=np.float32).reshape(-1, len(self.candidates)),
+            "present": ~np.isnan(np.asarray(self.scores, dtype=np.float32)).reshape(
+                -1, len(self.candidates)),
+            "confidence": np.asarray(self.confidence, dtype=np.float32),
+            "weights": np.asarray(self.weights, dtype=np.float64),
+        }
+
+    def _wins(self, arrays):
+        """
+        A (verdicts x candidates) matrix with 1 where the candidate won.
+        """
+        return arrays["winners"][:, None] == np.arange(len(self.candidates))
+
+    def win_rates(self, z=1.96):
+        """
+        The weighted share of the verdicts each candidate took part in that it won,
+        with a Wilson score confidence interval based on the effective sample size of
+        the weights. Unlike the plain normal approximation, it stays meaningful for few
+        verdicts and for rates close to 0 or 1.
+
+        :param z: The z-score of the interval; 1.96 gives 95%
+        :return: Three arrays with one entry per candidate: rates, lower and upper bounds
+        """
+        arrays = self.arrays()
+        weights = arrays["weights"]
+        if not len(weights):
+            empty = np.full(len(self.candidates), np.nan)
+            return empty, empty, empty
+        present = arrays["present"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rates = weights @ self._wins(arrays) / (weights @ present)
+            effective = (weights @ present) ** 2 / (weights ** 2 @ present)
+        denominator = 1 + z ** 2 / effective
+        center = (rates + z ** 2 / (2 * effective)) / denominator
+        margin = z / denominator * np.sqrt(rates * (1 - rates) / effective
+                                           + z ** 2 / (4 * effective ** 2))
+        return rates, np.clip(center - margin, 0, 1), np.clip(center + margin, 0, 1)
+
+    def mean_scores(self):
+        """
+        The weighted mean score of each candidate, over the verdicts it took part in.
+        """
+        arrays = self.arrays()
+        if not len(arrays["weights"]):
+            return np.full(len(self.candidates), np.nan)
+        weights = arrays["weights"][:, None] * arrays["present"]
+        with np.errstate(invalid="ignore"):
+            return np.nansum(arrays["scores"] * weights, axis=0) / weights.sum(axis=0)
+
+    def breakdown(self, by="segment"):
+        """
+        Win rates per segment or per round, over the verdicts each candidate took
+        part in.
+
+        :param by: "segment" or "round"
+        :return: A tuple (group labels, matrix with one row per group and one column
+                 per candidate)
+        """
+        arrays = self.arrays()
+        groups = arrays["segments"] if by == "segment" else arrays["rounds"]
+        labels, index = np.unique(groups, return_inverse=True)
+        totals = np.zeros((len(labels), len(self.candidates)))
+        np.add.at(totals, (index, arrays["winners"]), arrays["weights"])
+        present = np.zeros((len(labels), len(self.candidates)))
+        np.add.at(present, index, arrays["weights"][:, None] * arrays["present"])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rates = totals / present
+        if by == "segment":
+            labels = [self.segments[label] for label in labels]
+        return list(labels), rates
+
+    def ratings(self, iterations=200, prior=1.0):
+        """
+        Bradley-Terry strengths on the Elo scale (1000 is average). Every verdict counts
+        as a win of its winner over each other candidate that took part in it. The
+        strengths are fitted with the minorization-maximization algorithm, and `prior`
+        pseudo-wins in each direction keep candidates who never won (or never lost)
+        finite.
+        """
+        arrays = self.arrays()
+        wins_matrix = self._wins(arrays)
+        weighted = wins_matrix * arrays["weights"][:, None]
+        # wins[i, j]: weighted number of verdicts in which i won and j took part
+        wins = weighted.T @ (arrays["present"] & ~wins_matrix).astype(float)
+        wins += prior * (1 - np.eye(len(self.candidates)))
+        games = wins + wins.T
+        strength = np.ones(len(self.candidates))
+        for _ in range(iterations):
+            strength = wins.sum(axis=1) / (games / (strength[:, None] + strength[None, :])).sum(axis=1)
+            strength /= np.exp(np.log(strength).mean())
+        return 1000 + 400 * np.log10(strength)
+
+    def summary(self):
+        """
+        A text table of win rates, confidence intervals, mean scores and ratings,
+        followed by the win rates per segment.
+        """
+        rates, low, high = self.win_rates()
+        scores = self.mean_scores()
+        ratings = self.ratings()
+        width = max(len(name) for name in self.candidates + self.segments + ["candidate"]) + 2
+        lines = [f"{len(self)} verdicts ({self.invalid} invalid)",
+                 f"{'candidate':<{width}}{'win rate':>10}{'95% CI':>18}{'score':>8}{'rating':>8}"]
+        for i, name in enumerate(self.candidates):
+            lines.append(f"{name:<{width}}{rates[i]:>10.1%}"
+                         f"{f'[{low[i]:.1%}, {high[i]:.1%}]':>18}"
+                         f"{scores[i]:>8.2f}{ratings[i]:>8.0f}")
+        if len(self) and len(self.segments) > 1:
+            labels, matrix = self.breakdown("segment")
+            lines.append("")
+            lines.append(f"{'segment':<{width}}" + "".join(f"{name:>{width}}" for name in self.candidates))
+            for label, row in zip(labels, matrix):
+                lines.append(f"{label:<{width}}" + "".join(f"{rate:>{width}.1%}" for rate in row))
+        return "\n".join(lines)